@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""This module contains the local catalog of the products returned by the
+scihub. It is a SQLite database stored in the download directory with:
+    - product: one row per product uuid (title, link, begin year, cloud cover
+      percentage, footprint, ingestion date),
+    - search: one row per open search query (request of the requete.csv file)
+      with the time it was last refreshed from the scihub and whether the
+      scihub returned all its products,
+    - search_product: the products returned by each query,
+    - stored: the products that have been downloaded (uuid, md5, path, size),
+      whatever the request (zone) they were downloaded for.
+A query refreshed less than catalog_ttl minutes ago is answered from the
+catalog without contacting the scihub. Otherwise only the products ingested
+since the watermark of the request are requested and added to the catalog
+(see main.py).
+A product already downloaded for another request is linked (see
+misc_tools.linkfile) instead of being downloaded again.
+"""
+
+import os
+import sys
+import imp
+import sqlite3
+import time
+import logging
+
+module_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(module_path)
+
+import misc_tools
+import progressbar
+import xml_tools
+imp.reload(misc_tools)
+imp.reload(progressbar)
+imp.reload(xml_tools)
+
+if __name__ == '__main__':
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s ' +
+                              '- %(levelname)s - %(message)s')
+    steam_handler = logging.StreamHandler()
+    steam_handler.setFormatter(formatter)
+    steam_handler.setLevel(logging.DEBUG)
+    logger.addHandler(steam_handler)
+else:
+    logger = logging.getLogger('sentinel_dl')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS product (
+    uuid TEXT PRIMARY KEY,
+    title TEXT,
+    link TEXT,
+    year TEXT,
+    cloud REAL,
+    ingestiondate TEXT,
+    footprint TEXT);
+CREATE TABLE IF NOT EXISTS search (
+    query TEXT PRIMARY KEY,
+    refreshed REAL,
+    complete INTEGER DEFAULT 1);
+CREATE TABLE IF NOT EXISTS search_product (
+    query TEXT,
+    uuid TEXT,
+    PRIMARY KEY (query, uuid));
+CREATE TABLE IF NOT EXISTS stored (
+    path TEXT PRIMARY KEY,
+    uuid TEXT,
+    md5 TEXT,
+    size INTEGER);
+CREATE INDEX IF NOT EXISTS stored_uuid ON stored (uuid);
+CREATE INDEX IF NOT EXISTS stored_md5 ON stored (md5);
+"""
+
+#-----------------------------------opendb------------------------------------#
+def opendb(db_path):
+    """Function that open the catalog (created if it doesn't exist).
+
+    args:
+        db_path (string): path of the SQLite file
+
+    return:
+        sqlite3 connection
+    """
+    conn = sqlite3.connect(db_path)
+    conn.text_factory = str
+    conn.executescript(SCHEMA)
+    # catalog created before the complete column
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(search)')]
+    if 'complete' not in columns:
+        with conn:
+            conn.execute('ALTER TABLE search ADD COLUMN complete INTEGER DEFAULT 1')
+    return conn
+
+#---------------------------------lastrefresh---------------------------------#
+def lastrefresh(conn, query):
+    """Function that return the time (seconds since the epoch) a query was last
+    refreshed from the scihub, or None if it is not in the catalog."""
+    row = conn.execute('SELECT refreshed FROM search WHERE query = ?', (query,)).fetchone()
+    return None if row is None else row[0]
+
+#---------------------------------freshproducts-------------------------------#
+def freshproducts(conn, query, ttl):
+    """Function that return the products of a query if it has been refreshed
+    less than ttl minutes ago.
+
+    args:
+        conn: return of opendb
+        query (string): open search query (ex: row[1] of the requete.csv)
+        ttl (int): time to live in minutes. 0 means the catalog is never used
+                   without refreshing it.
+
+    return:
+        tuple (list of products (see readproducts), complete) or None if the
+        query is unknown or too old. complete is False if the last browse of
+        the scihub for the query was incomplete (see osodrequest.browseprod).
+    """
+    refreshed = lastrefresh(conn, query)
+    if refreshed is None or ttl <= 0:
+        return None
+    age = time.time() - refreshed
+    if age >= ttl * 60:
+        logger.debug('catalog of %s refreshed %d min ago: too old'% (query, age // 60))
+        return None
+    logger.debug('catalog of %s refreshed %d min ago'% (query, age // 60))
+    complete = conn.execute('SELECT complete FROM search WHERE query = ?', (query,)).fetchone()[0]
+    return readproducts(conn, query), complete != 0
+
+#---------------------------------readproducts--------------------------------#
+def readproducts(conn, query):
+    """Function that return the products of a query stored in the catalog.
+
+    args:
+        conn: return of opendb
+        query (string): open search query
+
+    return:
+        list of xml_tools.ProductRecord sorted by descending ingestion date,
+        like the scihub responses.
+    """
+    cursor = conn.execute('SELECT p.title, p.uuid, p.link, p.year, p.cloud, '
+                          'p.ingestiondate, p.footprint '
+                          'FROM product p JOIN search_product s ON p.uuid = s.uuid '
+                          'WHERE s.query = ? ORDER BY p.ingestiondate DESC', (query,))
+    return [xml_tools.ProductRecord._make(row) for row in cursor]
+
+#---------------------------------storeproducts-------------------------------#
+def storeproducts(conn, query, prodList, full, complete=True):
+    """Function that add the products returned by the scihub for a query to
+    the catalog and mark the query as refreshed.
+
+    args:
+        conn: return of opendb
+        query (string): open search query
+        prodList (list): return of osodrequest.browseprod
+        full (boolean): True if prodList is the entire catalog of the query.
+                        The products of the query that are not in prodList
+                        anymore are then removed from it.
+        complete (boolean): False if browseprod returned an incomplete list.
+                            The query is then marked as incomplete until it
+                            is browsed completely (see freshproducts).
+    """
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO product (title, uuid, link, year, cloud, '
+                         'ingestiondate, footprint) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (element[:7] for element in prodList))
+        if full:
+            conn.execute('DELETE FROM search_product WHERE query = ?', (query,))
+        conn.executemany('INSERT OR IGNORE INTO search_product (query, uuid) VALUES (?, ?)',
+                         ((query, element[1]) for element in prodList))
+        # products that no query returns anymore
+        conn.execute('DELETE FROM product WHERE uuid NOT IN (SELECT uuid FROM search_product)')
+        conn.execute('INSERT OR REPLACE INTO search (query, refreshed, complete) VALUES (?, ?, ?)',
+                     (query, time.time(), 1 if complete else 0))
+    logger.debug('%s product(s) stored in the catalog for %s'% (str(len(prodList)), query))
+
+#----------------------------------addstored----------------------------------#
+def addstored(conn, entries, replace=True):
+    """Function that add downloaded products to the index of the stored
+    products.
+
+    args:
+        conn: return of opendb
+        entries (list): list of (uuid, md5, path) of complete files
+        replace (boolean): if False, the paths already indexed are kept as is
+    """
+    rows = []
+    for uuid, checksum, path in entries:
+        if os.path.isfile(path):
+            rows.append((path, uuid, checksum.lower(), os.path.getsize(path)))
+    with conn:
+        conn.executemany('INSERT OR %s INTO stored (path, uuid, md5, size) VALUES (?, ?, ?, ?)'
+                         % ('REPLACE' if replace else 'IGNORE'), rows)
+
+#---------------------------------linkstored----------------------------------#
+def linkstored(conn, uuid, checksum, filePath):
+    """Function that look for a product already downloaded (same uuid or same
+    md5) and link it to filePath.
+
+    args:
+        conn: return of opendb
+        uuid (string): uuid of the product
+        checksum (string): md5 of the product
+        filePath (string): path where the product must be available
+
+    return:
+        True if the product is available at filePath, False if it has to be
+        downloaded.
+    """
+    checksum = checksum.lower()
+    cursor = conn.execute('SELECT path, md5, size FROM stored WHERE (uuid = ? OR md5 = ?) '
+                          'AND path != ?', (uuid, checksum, filePath))
+    for path, md5, size in cursor.fetchall():
+        if md5 != checksum:
+            continue
+        # the file must not have been removed, replaced or corrupted since it
+        # was indexed (the checksum is usually read from the digest cache)
+        if (not os.path.isfile(path) or os.path.getsize(path) != size or
+            misc_tools.generate_file_md5(os.path.dirname(path), os.path.basename(path)) != checksum):
+            with conn:
+                conn.execute('DELETE FROM stored WHERE path = ?', (path,))
+            continue
+        method = misc_tools.linkfile(path, filePath)
+        if method:
+            logger.info('%s already downloaded: %s from %s'% (os.path.basename(filePath),
+                                                            method, path))
+            progressbar.removepart(filePath)
+            addstored(conn, [(uuid, checksum, filePath)])
+            return True
+    return False
+
+#------------------------------------Test-------------------------------------#
+if __name__ == '__main__':
+    import hashlib
+    base_path = os.path.dirname(module_path)
+    xmlpath2 = base_path + "/testfile/test_S2.xml"
+    db_path = base_path + "/testfile/catalog_test.db"
+
+    # set test
+    list_function = ['storeproducts', 'freshproducts', 'linkstored']
+    test_function = [list_function[0], list_function[1], list_function[2]] # insert function(s) from list_function to test
+
+    if os.path.isfile(db_path):
+        os.remove(db_path)
+    conn = opendb(db_path)
+    prod_list = xml_tools.getprodlist(xmlpath2, 'S2')
+
+    if(list_function[0] in test_function):
+        print('#--------------test: %s--------------#'% list_function[0])
+        storeproducts(conn, 'platformname:Sentinel-2', prod_list[:6], False)
+        storeproducts(conn, 'platformname:Sentinel-2', prod_list[4:], False)
+        print(len(readproducts(conn, 'platformname:Sentinel-2')))
+        storeproducts(conn, 'platformname:Sentinel-2', prod_list[2:], True)
+        print(len(readproducts(conn, 'platformname:Sentinel-2')))
+        print(sorted(readproducts(conn, 'platformname:Sentinel-2')) == sorted(prod_list[2:]))
+
+    if(list_function[1] in test_function):
+        print('#--------------test: %s--------------#'% list_function[1])
+        print(freshproducts(conn, 'platformname:Sentinel-2', 0))
+        print(len(freshproducts(conn, 'platformname:Sentinel-2', 60)[0]))
+        print(freshproducts(conn, 'platformname:Sentinel-1', 60))
+        storeproducts(conn, 'platformname:Sentinel-2', prod_list[:2], False, False)
+        print(freshproducts(conn, 'platformname:Sentinel-2', 60)[1])
+
+    if(list_function[2] in test_function):
+        print('#--------------test: %s--------------#'% list_function[2])
+        zone1_path = base_path + '/testfile/linkstored_zone1.tmp'
+        zone2_path = base_path + '/testfile/linkstored_zone2.tmp'
+        with open(zone1_path, 'wb') as f:
+            f.write('sentinel')
+        addstored(conn, [(prod_list[0][1], hashlib.md5('sentinel').hexdigest().upper(), zone1_path)])
+        print(linkstored(conn, prod_list[0][1], hashlib.md5('sentinel').hexdigest(), zone2_path))
+        print(linkstored(conn, prod_list[0][1], '012345', zone2_path + '2'))
+        print(os.path.samefile(zone1_path, zone2_path))
+        os.remove(zone1_path)
+        os.remove(zone2_path)
+
+    conn.close()
+    os.remove(db_path)
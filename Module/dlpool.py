@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""This module contains a bounded pool of workers that download and verify the
+parts of a product in parallel. It is used in the case tiles and/or bands are
+specified in the request.csv, where a product is made of dozens of small files
+(jp2, gml, xml…) and where the latency of each request dominates the download
+time.
+Many parts are identical from one product to another (xsd schemas, html
+pages, rep_info files…). Once downloaded, each part is also linked into a
+content addressed store (storeDir) where it is named after the md5 given by the
+manifest.safe: a part whose md5 is already in the store is linked instead of
+being downloaded again.
+The parts of the store that are only linked to the store itself (the products
+have been removed) are pruned at the end of each run. The parts stored with a
+reflink (see misc_tools.linkfile) don't share their link count with the
+products: they are listed in the reflinks file of the store and never pruned.
+"""
+
+import os
+import sys
+import imp
+import logging
+import threading
+
+module_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(module_path)
+
+import misc_tools
+import osodrequest
+import progressbar
+import engine
+imp.reload(misc_tools)
+imp.reload(osodrequest)
+
+if __name__ == '__main__':
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s ' +
+                              '- %(levelname)s - %(message)s')
+    steam_handler = logging.StreamHandler()
+    steam_handler.setFormatter(formatter)
+    steam_handler.setLevel(logging.DEBUG)
+    logger.addHandler(steam_handler)
+else:
+    logger = logging.getLogger('sentinel_dl')
+
+# Directory of the content addressed store of the parts. None means that the
+# store is not used. Set by main.py (dl_dir/.cas).
+storeDir = None
+storeLock = threading.Lock()
+storeStats = {'linked': 0, 'saved': 0}
+
+#----------------------------------reflinkspath--------------------------------#
+def reflinkspath():
+    """Function that return the path of the list of the parts stored with a
+    reflink."""
+    return storeDir + '/reflinks'
+
+#----------------------------------storepath-----------------------------------#
+def storepath(checksum):
+    """Function that return the path of a part in the store."""
+    checksum = checksum.lower()
+    return storeDir + '/' + checksum[:2] + '/' + checksum
+
+#----------------------------------linkstored----------------------------------#
+def linkstored(part, partPath):
+    """Function that link a part from the store if it has already been
+    downloaded.
+
+    args:
+        part (list): [relative path, checksum, download uri]
+        partPath (string): path where the part must be available
+
+    return:
+        True if the part is available at partPath
+    """
+    if storeDir is None:
+        return False
+    stored_path = storepath(part[1])
+    if not os.path.isfile(stored_path):
+        return False
+    # The stored part may have been corrupted since it was downloaded (see
+    # verify.py). Its checksum is usually read from the digest cache.
+    if misc_tools.generate_file_md5(os.path.dirname(stored_path), os.path.basename(stored_path),
+                                    2**20) != part[1].lower():
+        logger.warning('The stored part %s is corrupted. It is removed from the store.'% stored_path)
+        with storeLock:
+            if os.path.isfile(stored_path):
+                os.remove(stored_path)
+        return False
+    misc_tools.create_directory(os.path.dirname(partPath))
+    with storeLock:
+        method = misc_tools.linkfile(stored_path, partPath)
+        if not method:
+            return False
+        storeStats['linked'] += 1
+        storeStats['saved'] += os.path.getsize(partPath)
+    progressbar.removepart(partPath)
+    logger.info('The current product part is already in the store (%s)'% method)
+    return True
+
+#-----------------------------------addstored----------------------------------#
+def addstored(part, partPath):
+    """Function that add a part whose checksum is ok to the store."""
+    if storeDir is None:
+        return
+    stored_path = storepath(part[1])
+    misc_tools.create_directory(os.path.dirname(stored_path))
+    with storeLock:
+        if not os.path.isfile(stored_path):
+            if misc_tools.linkfile(partPath, stored_path) == 'reflink':
+                with open(reflinkspath(), 'a') as f:
+                    f.write(os.path.basename(stored_path) + '\n')
+
+#----------------------------------prunestore----------------------------------#
+def prunestore():
+    """Function that remove the parts of the store that are not linked to any
+    product anymore (ex: products removed by the user). Only the parts stored
+    with a hard link are removed: a reflink always has a single link.
+
+    return:
+        the number of bytes freed
+    """
+    freed = 0
+    if storeDir is None or not os.path.isdir(storeDir):
+        return freed
+    reflinks = set()
+    if os.path.isfile(reflinkspath()):
+        with open(reflinkspath()) as f:
+            reflinks = set(line.strip() for line in f)
+    for dir_path, dir_names, file_names in os.walk(storeDir):
+        if dir_path == storeDir:
+            continue
+        for file_name in file_names:
+            if file_name in reflinks:
+                continue
+            stat = os.stat(dir_path + '/' + file_name)
+            if stat.st_nlink == 1:
+                os.remove(dir_path + '/' + file_name)
+                freed += stat.st_size
+    return freed
+
+#---------------------------------downloadpart---------------------------------#
+def downloadpart(part, partPath, nbRetry, waitTime, chunkSize, state, reportHook=None):
+    """Function that download a single part of a product and check its
+    checksum.
+
+    args:
+        part (list): part of a product (return of manifestSafe.generateuri):
+                    [relative path, checksum, download uri]
+        partPath (string): path where the part will be saved
+        nbRetry (int): number of time the client will try to contact the
+                        server.
+        waitTime (int): time in second to wait between tries
+        chunkSize (int): bytes to read and write.
+        state (dictionary): state shared between the workers. It contains the
+                        'fulldisk' flag and the lock that protects it.
+        reportHook: function called after each chunk (ex:
+                    progressbar.chunk_report).
+
+    return:
+        the status of the part: 'checksum ok' or 'corrupted file'
+    """
+    with state['lock']:
+        fulldisk = state['fulldisk']
+    if linkstored(part, partPath):
+        return 'checksum ok'
+    if fulldisk:
+        logger.warning('The current product part has not been retrieved because the disk is full')
+        return 'corrupted file'
+    misc_tools.create_directory(os.path.dirname(partPath))
+    result = osodrequest.getimagefile(part[2], nbRetry, waitTime, partPath,
+                                      chunkSize, part[1].lower(),
+                                      reportHook=reportHook)
+    if result[1]:
+        with state['lock']:
+            state['fulldisk'] = True
+    if result[0]:
+        if result[2].lower() == part[1].lower():
+            logger.info('The current product part has been successfully retrieved')
+            status = 'checksum ok'
+            addstored(part, partPath)
+        else:
+            logger.warning('The current product part is corrupted')
+            status = 'corrupted file'
+    else:
+        logger.warning('The current product part could not be retrieved.')
+        status = 'corrupted file'
+    return status
+
+#--------------------------------downloadparts---------------------------------#
+def downloadparts(parts, baseProdPath, nbRetry, waitTime, chunkSize, nbWorkers,
+                  fulldisk=False):
+    """Generator that download the parts of a product with a pool of at most
+    nbWorkers workers (threads or green threads, see engine). The status of
+    each part is yielded as soon as the part is processed so that the caller
+    can update the part report.
+
+    args:
+        parts (list of list): parts of a product (return of
+                            manifestSafe.generateuri)
+        baseProdPath (string): directory of the product on the disk
+        nbRetry (int): number of time the client will try to contact the
+                        server.
+        waitTime (int): time in second to wait between tries
+        chunkSize (int): bytes to read and write.
+        nbWorkers (int): maximum number of parts downloaded at the same time.
+        fulldisk (boolean): True if the disk is already known to be full.
+
+    yield:
+        (part, status, fulldisk): the part, its status ('checksum ok' or
+        'corrupted file') and whether the disk has been found full so far.
+    """
+    # Once a worker hits a full disk, the parts that have not been started yet
+    # are not downloaded and get the 'corrupted file' status, as it was the case
+    # when the parts were downloaded one after the other.
+    state = {'lock': threading.Lock(), 'fulldisk': fulldisk}
+    nb_parts = len(parts)
+
+    def work(args):
+        i, part = args
+        part_path = baseProdPath + part[0][1:]
+        logger.info('download %s out of %s\n file : %s'
+                    % (str(i+1), str(nb_parts), part_path))
+        # The progress of the parts is shown by progressbar.monitor
+        status = downloadpart(part, part_path, nbRetry, waitTime, chunkSize, state)
+        return part, status
+
+    if nbWorkers <= 1:
+        for i, part in enumerate(parts):
+            part, status = work((i, part))
+            yield part, status, state['fulldisk']
+    else:
+        logger.debug('Downloading %s parts with %s workers'% (str(nb_parts), str(nbWorkers)))
+        pool = engine.makepool(min(nbWorkers, max(nb_parts, 1)))
+        try:
+            for part, status in pool.imap_unordered(work, enumerate(parts)):
+                with state['lock']:
+                    fulldisk = state['fulldisk']
+                yield part, status, fulldisk
+        finally:
+            pool.terminate()
+            pool.join()
+
+#------------------------------------Test-------------------------------------#
+if __name__ == '__main__':
+    import manifestSafe
+    base_path = os.path.dirname(module_path)
+    config_path = base_path + "/config.cfg"
+    conf_dict = misc_tools.readconf(config_path)
+
+    nbretry = 1
+    waittime = 5
+    chunk_size = 2**23
+    dl_product = "https://scihub.copernicus.eu/dhus/odata/v1/Products('0282b16c-310a-408b-aad6-85fdfa02a5da')/$value"
+    name_product = 'S2A_OPER_PRD_MSIL1C_PDMC_20160222T115941_R008_V20160218T104104_20160218T104104'
+    xmlmanifestpath = base_path + "/testfile/manifest.safe.xml"
+    tiles = ['T31TEJ', 'T31TDJ']
+    bands = ['B02', 'B03', 'B04']
+
+    # set test
+    list_function = ['downloadparts']
+    test_function = [list_function[0]] # insert function(s) from list_function to test
+
+    if(list_function[0] in test_function):
+        print('#--------------test: %s--------------#'% list_function[0])
+        osodrequest.authenticate(conf_dict['log']['user'], conf_dict['log']['pw'],
+                                 conf_dict['log']['auth_url'])
+        elements = manifestSafe.readmanifest(xmlmanifestpath)
+        elements = manifestSafe.filterelementS2(elements, tiles, bands)
+        elements = manifestSafe.generateuri(elements, dl_product, name_product)
+        base_prod_path = base_path + "/testfile/%s"% name_product
+        for part, status, fulldisk in downloadparts(elements, base_prod_path, nbretry,
+                                                    waittime, chunk_size, 4):
+            logger.debug('%s : %s (full disk: %s)'% (part[0], status, fulldisk))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""This module contains the engines used to run the network operations (search
+pages, checksums, manifests and file downloads) concurrently. Two engines are
+available and selected with the 'engine' parameter of the config.cfg file:
+    - 'thread': a pool of operating system threads.
+    - 'green': a pool of green threads running on a single event loop (eventlet
+      library, see testfile/testthread.py). The standard library is monkey
+      patched so that the blocking calls of osodrequest (sockets, sleep, locks)
+      give the hand to the other transfers instead of blocking. Hundreds of
+      small transfers can then overlap without a thread per transfer.
+The 'green' engine needs the optional eventlet library (see README.md). If it
+can't be imported, an error is logged and the 'thread' engine is used instead.
+"""
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+if __name__ == '__main__':
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s ' +
+                              '- %(levelname)s - %(message)s')
+    steam_handler = logging.StreamHandler()
+    steam_handler.setFormatter(formatter)
+    steam_handler.setLevel(logging.DEBUG)
+    logger.addHandler(steam_handler)
+else:
+    logger = logging.getLogger('sentinel_dl')
+
+engine = 'thread' # engine currently in use
+
+#------------------------------------setup------------------------------------#
+def setup(name):
+    """Function that select the engine used by makepool. The 'green' engine
+    must be set up before the modules that create locks or connections when
+    they are imported (progressbar, throttle, dlpool, osodrequest…, see
+    main.py): their locks would otherwise block the event loop.
+
+    args:
+        name (string): 'thread' or 'green'
+
+    return:
+        the name of the engine actually in use
+    """
+    global engine
+    if name == 'green':
+        try:
+            import eventlet
+        except ImportError as e:
+            logger.error('The green engine needs the eventlet library (pip install ' +
+                         'eventlet), which could not be imported: %s. '% str(e) +
+                         'Using the thread engine.')
+            name = 'thread'
+        else:
+            eventlet.monkey_patch(socket=True, select=True, thread=True, time=True)
+    elif name != 'thread':
+        logger.warning('Unknown engine %s. Using the thread engine.'% name)
+        name = 'thread'
+    engine = name
+    logger.debug('engine: %s'% engine)
+    return engine
+
+#----------------------------------GreenPool----------------------------------#
+class GreenPool(object):
+    """Pool of green threads with the same interface as ThreadPool for the
+    methods used in this project."""
+
+    def __init__(self, size):
+        import eventlet
+        import eventlet.queue
+        self.eventlet = eventlet
+        self.pool = eventlet.GreenPool(size)
+        self.queue = eventlet.queue
+
+    def imap(self, func, iterable):
+        return self.pool.imap(func, iterable)
+
+    def imap_unordered(self, func, iterable):
+        results = self.queue.Queue()
+        items = list(iterable)
+
+        def run(item):
+            try:
+                results.put((True, func(item)))
+            except Exception as e:
+                results.put((False, e))
+
+        for item in items:
+            self.pool.spawn_n(run, item)
+        for i in range(len(items)):
+            ok, result = results.get()
+            if not ok:
+                raise result
+            yield result
+
+    def terminate(self):
+        for thread in list(self.pool.coroutines_running):
+            thread.kill()
+
+    def join(self):
+        self.pool.waitall()
+
+#----------------------------------makepool-----------------------------------#
+def makepool(size):
+    """Function that create a pool of workers of the selected engine.
+
+    args:
+        size (int): maximum number of operations running at the same time
+
+    return:
+        a pool with the imap, imap_unordered, terminate and join methods of
+        multiprocessing.pool.ThreadPool
+    """
+    if engine == 'green':
+        return GreenPool(size)
+    return ThreadPool(size)
+
+#---------------------------------runparallel---------------------------------#
+def runparallel(func, argsList, size):
+    """Function that call func with each tuple of arguments of argsList, at
+    most size calls at the same time.
+
+    args:
+        func (function): function to call
+        argsList (list of tuple): arguments of each call
+        size (int): maximum number of calls running at the same time
+
+    return:
+        the list of the results, in the order of argsList
+    """
+    if size <= 1 or len(argsList) <= 1:
+        return [func(*args) for args in argsList]
+    pool = makepool(min(size, len(argsList)))
+    try:
+        return list(pool.imap(lambda args: func(*args), argsList))
+    finally:
+        pool.terminate()
+        pool.join()
+
+#------------------------------------Test-------------------------------------#
+if __name__ == '__main__':
+    import time
+
+    def wait(sec):
+        time.sleep(sec)
+        return sec
+
+    # set test
+    list_function = ['runparallel']
+    test_function = [list_function[0]] # insert function(s) from list_function to test
+
+    if(list_function[0] in test_function):
+        print('#--------------test: %s--------------#'% list_function[0])
+        for name in ['thread', 'green']:
+            setup(name)
+            start = time.time()
+            result = runparallel(wait, [(1,)] * 10, 10)
+            print('%s: %s in %0.1f s'% (engine, str(result), time.time() - start))
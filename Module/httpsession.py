@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""This module provides a small http session built on top of httplib. Unlike
+urllib2, which opens a new connection (and a new TLS handshake) for each
+request, the session keeps the connections to the server alive and reuses them
+for the next requests. The basic authentication header is sent with every
+request so that the server does not have to answer with a 401 first.
+The responses returned by Session.urlopen behave like the ones of
+urllib2.urlopen (read, info, getcode, geturl, close) and the errors are raised
+as urllib2.HTTPError and urllib2.URLError so that the callers don't need to
+change the way they handle them.
+"""
+
+import httplib
+import urllib2
+import urlparse
+import base64
+import socket
+import threading
+import logging
+from StringIO import StringIO
+
+if __name__ == '__main__':
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s ' +
+                              '- %(levelname)s - %(message)s')
+    steam_handler = logging.StreamHandler()
+    steam_handler.setFormatter(formatter)
+    steam_handler.setLevel(logging.DEBUG)
+    logger.addHandler(steam_handler)
+else:
+    logger = logging.getLogger('sentinel_dl')
+
+#----------------------------------Response-----------------------------------#
+class Response(object):
+    """Response of a request sent through a Session. The connection goes back
+    to the session pool once the body has been entirely read.
+
+    When the body has a known length, it is read directly from the socket,
+    which allows to count the bytes as they arrive (progress callback, called
+    with the number of bytes received) and to abort a blocked read from
+    another thread (abort).
+    """
+
+    def __init__(self, session, key, conn, resp, url):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.progress = None
+
+    def raw(self):
+        """Return True if the body can be read directly from the socket."""
+        resp = self.resp
+        if (self.conn is None or self.conn.sock is None or resp.fp is None
+                or resp.chunked or resp.length is None):
+            return False
+        # The response is created unbuffered (httplib default) so nothing of
+        # the body should have been read with the headers.
+        try:
+            return len(resp.fp._rbuf.getvalue()) == 0
+        except AttributeError:
+            return False
+
+    def readinto(self, b):
+        """Read up to len(b) bytes of the body into the writable buffer b.
+
+        return:
+            the number of bytes read, 0 at the end of the body.
+        """
+        view = memoryview(b)
+        if self.conn is None:
+            return 0
+        if not self.raw():
+            data = self.read(len(view))
+            view[:len(data)] = data
+            return len(data)
+        size = min(len(view), self.resp.length)
+        sock = self.conn.sock
+        pos = 0
+        try:
+            while pos < size:
+                n = sock.recv_into(view[pos:size])
+                if n == 0:
+                    raise httplib.IncompleteRead(view[:pos].tobytes())
+                pos += n
+                self.resp.length -= n
+                if self.progress:
+                    self.progress(n)
+        except (socket.error, httplib.HTTPException):
+            self.discard()
+            raise
+        if self.resp.length == 0:
+            self.resp.close()
+            self.release()
+        return pos
+
+    def read(self, amt=None):
+        if self.conn is None:
+            return ''
+        if amt is not None and self.raw():
+            buf = bytearray(min(amt, self.resp.length))
+            n = self.readinto(buf)
+            return memoryview(buf)[:n].tobytes()
+        try:
+            data = self.resp.read(amt)
+        except (socket.error, httplib.HTTPException):
+            self.discard()
+            raise
+        if self.progress:
+            self.progress(len(data))
+        if self.resp.isclosed():
+            self.release()
+        return data
+
+    def abort(self):
+        """Stop the transfer. Can be called from another thread, the pending
+        read fails and the connection is not reused."""
+        conn = self.conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def info(self):
+        return self.resp.msg
+
+    def getcode(self):
+        return self.resp.status
+
+    def geturl(self):
+        return self.url
+
+    def release(self):
+        """Give the connection back to the session pool."""
+        if self.conn is not None:
+            if self.resp.will_close:
+                self.conn.close()
+            else:
+                self.session.release(self.key, self.conn)
+            self.conn = None
+
+    def discard(self):
+        """Close the connection, it can't be reused."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def close(self):
+        # A connection with unread bytes can't be used for another request
+        if self.resp.isclosed():
+            self.release()
+        else:
+            self.discard()
+
+#-----------------------------------Session-----------------------------------#
+class Session(object):
+    """Pool of keep-alive http(s) connections that share the same
+    credentials.
+
+    args:
+        username (string): username at the scihub webpage
+        password (string): password at the scihub webpage
+        timeout (int): default socket timeout in second
+        maxIdle (int): maximum number of idle connections kept per server
+    """
+
+    maxRedirect = 5
+
+    def __init__(self, username=None, password=None, timeout=None, maxIdle=16):
+        self.auth = None
+        if username is not None:
+            self.auth = 'Basic ' + base64.b64encode('%s:%s'% (username, password))
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'opened': 0, 'reused': 0}
+
+    def connection(self, key, timeout):
+        """Return an idle connection to the server or a new one.
+
+        return:
+            (conn, reused)
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            if self.idle.get(key):
+                self.stats['reused'] += 1
+                conn = self.idle[key].pop()
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.stats['opened'] += 1
+        scheme, host = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout)
+        return conn, False
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.maxIdle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all the idle connections."""
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+    def urlopen(self, url, headers=None, timeout=None):
+        """Send a GET request and return the response.
+
+        args:
+            url (string): url of the request (already formatted)
+            headers (dictionary): additional headers (ex: {'Range': 'bytes=0-'})
+            timeout (int): socket timeout in second. Session timeout if None.
+
+        return:
+            Response object
+
+        raise:
+            urllib2.HTTPError if the server answer with an error code,
+            urllib2.URLError if the server could not be reached.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        origin = None
+        for i in range(self.maxRedirect + 1):
+            parts = urlparse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            if origin is None:
+                origin = key
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            request_headers = {'Connection': 'keep-alive'}
+            if self.auth:
+                request_headers['Authorization'] = self.auth
+            if headers:
+                request_headers.update(headers)
+            if key != origin:
+                # The credentials are not sent to the host of a redirection
+                # (as urllib2 does)
+                request_headers.pop('Authorization', None)
+            conn, reused = self.connection(key, timeout)
+            try:
+                try:
+                    conn.request('GET', path, headers=request_headers)
+                    resp = conn.getresponse()
+                except (socket.error, httplib.HTTPException):
+                    # The server may have closed an idle connection in the
+                    # meantime. The request is sent again on a new connection.
+                    conn.close()
+                    if not reused:
+                        raise
+                    conn, reused = self.connection(key, timeout)
+                    conn.request('GET', path, headers=request_headers)
+                    resp = conn.getresponse()
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                raise urllib2.URLError(e)
+            response = Response(self, key, conn, resp, url)
+            if resp.status in (301, 302, 303, 307) and resp.getheader('Location'):
+                response.read()
+                response.close()
+                url = urlparse.urljoin(url, resp.getheader('Location'))
+                logger.debug('Redirected to %s'% url)
+                continue
+            if resp.status >= 400:
+                body = response.read()
+                response.close()
+                raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg,
+                                        StringIO(body))
+            return response
+        raise urllib2.URLError('Too many redirections')
+
+#------------------------------------Test-------------------------------------#
+if __name__ == '__main__':
+    url = 'https://scihub.copernicus.eu/dhus/search?q=*&rows=1'
+    session = Session(timeout=60)
+
+    # set test
+    list_function = ['urlopen']
+    test_function = [list_function[0]] # insert function(s) from list_function to test
+
+    if(list_function[0] in test_function):
+        print('#--------------test: %s--------------#'% list_function[0])
+        for i in range(3):
+            try:
+                handle = session.urlopen(url)
+            except IOError as e:
+                print('error: %s'% str(e))
+            else:
+                print('status: %s size: %s'% (handle.getcode(), len(handle.read())))
+        print(session.stats)
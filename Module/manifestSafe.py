@@ -396,10 +396,7 @@ if __name__ == '__main__':
             result = osodrequest.getimagefile(elem[2], nbretry, waittime, filepath, 2**23, elem[1])
             logger.debug('getimagefile succeed: %s'% str(result[0]))
             if result[0]:
-                md5generated = misc_tools.generate_file_md5(os.path.dirname(filepath),
-                                                            os.path.basename(filepath),
-                                                            blocksize=2**20)
-                goodfile = md5generated.lower() == elem[1].lower()
+                goodfile = result[2].lower() == elem[1].lower()
                 checksum_bool.append(goodfile)
         logger.debug('%s file downloaded out of %s'% (str(len(checksum_bool)), str(len(elements))))
         logger.debug('%s file good out of %s'% (str(sum(checksum_bool)), str(len(checksum_bool))))
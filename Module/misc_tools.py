@@ -2,10 +2,18 @@
 """This module contains some basic functions
 """
 import os
+import re
+import errno
 import ConfigParser
 import urllib
 import hashlib
 import logging
+import fcntl
+import mmap
+import ctypes
+import ctypes.util
+import datetime
+import sqlite3
 
 if __name__ == '__main__':
     logger = logging.getLogger(__name__)
@@ -18,6 +26,18 @@ if __name__ == '__main__':
     logger.addHandler(steam_handler)
 else:
     logger = logging.getLogger('sentinel_dl')
+
+# SQLite file of the digest cache of generate_file_md5. None means that the
+# cache is not used. Set by main.py (dl_dir/digest.db).
+digestDb = None
+DIGEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest (
+    path TEXT PRIMARY KEY,
+    inode INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    md5 TEXT);
+"""
     
 #----------------------------create_directory-----------------------------#
 def create_directory(dir_path):
@@ -31,8 +51,14 @@ def create_directory(dir_path):
     """
     did_exist = True
     if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-        did_exist = False      
+        # The directory may be created by another download thread in between
+        try:
+            os.makedirs(dir_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            did_exist = False
     return did_exist
 
 #---------------------------------findSat--------------------------------------#
@@ -55,6 +81,24 @@ def findSat(request, sat_dict):
     return sat
 
 #---------------------------------readconf-------------------------------------#
+# Default values of the optional parameters of the [param] section, so that a
+# config.cfg written for a previous version of the tool can still be used.
+PARAM_DEFAULTS = {'nb_workers': '4',
+                  'nb_segments': '1',
+                  'nb_page_workers': '4',
+                  'sync_overlap': '24',
+                  'full_sync_days': '7',
+                  'catalog_ttl': '60',
+                  'verify_workers': '0',
+                  'dump_pages': '0',
+                  'read_timeout': '300',
+                  'stall_window': '120',
+                  'stall_rate': '1024',
+                  'engine': 'thread',
+                  'max_rate': '0',
+                  'rate_schedule': '',
+                  'disk_reserve': '0'}
+
 def readconf(config_path):
     """Function that read a configuration file
 
@@ -65,7 +109,9 @@ def readconf(config_path):
                     section and parameter:value. The higher level dictionary
                     contains the section as key and a dictionary as value.
                     This lower dictionary contains the parameter as key and
-                    the value of the parameter as value.
+                    the value of the parameter as value. The missing optional
+                    parameters of the [param] section get their default value
+                    (see PARAM_DEFAULTS).
     """ 
     config = ConfigParser.RawConfigParser()
     config.read(config_path)
@@ -74,6 +120,11 @@ def readconf(config_path):
         dictionary[section] = {}
         for option in config.options(section):
             dictionary[section][option] = config.get(section, option)
+    param = dictionary.setdefault('param', {})
+    for option, value in PARAM_DEFAULTS.items():
+        if option not in param:
+            logger.debug('%s is not in %s: using %s'% (option, config_path, repr(value)))
+            param[option] = value
     return dictionary
 
 #---------------------------------buildreq-------------------------------------#
@@ -94,6 +145,71 @@ def buildreq(url_request_raw, row, start):
     url_request = urllib.quote(url_request_raw, ':()[]/?=,&')
     return url_request
 
+#--------------------------------ingestionreq----------------------------------#
+def ingestionreq(url_request_raw, watermark, overlap):
+    """Function that restrict a base request to the products ingested since a
+    given date
+
+    parameters:
+        url_request_raw (string): non formated base request (.../search?q=...)
+        watermark (string): latest ingestion date already seen.
+                            ex: '2016-02-23T22:45:56.547Z'
+        overlap (int): number of hours before the watermark that are queried
+                        again, in case some products were published late.
+    return:
+        url with the ingestiondate condition appended to the query
+    """
+    start = readdate(watermark) - datetime.timedelta(hours=overlap)
+    base, query = url_request_raw.split('?q=', 1)
+    return (base + '?q=(' + query + ') AND ingestiondate:[%s TO NOW]'
+            % start.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+
+#---------------------------------pushdownreq----------------------------------#
+def pushdownreq(url_request_raw, sat, maxcloudperc, tiles):
+    """Function that add to a base request the conditions of the requete.csv
+    that are otherwise checked once the products have been retrieved (cloud
+    cover percentage, tiles), so that the scihub only returns the products
+    that may be downloaded.
+
+    parameters:
+        url_request_raw (string): non formated base request (.../search?q=...)
+        sat (string): satellite 'S1' or 'S2'
+        maxcloudperc (string): maximum cloud percentage (column 'nuage' of the
+                        requete.csv). Ignored if it is not a number.
+        tiles (list of string): tiles to keep (return of extractBandsTiles).
+                        Ignored if one of them is not a tile name.
+    return:
+        url with the conditions appended to the query
+    """
+    clauses = []
+    if sat == 'S2' and maxcloudperc.isdigit():
+        clauses.append('cloudcoverpercentage:[0 TO %s]'% maxcloudperc)
+    tiles = [tile.upper() for tile in tiles if tile != '']
+    if sat == 'S2' and tiles and all(re.match('^T?[0-9]{2}[A-Z]{3}$', tile) for tile in tiles):
+        # Since december 2016 the name of a product contains its tile
+        # (ex: S2A_MSIL1C_20170105T103422_N0204_R108_T31TDF_20170105T103426).
+        # The products named after the former convention (S2A_OPER_PRD_...)
+        # contain several tiles that are not in their name: they are kept.
+        names = ['filename:*_T%s_*'% tile[-5:] for tile in tiles]
+        names.append('filename:S2?_OPER_*')
+        clauses.append('(' + ' OR '.join(names) + ')')
+    if not clauses:
+        return url_request_raw
+    base, query = url_request_raw.split('?q=', 1)
+    return base + '?q=(' + query + ') AND ' + ' AND '.join(clauses)
+
+#----------------------------------readdate-------------------------------------#
+def readdate(date):
+    """Function that read a date of the scihub (ex: '2016-02-23T22:45:56.547Z'
+    or '2016-02-23T22:45:56Z'). The fraction of second is ignored.
+
+    parameters:
+        date (string): date in the ISO 8601 format
+    return:
+        datetime object
+    """
+    return datetime.datetime.strptime(date[:19], '%Y-%m-%dT%H:%M:%S')
+
 #---------------------------------cloudfilter----------------------------------#
 def cloudfilter(prod_list, sat, maxcloudperc):
     """Function that filter a product list base on the maximum cloud percentage
@@ -108,39 +224,202 @@ def cloudfilter(prod_list, sat, maxcloudperc):
         cloud percentage condition.
     """
     if sat != 'S1':
-        prod_list_filter = [elem for elem in prod_list if elem[-1] <= maxcloudperc]
+        prod_list_filter = [elem for elem in prod_list if elem[4] <= maxcloudperc]
     else:
         prod_list_filter = prod_list
     return prod_list_filter
 
+#-----------------------------------filekey------------------------------------#
+def filekey(file_path):
+    """Function that return the identity of a file for the digest cache.
+
+    return:
+        (inode, size, mtime_ns), None if the file doesn't exist
+    """
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    # os.stat has no st_mtime_ns in python 2
+    return (st.st_ino, st.st_size, int(round(st.st_mtime * 10**9)))
+
+#---------------------------------opendigest-----------------------------------#
+def opendigest():
+    """Function that open the digest cache. A connection is opened for each
+    lookup so that the cache can be used by the download threads and by
+    several processes (the cost is negligible compared to hashing a file).
+    """
+    conn = sqlite3.connect(digestDb, timeout=60)
+    conn.executescript(DIGEST_SCHEMA)
+    return conn
+
+#--------------------------------cacheddigest----------------------------------#
+def cacheddigest(file_path):
+    """Function that return the md5 checksum of a file from the digest cache.
+
+    return:
+        the checksum md5, '' if the cache is not used, if the file is not in
+        the cache or if it has changed (inode, size or modification time)
+        since it was hashed.
+    """
+    if digestDb is None:
+        return ''
+    key = filekey(file_path)
+    if key is None:
+        return ''
+    conn = opendigest()
+    try:
+        row = conn.execute('SELECT inode, size, mtime_ns, md5 FROM digest WHERE path = ?',
+                           (os.path.abspath(file_path),)).fetchone()
+    finally:
+        conn.close()
+    if row is None or tuple(row[:3]) != key:
+        return ''
+    return row[3]
+
+#---------------------------------storedigest----------------------------------#
+def storedigest(file_path, checksum, key=None):
+    """Function that add the md5 checksum of a file to the digest cache.
+
+    args:
+        file_path (string): path of the file
+        checksum (string): md5 checksum of the file
+        key (tuple): return of filekey taken before the file was hashed. The
+                    checksum is not stored if the file has changed since.
+    """
+    if digestDb is None or not checksum:
+        return
+    cur_key = filekey(file_path)
+    if cur_key is None or (key is not None and key != cur_key):
+        return
+    conn = opendigest()
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO digest VALUES (?, ?, ?, ?, ?)',
+                         (os.path.abspath(file_path),) + cur_key + (checksum.lower(),))
+    finally:
+        conn.close()
+
+#---------------------------------prunedigest----------------------------------#
+def prunedigest():
+    """Function that remove from the digest cache the files that have been
+    removed or modified.
+
+    return:
+        number of entries removed
+    """
+    if digestDb is None or not os.path.isfile(digestDb):
+        return 0
+    conn = opendigest()
+    try:
+        stale = [(row[0],) for row in conn.execute('SELECT path, inode, size, mtime_ns FROM digest')
+                 if filekey(row[0]) != tuple(row[1:])]
+        with conn:
+            conn.executemany('DELETE FROM digest WHERE path = ?', stale)
+    finally:
+        conn.close()
+    return len(stale)
+
+#-----------------------------------fadvise------------------------------------#
+# posix_fadvise(2) is not in the os module of python 2
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+try:
+    _fadvise = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).posix_fadvise
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+except (OSError, AttributeError):
+    _fadvise = None
+
+def fadvise(fd, advice, offset=0, length=0):
+    """Function that tell the kernel how a file will be read (ex:
+    POSIX_FADV_SEQUENTIAL doubles the readahead of the file).
+
+    return:
+        True if the advice has been given
+    """
+    if _fadvise is None:
+        return False
+    return _fadvise(fd, offset, length, advice) == 0
+
+#---------------------------------md5 backends---------------------------------#
+# The md5 of a file is computed by the CPU at about 500 MB/s per core, often
+# slower than the disk: the backends avoid the copies of the file into new
+# strings. The files of at least MMAP_MIN_SIZE bytes are mapped in windows of
+# MMAP_WINDOW bytes (mapping the whole file would make the resident memory of
+# the process grow up to the size of the file). The smaller ones are read into
+# a single buffer (see testfile/benchmd5.py).
+MMAP_MIN_SIZE = 2**26
+MMAP_WINDOW = 2**24
+
+def md5readinto(f, blocksize):
+    """Function that compute the md5 of an open file with reads into a buffer
+    allocated once."""
+    m = hashlib.md5()
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        m.update(view[:n])
+    return m.hexdigest()
+
+def md5mmap(f, size):
+    """Function that compute the md5 of an open file of size bytes mapped in
+    memory by windows of MMAP_WINDOW bytes."""
+    m = hashlib.md5()
+    for offset in xrange(0, size, MMAP_WINDOW):
+        window = mmap.mmap(f.fileno(), min(MMAP_WINDOW, size - offset),
+                           access=mmap.ACCESS_READ, offset=offset)
+        try:
+            m.update(window)
+        finally:
+            window.close()
+    return m.hexdigest()
+
 #---------------------------------generate_file_md5----------------------------------#
 # http://stackoverflow.com/questions/1131220/get-md5-hash-of-big-files-in-python
-def generate_file_md5(rootdir, filename, blocksize=2**20):
-    """Function that calculate the checksum md5 of a file.
+def generate_file_md5(rootdir, filename, blocksize=2**20, cache=True):
+    """Function that calculate the checksum md5 of a file. If the file has
+    not changed since it was last hashed, the checksum is read from the digest
+    cache (see cacheddigest). Otherwise the file is mapped in memory (md5mmap)
+    if it has at least MMAP_MIN_SIZE bytes, read by chunks of blocksize bytes
+    (md5readinto) if not.
 
     parameters:
         rootdir (string): directory of the file
         filename (string): name of the file
         blocksize (int): chunk size to read.
+        cache (boolean): False to read the file even if it is in the digest
+                        cache (the cache is still updated).
     return:
         the checksum md5 returned is '' if a problem happened.
     """
-    checksum = ''
-    m = hashlib.md5()
-    #logger.debug('filepath: %s'% os.path.join(rootdir, filename))
+    file_path = os.path.join(rootdir, filename)
+    checksum = cacheddigest(file_path) if cache else ''
+    if checksum:
+        logger.debug('checksum md5 read from the digest cache')
+        return checksum
+    key = filekey(file_path)
+    #logger.debug('filepath: %s'% file_path)
     try:
-        f = open(os.path.join(rootdir, filename), "rb")
+        f = open(file_path, "rb", 0)
     except IOError as e:
         logger.error('errno: %s err message: %s'% (str(e.errno), os.strerror(e.errno)))
     else:
-        logger.debug('file size: %s'% os.path.getsize(os.path.join(rootdir, filename)))
         with f:
-            while True:
-                buf = f.read(blocksize)
-                if not buf:
-                    break
-                m.update(buf)
-            checksum = m.hexdigest() 
+            size = os.fstat(f.fileno()).st_size
+            logger.debug('file size: %s'% size)
+            fadvise(f.fileno(), POSIX_FADV_SEQUENTIAL)
+            if size >= MMAP_MIN_SIZE:
+                try:
+                    checksum = md5mmap(f, size)
+                except (mmap.error, EnvironmentError) as e:
+                    logger.debug('The file could not be mapped in memory: %s'% str(e))
+                    f.seek(0)
+            if not checksum:
+                checksum = md5readinto(f, blocksize)
+        storedigest(file_path, checksum, key)
     return checksum
 
 #---------------------------------extractBandsTiles----------------------------------#
@@ -161,6 +440,95 @@ def extractBandsTiles(tiles, bands):
     l_tiles = tiles.split(",")
     return l_tiles, l_bands
     
+#---------------------------------freespace-----------------------------------#
+def freespace(dir_path):
+    """Function that return the space left on the disk of a directory
+
+    parameters:
+        dir_path (string): path of an existing directory
+    return:
+        number of bytes available to the user, None if it can't be known.
+    """
+    try:
+        stat = os.statvfs(dir_path)
+    except (AttributeError, OSError) as e:
+        logger.debug('Free space of %s unknown: %s'% (dir_path, str(e)))
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+#---------------------------------preallocate----------------------------------#
+# fallocate(2) with FALLOC_FL_KEEP_SIZE allocates the blocks of a file without
+# changing its size, so that the size of a partial download stays the number of
+# bytes actually received (see progressbar.resumeoffset).
+FALLOC_FL_KEEP_SIZE = 1
+try:
+    _fallocate = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+    _fallocate = None
+
+def preallocate(fd, offset, length):
+    """Function that reserve the disk space of a file before writing it
+
+    parameters:
+        fd (int): file descriptor of the file opened for writing
+        offset (int): position of the first byte to reserve
+        length (int): number of bytes to reserve
+    return:
+        True if the space has been reserved, False if the system or the
+        file system does not support it.
+    raise:
+        OSError if the space could not be reserved (ex: errno.ENOSPC)
+    """
+    if _fallocate is None or length <= 0:
+        return False
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+            return False
+        raise OSError(err, os.strerror(err))
+    return True
+
+#----------------------------------linkfile------------------------------------#
+# ioctl(2) request of Linux that makes a file share the blocks of another one
+# (copy on write clone, supported by btrfs, xfs…)
+FICLONE = 0x40049409
+
+def linkfile(src_path, dst_path):
+    """Function that make a file available at another path without copying
+    its content. A hard link is tried first, then a reflink when both paths
+    are not on the same file system or hard links are not allowed. The
+    destination is replaced if it exists.
+
+    parameters:
+        src_path (string): path of the existing file
+        dst_path (string): path where the file must be available
+    return:
+        'hard link', 'reflink' or '' if the file could not be linked
+    """
+    if os.path.exists(dst_path) and os.path.samefile(src_path, dst_path):
+        return 'hard link'
+    tmp_path = dst_path + '.link'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+        method = 'hard link'
+    except OSError as e:
+        logger.debug('hard link of %s failed: %s'% (src_path, str(e)))
+        try:
+            with open(src_path, 'rb') as src:
+                with open(tmp_path, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            method = 'reflink'
+        except (IOError, OSError) as e:
+            logger.debug('reflink of %s failed: %s'% (src_path, str(e)))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return ''
+    os.rename(tmp_path, dst_path)
+    return method
+
 #-----------------------------------Test------------------------------------#
 if __name__ == '__main__':
           
@@ -181,7 +549,8 @@ if __name__ == '__main__':
     # set test
     list_function = ['create_directory', 'findSat', 'readconffile',
                      'buildreq', 'cloudfilter', 'generate_file_md5',
-                     'extractBandsTiles']
+                     'extractBandsTiles', 'freespace', 'linkfile', 'pushdownreq',
+                     'digestcache']
     test_function = [list_function[5]] # insert function(s) from list_function to test
     request = requestS2 # requestS1 or requestS2 
     
@@ -270,7 +639,7 @@ if __name__ == '__main__':
             numb_prod = xml_tools.getnumbprod(xmlpath)
             print 'nombre de produit de la requête: ', numb_prod
             # Get product list
-            prod_list = osodrequest.browseprod(request, sat, numb_prod, maxitem, nbretry, waittime, xmlpath)
+            prod_list = osodrequest.browseprod(request, sat, numb_prod, maxitem, nbretry, waittime)[0]
             # Filter the list
             filtered_prod_list = cloudfilter(prod_list, sat, maxcloudperc)
             same_list = (prod_list == filtered_prod_list)
@@ -310,3 +679,46 @@ if __name__ == '__main__':
         extract = extractBandsTiles(tiles3, bands3)
         print(extract[0])
         print(extract[1])
+
+    if(list_function[7] in test_function):
+        print('#--------------test: %s--------------#'% list_function[7])
+        print('free space: %s bytes'% str(freespace(base_path)))
+        test_file = base_path + '/testfile/preallocate.tmp'
+        with open(test_file, 'wb') as f:
+            print('preallocated: %s'% preallocate(f.fileno(), 0, 2**20))
+        print('size: %s'% os.path.getsize(test_file))
+        os.remove(test_file)
+
+    if(list_function[8] in test_function):
+        print('#--------------test: %s--------------#'% list_function[8])
+        src_file = base_path + '/testfile/linkfile_src.tmp'
+        dst_file = base_path + '/testfile/linkfile_dst.tmp'
+        with open(src_file, 'wb') as f:
+            f.write('sentinel')
+        print(linkfile(src_file, dst_file))
+        print(os.path.samefile(src_file, dst_file))
+        print(linkfile(src_file, dst_file))
+        os.remove(src_file)
+        os.remove(dst_file)
+
+    if(list_function[9] in test_function):
+        print('#--------------test: %s--------------#'% list_function[9])
+        print(pushdownreq(requestS2, 'S2', '20', ['T32TLQ', '31TGJ']))
+        print(pushdownreq(requestS2, 'S2', '', ['']))
+        print(pushdownreq(requestS1, 'S1', '20', ['T32TLQ']))
+
+    if(list_function[10] in test_function):
+        print('#--------------test: %s--------------#'% list_function[10])
+        digestDb = base_path + '/testfile/digest.tmp'
+        test_file = base_path + '/testfile/digest_file.tmp'
+        with open(test_file, 'wb') as f:
+            f.write('sentinel' * 2**17)
+        print(generate_file_md5(os.path.dirname(test_file), os.path.basename(test_file)))
+        print(cacheddigest(test_file)) # same checksum, read from the cache
+        with open(test_file, 'ab') as f:
+            f.write('2')
+        print(repr(cacheddigest(test_file))) # '': the file has changed
+        print(generate_file_md5(os.path.dirname(test_file), os.path.basename(test_file)))
+        os.remove(test_file)
+        print(prunedigest()) # 1
+        os.remove(digestDb)
@@ -1,19 +1,20 @@
 # -*- coding: utf-8 -*-
-"""This module provides functionnalities build around the urllib2 library. More
+"""This module provides functionnalities build around the httplib library. More
 specifically, it deals with with requests around both protocol provided by sci-
 hub: open search (os) and open data (od). The open search query are used to
 retrieve xml file of product list (as in a catalog) while the open data ones
 are used to download products. More information about open search and open data
 protocole can be found on the scihub API documention:
 https://scihub.copernicus.eu/twiki/do/view/SciHubUserGuide/5APIsAndBatchScripting#Open_Search
-This module currently use urllib2. Maybe it could have been better to use the
-easier and higher level request http library:
+The requests are sent through a shared httpsession.Session (built on httplib)
+which keeps the connections to the server alive between the calls. Maybe it
+could have been better to use the easier and higher level request http library:
 http://requests.readthedocs.org/en/master/
 """
 
-import urllib2
 import urllib
 import time
+import threading
 import os
 import sys
 import imp
@@ -25,9 +26,12 @@ sys.path.append(module_path)
 import misc_tools
 import xml_tools
 import progressbar
+import httpsession
+import engine
 imp.reload(misc_tools)
 imp.reload(xml_tools)
 imp.reload(progressbar)
+imp.reload(httpsession)
 
 if __name__ == '__main__':
     logger = logging.getLogger(__name__)
@@ -41,10 +45,23 @@ if __name__ == '__main__':
 else:
     logger = logging.getLogger('sentinel_dl')
 
+# Session shared by all the functions of this module. It is replaced by an
+# authenticated one in authenticate(). Note that reloading this module after
+# the authentication drops the session.
+session = httpsession.Session(timeout=progressbar.readTimeout)
+
+# The search responses are parsed in memory. If dumpDir is set (dump_pages
+# parameter of the config.cfg file), they are also written into this directory
+# to help debugging.
+dumpDir = None
+dumpLock = threading.Lock()
+dumpCount = [0]
+
 #--------------------------------authenticate---------------------------------#
 def authenticate(username, password, url):
-    """Function that install a specific opener for accessing scihub through the
-    API. (https://docs.python.org/2.7/howto/urllib2.html)
+    """Function that create the http session used to access scihub through the
+    API. The session sends the credentials with every request and keeps the
+    connections alive between the requests.
 
     args:
         username (string): username at the scihub webpage
@@ -52,53 +69,63 @@ def authenticate(username, password, url):
         url (string): url of the scihub webpage.
                         'https://scihub.copernicus.eu/dhus'
     """
-    password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-    password_mgr.add_password(None, url, username, password)
-    handler = urllib2.HTTPBasicAuthHandler(password_mgr)
-    opener = urllib2.build_opener(handler)
-    urllib2.install_opener(opener)
+    global session
+    session.close()
+    session = httpsession.Session(username, password, timeout=progressbar.readTimeout)
     passed = False
     
-    # After insalling the opener, we try to send a request to see if it works.
+    # After creating the session, we try to send a request to see if it works.
     # If it didn't for whatever reason, then the function return False.
     # The special case of http 401 error is handled to test if the credentials
     # are valid.
     urlRequest = url + "/search?q=*"
     urlRequestFormat = urllib.quote(urlRequest, ':()[]/?=,&')
     try:
-        handle = urllib2.urlopen(urlRequestFormat)
+        handle = session.urlopen(urlRequestFormat)
     except IOError, e:
-        logger.debug('error %s: %s'% (e.code, e.reason))
-        if e.code == 401:
+        logger.debug('error %s: %s'% (getattr(e, 'code', ''), getattr(e, 'reason', e)))
+        if getattr(e, 'code', None) == 401:
             logger.error('Unauthorized or basic authentication failed. Please check '
                   + 'your username and password or make sure your account is '
                   + 'eligible for using the API.')
         passed = False
     else:
+        handle.read()
         passed = True
     return passed
 
-#-------------------------------getproductlist--------------------------------#
-def getproductlist(urlRequest, nbRetry, waitTime, xmlPath):
-    """Function that send an open search query and retrieve the server response
-    (i.e. xml file)
+#-------------------------------connectionstats-------------------------------#
+def connectionstats():
+    """Function that return the counters of the http session.
+
+    return:
+        dictionary: number of 'requests' sent, number of connections 'opened'
+                    and number of times an open connection has been 'reused'.
+    """
+    return dict(session.stats)
+
+#---------------------------------fetchpage-----------------------------------#
+def fetchpage(urlRequest, nbRetry, waitTime):
+    """Function that send an open search query and return the server response
+    (i.e. xml file) without writing it on the disk.
 
     args:
         urlRequest (string): raw (non formatted) url query.
         nbRetry (int): number of time the client will try to contact the
                         server.
         waitTime (int): time in second to wait between tries
-        xmlPath (string): path where the xml response file will be saved
 
     return:
-        passed: Boolean stating if the query was successful or not
+        the xml response (string) or None if the query failed
     """
     i = 0
-    passed = False
-    urlRequestFormat = urllib.quote(urlRequest, ':()[]/?=,&')
+    page = None
+    # '%' is kept so that an url already formatted by misc_tools.buildreq is
+    # not quoted twice.
+    urlRequestFormat = urllib.quote(urlRequest, ':()[]/?=,&%')
     while True:
         try:
-            handle = urllib2.urlopen(urlRequestFormat)
+            handle = session.urlopen(urlRequestFormat)
         except IOError, e:
             i += 1
             if hasattr(e, 'reason'):
@@ -111,17 +138,81 @@ def getproductlist(urlRequest, nbRetry, waitTime, xmlPath):
             time.sleep(waitTime)
         else:
             page = handle.read()
-            textfile = open(xmlPath, 'w')  
-            textfile.write(page)
-            textfile.close()
-            passed = True
             break
         if i >= nbRetry:
             break
-    return passed
+    return page
+
+#----------------------------------dumppage-----------------------------------#
+def dumppage(page, urlRequest):
+    """Function that write a search response into dumpDir, if set.
+
+    args:
+        page (string): xml response
+        urlRequest (string): url of the query, written in the log
+    """
+    if dumpDir is None:
+        return
+    with dumpLock:
+        dumpCount[0] += 1
+        dump_path = dumpDir + '/page_%05d.xml'% dumpCount[0]
+    misc_tools.create_directory(dumpDir)
+    with open(dump_path, 'w') as f:
+        f.write(page)
+    logger.debug('%s dumped to %s'% (urlRequest, dump_path))
+
+#--------------------------------countproducts--------------------------------#
+def countproducts(urlRequest, nbRetry, waitTime):
+    """Function that retrieve the total number of products of an open search
+    query.
+
+    args:
+        urlRequest (string): raw (non formatted) url query.
+        nbRetry (int): number of time the client will try to contact the
+                        server.
+        waitTime (int): time in second to wait between tries
+
+    return:
+        the number of products (int) or None if the query failed
+    """
+    page = fetchpage(urlRequest, nbRetry, waitTime)
+    if page is None:
+        return None
+    dumppage(page, urlRequest)
+    # An unreadable response (ex: maintenance page) fails the query like an
+    # unreachable server
+    numb_prod = xml_tools.getnumbprodpage(page)
+    if numb_prod is None:
+        logger.error('The number of products could not be read from the response of %s'
+                     % urlRequest)
+    return numb_prod
+
+#-------------------------------getproductlist--------------------------------#
+def getproductlist(urlRequest, nbRetry, waitTime, xmlPath):
+    """Function that send an open search query and retrieve the server response
+    (i.e. xml file)
+
+    args:
+        urlRequest (string): raw (non formatted) url query.
+        nbRetry (int): number of time the client will try to contact the
+                        server.
+        waitTime (int): time in second to wait between tries
+        xmlPath (string): path where the xml response file will be saved
+
+    return:
+        passed: Boolean stating if the query was successful or not
+    """
+    page = fetchpage(urlRequest, nbRetry, waitTime)
+    if page is None:
+        return False
+    textfile = open(xmlPath, 'w')  
+    textfile.write(page)
+    textfile.close()
+    return True
 
 #---------------------------------browseprod----------------------------------#
-def browseprod(urlRequest, sat, numbProd, maxItem, nbRetry, waitTime, xmlPath):
+def browseprod(urlRequest, sat, numbProd, maxItem, nbRetry, waitTime, nbWorkers=1,
+               nbPass=3):
     """Function that browse numbProd products from the begining of the catalog
     for a specified query, read the returned xml file and store the list of
     product in a list.
@@ -135,13 +226,19 @@ def browseprod(urlRequest, sat, numbProd, maxItem, nbRetry, waitTime, xmlPath):
         nbRetry (int): number of time the client will try to contact the
                         server.
         waitTime (int): time in second to wait between tries
-        xmlPath (string): path where the xml response file will be saved
+        nbWorkers (int): maximum number of pages requested at the same time
+                        (see engine).
+        nbPass (int): maximum number of times the pages that changed during
+                        the browsing are requested again.
 
     return:
-        a list of list where each element of the higher level list correpond
-        to one product and each element of the sublist contains different info-
-        rmations about the product (title, uuid, download link (open data link)
-        of the whole archive, cloud percentage if 'S2')
+        product_list: a list of list where each element of the higher level
+        list correpond to one product and each element of the sublist contains
+        different informations about the product (see
+        xml_tools.iterprodlist), sorted by descending ingestion date.
+        complete (boolean): False if some pages could not be retrieved or were
+        still changing after nbPass passes. product_list then only holds the
+        products that have been read.
     """
     
     # Depending on the maxItem parameter, the function will either retrieve all
@@ -149,53 +246,89 @@ def browseprod(urlRequest, sat, numbProd, maxItem, nbRetry, waitTime, xmlPath):
     # product numbProd = 1200 and maxItem = 500, the catalog will be browsed 3
     # times to retrieve all the product. If maxItem = 2000, then, only one pass
     # is necessary. This function browse the entire catalog.
-    product_list = []
-    quotient = numbProd // maxItem
-    reste = numbProd % maxItem
-    if reste == numbProd:
-        logger.debug('Retrieving %s product(s) in one query…'% str(numbProd))
-        current_url = misc_tools.buildreq(urlRequest, reste, 0)
-        result = getproductlist(current_url, nbRetry, waitTime, xmlPath)
-        if result == True:
-            product_list = xml_tools.getprodlist(xmlPath, sat)
-            logger.debug('List of product successfully retrieved.')
-    else:
-        if reste != 0:
-            nb_iter = quotient + 1
-        else:
-            nb_iter = quotient
+    # The pages are independent from each other: they are requested at the same
+    # time (at most nbWorkers), parsed in memory and merged.
+    # The products are sorted by ascending ingestion date so that the products
+    # ingested during the browsing are appended at the end of the catalog
+    # instead of shifting every page. Each page holds the total number of
+    # products at the time it was sent. When the total changes, only the pages
+    # near the end of the catalog they were sent with are requested again: the
+    # pages below old total - (new total - old total) have not moved. The
+    # products are merged by uuid so that the overlapping pages don't produce
+    # duplicates.
+    products = {}
+    totals = {} # (start index, number of rows) of a page retrieved -> total
+                # number of products it was sent with
+    urlOrdered = urlRequest + '&orderby=ingestiondate asc'
+
+    def browsepage(start, rows):
+        current_url = misc_tools.buildreq(urlOrdered, rows, start)
+        page = fetchpage(current_url, nbRetry, waitTime)
+        if page is None:
+            logger.debug('page %s-%s failed'% (str(start), str(start + rows)))
+            return None
+        dumppage(page, current_url)
+        result = xml_tools.readpage(page, sat)
+        if result is None:
+            logger.error('page %s-%s could not be read: %s'% (str(start), str(start + rows),
+                                                              current_url))
+            return None
+        logger.debug('page %s-%s succeed'% (str(start), str(start + rows)))
+        return result
+
+    complete = False
+    for i in range(nbPass + 1):
+        pages = [(start, min(maxItem, numbProd - start))
+                 for start in range(0, numbProd, maxItem)]
+        pages = [page for page in pages if page not in totals] or [(0, 0)]
         logger.debug('Retrieving %s product(s) in %s queries…'% (str(numbProd),
-                                                                 str(nb_iter)))
-        for i in range(0, nb_iter):
-            if (reste != 0) and (i == (nb_iter - 1)):
-                logger.debug('%s\%s. retreiving only the reste (%s) for the last iteration'
-                             % (str(i+1), str(nb_iter), str(reste))) 
-                current_url = misc_tools.buildreq(urlRequest, reste, i*maxItem)
-            else:
-                logger.debug('%s\%s. retreiving %s items'% (str(i+1),
-                                                            str(nb_iter),
-                                                            str(maxItem)))
-                current_url = misc_tools.buildreq(urlRequest, maxItem, i*maxItem)
-            result = getproductlist(current_url, nbRetry, waitTime, xmlPath)
-            if result == True:
-                product_list.extend(xml_tools.getprodlist(xmlPath, sat))
-                logger.debug('iteration %s\%s succeed'% (str(i+1),str(nb_iter)))
-            else:
-                logger.debug('iteration %s\%s failed'% (str(i+1),str(nb_iter)))
-                product_list = [] 
-                break
-    numb_prod_fin = xml_tools.getnumbprod(xmlPath)
-    logger.debug('total number of prouduct before: %s'% (str(numbProd)))
-    logger.debug('total number of prouduct after: %s'% (str(numb_prod_fin)))
-    if numb_prod_fin != numbProd:
-        logger.warning('The number of total products seems to have changed during the operation.')
-        product_list = []
-    else:
-        logger.debug('Browse product ok')
-    return product_list
+                                                                 str(len(pages))))
+        results = engine.runparallel(browsepage, pages, nbWorkers)
+        numb_prod_fin = []
+        for page, result in zip(pages, results):
+            if result is None:
+                continue
+            numb_prod_fin.append(result[0])
+            if page[1] > 0:
+                totals[page] = result[0]
+            for element in result[1]:
+                products[element[1]] = element
+        logger.debug('total number of prouduct before: %s'% (str(numbProd)))
+        logger.debug('total number of prouduct after: %s'% (str(numb_prod_fin)))
+        if not numb_prod_fin and not totals:
+            logger.debug('No page could be retrieved')
+            break
+        failed = len(numb_prod_fin) < len(pages)
+        if not failed and all(total == numbProd for total in numb_prod_fin):
+            complete = True
+            logger.debug('Browse product ok')
+            break
+        if failed:
+            logger.debug('At least one page could not be retrieved')
+        else:
+            logger.info('The number of total products changed during the operation. ' +
+                        'Requesting the pages that changed again…')
+        if i == nbPass:
+            break
+        # The most recent total is asked to the server. If it fails, the
+        # highest total read in the pages is used.
+        numb_prod = countproducts(urlRequest, nbRetry, waitTime)
+        numbProd = numb_prod if numb_prod is not None else max(numb_prod_fin or totals.values())
+        # the pages past the end of the catalog or near the end of the
+        # catalog they were sent with are requested again
+        for (start, rows), total in totals.items():
+            if (start + rows > numbProd or
+                (total != numbProd and start + rows > total - abs(numbProd - total))):
+                del totals[(start, rows)]
+    if not complete:
+        logger.warning('The list of products could not be entirely retrieved: ' +
+                       '%s product(s) read.'% str(len(products)))
+    product_list = sorted(products.values(), key=lambda element: element[5], reverse=True)
+    return product_list, complete
 
 #--------------------------------getimagefile---------------------------------#
-def getimagefile(urlRequest, nbRetry, waitTime, filePath, chunkSize, checksumReal):
+def getimagefile(urlRequest, nbRetry, waitTime, filePath, chunkSize, checksumReal,
+                 reportHook=None, nbSegments=1):
     """Function that download the product specified by urlRequest into the
     disk.
 
@@ -210,21 +343,41 @@ def getimagefile(urlRequest, nbRetry, waitTime, filePath, chunkSize, checksumRea
         filePath (string): path where the file will be saved
         chunkSize (int): bytes to read and write. (a file is written on the disk
                         piece by piece.)
+        reportHook: function called after each chunk (ex:
+                    progressbar.chunk_report). The progress of all the
+                    downloads is shown by progressbar.monitor anyway.
+        nbSegments (int): number of connections used to download the file.
+                        If greater than 1, see getimagefilesegmented.
 
     return:
         passed (boolean): True if the urlopen was successful. False otherwise.
         diskspace (boolean): True if the current file couldn't be wrote because
                             no left space on the hard drive. False otherwise.
+        checksum (string): md5 checksum of the downloaded file computed while
+                        writing it. '' if the file is not complete.
 
     note: if (True, True) is returned, it doesn't neccessarly mean that the
-    download was successful.
+    download was successful. An interrupted download is kept in a '.part' file
+    and resumed at the next call. A file that doesn't fit on the disk is not
+    downloaded and (True, False, '') is returned: the download is deferred and
+    the next products can still be downloaded.
     """
+    if nbSegments > 1:
+        return getimagefilesegmented(urlRequest, nbRetry, waitTime, filePath,
+                                     chunkSize, checksumReal, nbSegments, reportHook)
     i = 0
     passed = False
     fulldisk = False
+    checksum = ''
     while True:
+        # If a previous attempt has been interrupted, only the missing bytes
+        # are requested.
+        headers = {}
+        offset = progressbar.resumeoffset(filePath)
+        if offset:
+            headers['Range'] = 'bytes=%s-'% str(offset)
         try:
-            handle = urllib2.urlopen(urlRequest)
+            handle = session.urlopen(urlRequest, headers, timeout=progressbar.readTimeout)
         except IOError, e:
             i += 1
             if hasattr(e, 'reason'):
@@ -236,12 +389,164 @@ def getimagefile(urlRequest, nbRetry, waitTime, filePath, chunkSize, checksumRea
             logger.info('Waiting %s seconds…'% str(waitTime))
             time.sleep(waitTime)
         else:
-            fulldisk = progressbar.chunk_read3(handle, filePath, checksumReal, chunkSize, report_hook=progressbar.chunk_report)
+            fulldisk, checksum = progressbar.chunk_read3(handle, filePath, checksumReal, chunkSize, report_hook=reportHook)
+            handle.close()
             passed = True
             break
         if i >= nbRetry:
             break        
-    return (passed, fulldisk)
+    return (passed, fulldisk, checksum)
+
+#---------------------------getimagefilesegmented-----------------------------#
+def getimagefilesegmented(urlRequest, nbRetry, waitTime, filePath, chunkSize,
+                          checksumReal, nbSegments, reportHook=None):
+    """Function that download a product with several connections at the same
+    time. The file is split into nbSegments byte ranges that are downloaded
+    concurrently (workers of the engine, see engine) and written at their offset
+    into a file created with its final size. An interrupted segment is resumed
+    from its last written byte, at the next try or at the next call. If the
+    server does not accept byte ranges, if the file is too small to be split or
+    if a single connection download of the file has been interrupted, the
+    function falls back to a single connection download (getimagefile).
+
+    args:
+        urlRequest (string): raw (non formatted) opendata url. Any url that
+                            finishes with '$/value'
+        nbRetry (int): number of time the client will try to contact the
+                        server (for each segment).
+        waitTime (int): time in second to wait between tries
+        filePath (string): path where the file will be saved
+        chunkSize (int): bytes to read and write.
+        checksumReal (string): md5 checksum of the product (return of getmd5)
+        nbSegments (int): number of byte ranges downloaded at the same time.
+        reportHook: function called after each chunk (ex:
+                    progressbar.chunk_report).
+
+    return:
+        same as getimagefile: (passed, fulldisk, checksum). The checksum is
+        computed on the assembled file.
+    """
+    passed = False
+    fulldisk = False
+    checksum = ''
+    if os.path.isfile(filePath):
+        checksum = misc_tools.generate_file_md5(os.path.dirname(filePath),
+                                                os.path.basename(filePath),
+                                                chunkSize)
+        if checksum == checksumReal:
+            logger.info('The file has already been well downloaded.')
+            return (True, False, checksum)
+        logger.info('The file has already been downloaded but is corrupted. ' +
+                    'Redownloading the file…')
+        os.remove(filePath)
+    # An interrupted single connection download is resumed with a single
+    # connection (see progressbar.resumeoffset) rather than started again.
+    if progressbar.resumeoffset(filePath):
+        logger.info('Resuming the interrupted single connection download…')
+        return getimagefile(urlRequest, nbRetry, waitTime, filePath, chunkSize,
+                            checksumReal, reportHook)
+
+    # A request for the first byte tells whether the server accepts byte
+    # ranges and returns the total size of the file in the Content-Range header.
+    total_size = 0
+    try:
+        handle = session.urlopen(urlRequest, {'Range': 'bytes=0-0'},
+                                 timeout=progressbar.readTimeout)
+    except IOError, e:
+        logger.debug('Range request failed: %s'% str(e))
+    else:
+        if handle.getcode() == 206:
+            content_range = handle.info().getheader('Content-Range').strip()
+            total_size = int(content_range.split('/')[-1])
+        handle.read(1)
+        handle.close()
+    if total_size < nbSegments * chunkSize:
+        logger.debug('Segmented download not possible or not worth it. ' +
+                     'Downloading with a single connection.')
+        return getimagefile(urlRequest, nbRetry, waitTime, filePath, chunkSize,
+                            checksumReal, reportHook)
+
+    # The segments of an interrupted segmented download are resumed from
+    # their last written byte (see progressbar.readsegments).
+    part_path = progressbar.partpaths(filePath)[0]
+    segments = progressbar.readsegments(filePath, total_size)
+    if segments is None:
+        progressbar.removepart(filePath)
+        with open(part_path, 'wb') as f:
+            fits = progressbar.reservespace(f, 0, total_size)
+            if fits:
+                f.truncate(total_size)
+        if not fits:
+            progressbar.removepart(filePath)
+            return (True, False, checksum)
+        segment_size = -(-total_size // nbSegments)
+        segments = [[offset, min(segment_size, total_size - offset), 0]
+                    for offset in range(0, total_size, segment_size)]
+        progressbar.writesegments(filePath, total_size, segments)
+        logger.info('Downloading %s bytes in %s segments…'% (str(total_size), str(len(segments))))
+    done = sum(segment[2] for segment in segments)
+    if done:
+        logger.info('Resuming the %s segments from byte %s of %s'% (str(len(segments)),
+                                                                    str(done), str(total_size)))
+    lock = threading.Lock()
+    progress = {'bytes': done}
+    transfer = progressbar.monitor.start(os.path.basename(filePath), total_size, done)
+
+    def report(nb_bytes):
+        with lock:
+            progress['bytes'] += nb_bytes
+            if reportHook:
+                reportHook(progress['bytes'], chunkSize, total_size)
+
+    def download(segment):
+        offset, length = segment[0], segment[1]
+        seg_fulldisk = False
+        i = 0
+        while segment[2] < length:
+            segment_range = 'bytes=%s-%s'% (str(offset + segment[2]), str(offset + length - 1))
+            try:
+                segment_handle = session.urlopen(urlRequest, {'Range': segment_range},
+                                                 timeout=progressbar.readTimeout)
+                if segment_handle.getcode() != 206:
+                    segment_handle.close()
+                    raise IOError('The server ignored the byte range')
+            except IOError, e:
+                logger.warning('Segment %s-%s: %s'% (str(offset), str(offset + length - 1), str(e)))
+            else:
+                seg_fulldisk, nb_bytes = progressbar.segment_read(segment_handle, part_path,
+                                                                  offset + segment[2],
+                                                                  length - segment[2],
+                                                                  chunkSize, report, transfer)
+                segment_handle.close()
+                with lock:
+                    segment[2] += nb_bytes
+                    progressbar.writesegments(filePath, total_size, segments)
+            i += 1
+            if seg_fulldisk or segment[2] == length or i > nbRetry:
+                break
+            logger.info('Waiting %s seconds…'% str(waitTime))
+            time.sleep(waitTime)
+        return seg_fulldisk, segment[2] == length
+
+    # The segments run on the workers of the engine in use (see engine)
+    results = engine.runparallel(download, [(segment,) for segment in segments],
+                                 len(segments))
+    transfer.finish()
+
+    fulldisk = any(result[0] for result in results)
+    passed = True
+    if all(result[1] for result in results):
+        os.rename(part_path, filePath)
+        os.remove(progressbar.partpaths(filePath)[1])
+        checksum = misc_tools.generate_file_md5(os.path.dirname(filePath),
+                                                os.path.basename(filePath),
+                                                chunkSize)
+    elif fulldisk:
+        progressbar.removepart(filePath)
+    else:
+        logger.warning('At least one segment could not be retrieved. The partial ' +
+                       'file is kept to be resumed later.')
+    return (passed, fulldisk, checksum)
 
 #-----------------------------------getmd5------------------------------------#
 def getmd5(urlRequest, nbRetry, waitTime):
@@ -267,7 +572,7 @@ def getmd5(urlRequest, nbRetry, waitTime):
     checksum_url = checksum_url + '/Checksum/Value/$value'
     while True:
         try:
-            handle = urllib2.urlopen(checksum_url)
+            handle = session.urlopen(checksum_url)
         except IOError, e:
             i += 1
             if hasattr(e, 'reason'):
@@ -332,11 +637,29 @@ def filternewproduct(oldProduct, totalProduct):
         oldProduct
     
     """
-    #extract uuid of products previously downloaded (corrupted or not)
-    oldUuid = [elem[1] for elem in oldProduct]
-    #print(oldUuid)
+    #extract uuid of products previously downloaded (corrupted or not). A set
+    #is used so that each product is looked up in constant time.
+    oldUuid = set(elem[1] for elem in oldProduct)
     newProduct = [elem for elem in totalProduct if elem[1] not in oldUuid]
     return newProduct
+
+#-----------------------------filterremovedproduct-----------------------------#
+def filterremovedproduct(oldProduct, totalProduct):
+    """This function retrieve the products of oldProduct that are not in
+    totalProduct anymore, i.e. the products that have been removed from the
+    scihub database (or ingested again under a new uuid) since they were
+    found. totalProduct must be the result of a browse of the entire catalog
+    for the request.
+
+    args:
+        oldProduct (list of list): list of product previously downloaded
+        totalProduct (list of list): list of products currently in the database
+
+    return:
+        The products of oldProduct that are not in totalProduct
+    """
+    totalUuid = set(elem[1] for elem in totalProduct)
+    return [elem for elem in oldProduct if elem[1] not in totalUuid]
  
 #------------------------------------Test-------------------------------------#
 if __name__ == '__main__':
@@ -363,7 +686,7 @@ if __name__ == '__main__':
     # set test
     list_function = ['authenticate', 'getproductlist', 'browseprod',
                      'getimagefile', 'getmd5', 'getmanifest',
-                     'filternewproducts']
+                     'filternewproducts', 'connectionstats']
     test_function = [list_function[6]] # insert function(s) from list_function to test
     request = requestS2 # requestS1 or requestS2
 
@@ -399,10 +722,10 @@ if __name__ == '__main__':
         max_item = 6
         print(sat)
         print(numb_prod)
-        product_list = browseprod(request, sat, numb_prod, max_item, nbretry, waittime, xmlpath)
+        product_list = browseprod(request, sat, numb_prod, max_item, nbretry, waittime, 4)[0]
         print 'product list size: ', len(product_list)
         max_item = 1000
-        product_list2 = browseprod(request, sat, int(numb_prod), max_item, nbretry, waittime, xmlpath)
+        product_list2 = browseprod(request, sat, int(numb_prod), max_item, nbretry, waittime, 4)[0]
         print 'Same_list ?:', product_list == product_list2
         if product_list == product_list2:
             for element in product_list:
@@ -418,6 +741,7 @@ if __name__ == '__main__':
         result = getimagefile(a_product, nbretry, waittime, file_path_test, chunk_size, checksum_prod)
         print 'Succeed handle:', result[0]
         print 'no diskspace left:', result[1]
+        print 'checksum:', result[2]
 
     if(list_function[4] in test_function):
         print('#--------------test: %s--------------#'% list_function[4])
@@ -446,7 +770,7 @@ if __name__ == '__main__':
         max_item = 500
         print(sat)
         print(numb_prod)
-        product_list = browseprod(request, sat, numb_prod, max_item, nbretry, waittime, xmlpath)
+        product_list = browseprod(request, sat, numb_prod, max_item, nbretry, waittime, 4)[0]
         print 'product list size: ', len(product_list)
         print '\nnew prod 1'
         newprod1 = filternewproduct(product_list, product_list)
@@ -462,3 +786,12 @@ if __name__ == '__main__':
                 print('new product found: %s'% str(len(newprod)))
                 for elem in newprod:
                     print(elem)
+
+    if(list_function[7] in test_function):
+        print('#--------------test: %s--------------#'% list_function[7])
+        authenticate(conf_dict['log']['user'], conf_dict['log']['pw'],
+                     conf_dict['log']['auth_url'])
+        for i in range(3):
+            result = getmd5(a_product, nbretry, waittime)
+            print 'succeed:', result[0]
+        print 'connections:', connectionstats()
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 import urllib2
+import httplib
 import sys
 import os
 import errno
+import hashlib
 import logging
 import imp
-import signal
+import socket
+import threading
 import time
 
 # http://stackoverflow.com/questions/2028517/python-urllib2-progress-hook
@@ -19,6 +22,7 @@ module_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(module_path)
 
 import misc_tools
+import throttle
 imp.reload(misc_tools)
 
 if __name__ == '__main__':
@@ -33,31 +37,144 @@ if __name__ == '__main__':
 else:
     logger = logging.getLogger('sentinel_dl')
 
-#--------------------------------timout class---------------------------------#
+readTimeout = 300 # seconds without receiving any byte before giving up the download
+stallWindow = 120 # seconds over which the download speed is measured
+stallRate = 1024  # minimum speed (bytes/s) over stallWindow before giving up
+diskReserve = 0   # bytes that must stay free on the disk after a download
+
+#------------------------------read deadlines---------------------------------#
 # I've noticed that in rare case, the read operation inside chunk_read3 function
-# hangs forever, thus freezing the whole script
-# A workaround has been found on the following link:
-# http://stackoverflow.com/questions/8464391/what-should-i-do-if-socket-setdefaulttimeout-is-not-working
-# I'm currently using the alarm workaround which only work under unix systems.
-# I need to implement the cross plateform solution but it looks complicated
-# so i'll do it later
+# hangs forever, thus freezing the whole script.
+# The reads used to be wrapped into an ALARM signal, which only works on the
+# main thread and re-arms a process wide signal for each chunk. The reads are
+# now bounded by two deadlines that work from any thread:
+# - the socket timeout (readTimeout) given to the http session, which stops a
+#   connection that doesn't receive anything anymore,
+# - a stall detector, checked by a watchdog thread, that measures the speed of
+#   each transfer over stallWindow seconds and aborts the ones that are slower
+#   than stallRate (a connection that receives a few bytes from time to time
+#   never hits the socket timeout).
+
+def settimeouts(read_timeout, stall_window, stall_rate):
+    """Function that set the deadlines of the downloads. It must be called
+    before the http session is created (osodrequest.authenticate).
+
+    args:
+        read_timeout (int): seconds without receiving any byte
+        stall_window (int): seconds over which the download speed is measured
+        stall_rate (int): minimum download speed in bytes/s
+    """
+    global readTimeout, stallWindow, stallRate
+    readTimeout = read_timeout
+    stallWindow = stall_window
+    stallRate = stall_rate
+
+class StallDetector(object):
+    """Measure the number of bytes received by a transfer over a sliding
+    window and abort the transfer if the speed is too low.
+
+    args:
+        response: url handler of the transfer. Its abort() method, if any, is
+                called when the transfer is stalled.
+        window (int): seconds over which the speed is measured
+        rate (int): minimum speed in bytes/s
+        transfer (Transfer): progress of the transfer (see ProgressMonitor)
+    """
+
+    def __init__(self, response, window, rate, transfer=None):
+        self.response = response
+        self.transfer = transfer
+        self.window = window
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.paused = 0
+        self.checkpoint = (time.time(), 0, 0)
+        self.stalled = False
+
+    def update(self, nb_bytes):
+        with self.lock:
+            self.bytes += nb_bytes
 
-class Timeout():
-  """Timeout class using ALARM signal"""
-  class Timeout(Exception): pass
+    def pause(self, seconds):
+        """Count the time spent waiting for the bandwidth limiter, which is not
+        taken into account in the speed."""
+        with self.lock:
+            self.paused += seconds
 
-  def __init__(self, sec):
-    self.sec = sec
+    def check(self, now):
+        with self.lock:
+            start, start_bytes, start_paused = self.checkpoint
+            if now - start < self.window:
+                return
+            active = max(now - start - (self.paused - start_paused), 1e-3)
+            speed = (self.bytes - start_bytes) / active
+            self.checkpoint = (now, self.bytes, self.paused)
+            if speed >= self.rate or self.stalled:
+                return
+            self.stalled = True
+        logger.error('Transfer stalled (%0.1f bytes/s during the last %s s). Aborting it.'
+                     % (speed, str(self.window)))
+        abort = getattr(self.response, 'abort', None)
+        if abort:
+            abort()
 
-  def __enter__(self):
-    signal.signal(signal.SIGALRM, self.raise_timeout)
-    signal.alarm(self.sec)
+class Watchdog(object):
+    """Thread that periodically checks the stall detectors of the running
+    transfers."""
 
-  def __exit__(self, *args):
-    signal.alarm(0) # disable alarm
+    def __init__(self, period=1):
+        self.period = period
+        self.lock = threading.Lock()
+        self.detectors = set()
+        self.thread = None
 
-  def raise_timeout(self, *args):
-    raise Timeout.Timeout()
+    def watch(self, response, transfer=None):
+        """Return a new stall detector for response and start checking it."""
+        detector = StallDetector(response, stallWindow, stallRate, transfer)
+        with self.lock:
+            self.detectors.add(detector)
+            start = self.thread is None
+            if start:
+                self.thread = threading.Thread(target=self.run, name='watchdog')
+                self.thread.daemon = True
+        # The thread is started once the lock is released: its run method
+        # takes the lock.
+        if start:
+            self.thread.start()
+        # The session responses count the bytes as they arrive on the socket
+        if hasattr(response, 'progress'):
+            response.progress = lambda nb_bytes: received(detector, nb_bytes)
+        return detector
+
+    def unwatch(self, detector):
+        with self.lock:
+            self.detectors.discard(detector)
+        if hasattr(detector.response, 'progress'):
+            detector.response.progress = None
+
+    def run(self):
+        while True:
+            time.sleep(self.period)
+            with self.lock:
+                detectors = list(self.detectors)
+            now = time.time()
+            for detector in detectors:
+                detector.check(now)
+
+watchdog = Watchdog()
+
+def received(detector, nb_bytes):
+    """Function called for each block of bytes received by a transfer. The
+    bytes are counted by the stall detector and the progress monitor of the
+    transfer and taken from the bandwidth limiter shared by all the transfers
+    (see throttle), which may pause the transfer."""
+    detector.update(nb_bytes)
+    if detector.transfer is not None:
+        detector.transfer.update(nb_bytes)
+    waited = throttle.bucket.consume(nb_bytes)
+    if waited:
+        detector.pause(waited)
 
 #--------------------------------chunk_report---------------------------------#
 def chunk_report(bytes_so_far, chunk_size, total_size):
@@ -77,63 +194,449 @@ def chunk_report(bytes_so_far, chunk_size, total_size):
     if bytes_so_far >= total_size:
         sys.stdout.write('\n')
 
+#-------------------------------ProgressMonitor--------------------------------#
+# chunk_report writes to the standard output for every chunk of every download,
+# even when the script runs from cron. The downloads are now all registered to
+# a single monitor that counts the bytes of the running transfers and measures
+# their speed. A status line is drawn at most every 'interval' seconds and only
+# if the standard output is a terminal:
+# ex: 45.2% 1.2 GB of 2.7 GB 12.3 MB/s ETA 0:02:05 (3 transfers)
+# The figures are also available with ProgressMonitor.stats().
+def humansize(nb_bytes):
+    """Function that format a number of bytes. ex: 1.2 GB"""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(nb_bytes) < 1024.0:
+            return '%0.1f %s'% (nb_bytes, unit)
+        nb_bytes /= 1024.0
+    return '%0.1f TB'% nb_bytes
+
+def humantime(seconds):
+    """Function that format a duration. ex: 0:02:05"""
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(seconds)
+    return '%d:%02d:%02d'% (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class Transfer(object):
+    """Progress of a single download registered to a ProgressMonitor.
+
+    args:
+        monitor (ProgressMonitor): monitor of the transfer
+        name (string): name displayed for the transfer
+        total (int): size of the file in bytes
+        done (int): bytes already on the disk (resumed download)
+    """
+
+    def __init__(self, monitor, name, total, done):
+        self.monitor = monitor
+        self.name = name
+        self.total = total
+        self.done = done
+        self.start = time.time()
+        self.rate = 0.0
+        self.sample = (self.start, done)
+
+    def update(self, nb_bytes):
+        self.monitor.update(self, nb_bytes)
+
+    def finish(self):
+        self.monitor.finish(self)
+
+    def remaining(self):
+        return max(self.total - self.done, 0)
+
+class ProgressMonitor(object):
+    """Progress of all the transfers of the run.
+
+    args:
+        interval (float): minimum time in second between two status lines
+        stream (file): where the status line is drawn
+    """
+
+    smoothing = 0.3 # weight of the last measure in the speeds
+
+    def __init__(self, interval=0.25, stream=sys.stdout):
+        self.interval = interval
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.transfers = []
+        self.runTotal = 0 # bytes of all the transfers started during the run
+        self.runDone = 0
+        self.rate = 0.0
+        self.sample = (time.time(), 0)
+        self.last = 0
+        self.drawn = False
+
+    def start(self, name, total, done=0):
+        """Register a new transfer and return it."""
+        transfer = Transfer(self, name, total, done)
+        with self.lock:
+            self.transfers.append(transfer)
+            self.runTotal += total
+            self.runDone += done
+        return transfer
+
+    def update(self, transfer, nb_bytes):
+        with self.lock:
+            transfer.done += nb_bytes
+            self.runDone += nb_bytes
+            now = time.time()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+            self.measure(now)
+            if not self.isatty():
+                return
+            line = self.line()
+            self.drawn = True
+        self.stream.write('\r' + line.ljust(79)[:79])
+        self.stream.flush()
+
+    def finish(self, transfer):
+        """Unregister a transfer. The bytes of an incomplete transfer are not
+        expected anymore."""
+        with self.lock:
+            if transfer in self.transfers:
+                self.transfers.remove(transfer)
+            self.runTotal -= transfer.remaining()
+            elapsed = max(time.time() - transfer.start, 1e-3)
+            end_line = self.drawn and not self.transfers
+            if end_line:
+                self.drawn = False
+        logger.debug('%s: %s of %s in %s (%s/s)'
+                     % (transfer.name, humansize(transfer.done), humansize(transfer.total),
+                        humantime(elapsed), humansize(transfer.done / elapsed)))
+        if end_line:
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def measure(self, now):
+        """Update the speed of the transfers and of the whole run."""
+        def smooth(rate, sample, done):
+            if now - sample[0] <= 0:
+                return rate
+            instant = (done - sample[1]) / (now - sample[0])
+            if rate == 0:
+                return instant
+            return self.smoothing * instant + (1 - self.smoothing) * rate
+        for transfer in self.transfers:
+            transfer.rate = smooth(transfer.rate, transfer.sample, transfer.done)
+            transfer.sample = (now, transfer.done)
+        self.rate = smooth(self.rate, self.sample, self.runDone)
+        self.sample = (now, self.runDone)
+
+    def isatty(self):
+        try:
+            return self.stream.isatty()
+        except (AttributeError, ValueError):
+            return False
+
+    def line(self):
+        remaining = max(self.runTotal - self.runDone, 0)
+        percent = 100.0 * self.runDone / self.runTotal if self.runTotal else 100.0
+        eta = remaining / self.rate if self.rate > 0 else None
+        return ('%0.1f%% %s of %s %s/s ETA %s (%s transfers)'
+                % (percent, humansize(self.runDone), humansize(self.runTotal),
+                   humansize(self.rate), humantime(eta), str(len(self.transfers))))
+
+    def stats(self):
+        """Return the progress of the run.
+
+        return:
+            dictionary with the keys 'rate' (bytes/s), 'remaining' (bytes),
+            'eta' (second, None if unknown) and 'transfers', the list of the
+            running transfers as dictionaries with the keys 'name', 'done',
+            'total', 'rate', 'remaining' and 'eta'.
+        """
+        with self.lock:
+            self.measure(time.time())
+            remaining = max(self.runTotal - self.runDone, 0)
+            transfers = []
+            for transfer in self.transfers:
+                transfers.append({'name': transfer.name, 'done': transfer.done,
+                                  'total': transfer.total, 'rate': transfer.rate,
+                                  'remaining': transfer.remaining(),
+                                  'eta': transfer.remaining() / transfer.rate if transfer.rate > 0 else None})
+            return {'rate': self.rate, 'remaining': remaining,
+                    'eta': remaining / self.rate if self.rate > 0 else None,
+                    'transfers': transfers}
+
+monitor = ProgressMonitor()
+
+#---------------------------------readchunk-----------------------------------#
+def readchunk(response, view):
+    """Function that read the next bytes of a response into a buffer that is
+    allocated once per download. The responses of the http session (see
+    httpsession) are read straight from the socket into the buffer. The other
+    url handlers (urllib2) don't have a readinto method and are read with
+    read(), which creates a new string at each call.
+
+    args:
+        response (??): url handler (returned by urlopen())
+        view (memoryview): buffer to fill
+
+    return:
+        the number of bytes read, 0 at the end of the response.
+    """
+    if hasattr(response, 'readinto'):
+        return response.readinto(view)
+    chunk = response.read(len(view))
+    view[:len(chunk)] = chunk
+    return len(chunk)
+
+#-------------------------------resume helpers---------------------------------#
+# A file is first written to a '.part' file next to its destination. A sidecar
+# '.part.info' file stores the total size of the file (Content-Length of the
+# full download). When a download is interrupted, the '.part' file is kept so
+# that the next attempt only asks the server for the missing bytes with a
+# 'Range:' header. The '.part' file is renamed to the destination path once all
+# the bytes have been received.
+# A segmented download (see osodrequest.getimagefilesegmented) writes its
+# segments at their offset in a '.part' file created with its final size. Its
+# sidecar also stores the offset, the length and the number of bytes written of
+# each segment, one segment per line, so that each segment is resumed from its
+# last written byte.
+def partpaths(destination_path):
+    """Function that return the paths of the partial file and of its sidecar.
+
+    args:
+        destination_path (string): path of the complete file
+
+    return:
+        (part_path, info_path)
+    """
+    return destination_path + '.part', destination_path + '.part.info'
+
+def resumeoffset(destination_path):
+    """Function that return the number of bytes of a previous partial download
+    that can be reused.
+
+    args:
+        destination_path (string): path of the complete file
+
+    return:
+        the size of the '.part' file or 0 if there is nothing to resume.
+    """
+    part_path, info_path = partpaths(destination_path)
+    if os.path.isfile(destination_path):
+        return 0
+    try:
+        with open(info_path, 'r') as f:
+            total_size = int(f.read().strip())
+        offset = os.path.getsize(part_path)
+    except (IOError, OSError, ValueError):
+        return 0
+    if 0 < offset < total_size:
+        return offset
+    return 0
+
+def readsegments(destination_path, total_size):
+    """Function that return the segments of a previous segmented download
+    that can be reused.
+
+    args:
+        destination_path (string): path of the complete file
+        total_size (int): size of the complete file
+
+    return:
+        list of [offset, length, written] or None if there is nothing to
+        resume.
+    """
+    part_path, info_path = partpaths(destination_path)
+    try:
+        with open(info_path, 'r') as f:
+            lines = f.read().split('\n')
+        segments = [[int(value) for value in line.split()] for line in lines[1:] if line.strip()]
+        if int(lines[0]) != total_size or os.path.getsize(part_path) != total_size:
+            return None
+    except (IOError, OSError, ValueError):
+        return None
+    if not segments or any(len(segment) != 3 for segment in segments):
+        return None
+    return segments
+
+def writesegments(destination_path, total_size, segments):
+    """Function that save the progress of the segments of a segmented download
+    in the sidecar of its '.part' file (see readsegments)."""
+    info_path = partpaths(destination_path)[1]
+    with open(info_path + '.tmp', 'w') as f:
+        f.write(str(total_size) + '\n')
+        for segment in segments:
+            f.write('%s %s %s\n'% tuple(str(value) for value in segment))
+    os.rename(info_path + '.tmp', info_path)
+
+def removepart(destination_path):
+    """Function that remove the partial file of a download and its sidecar."""
+    for path in partpaths(destination_path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+#-------------------------------disk admission--------------------------------#
+# The space needed by a download is known from its Content-Length before the
+# first byte is written. A download is only started if it fits on the disk
+# (minus diskReserve) and its space is then reserved, so that the downloads
+# running at the same time can't take it. A download that doesn't fit is
+# deferred to the next run and the smaller ones can still go ahead, instead of
+# finding out the disk is full in the middle of a write.
+diskLock = threading.Lock()
+
+def setdiskreserve(disk_reserve):
+    """Function that set the number of bytes that must stay free on the disk."""
+    global diskReserve
+    diskReserve = disk_reserve
+
+def reservespace(f, offset, length):
+    """Function that check that length bytes fit on the disk and reserve them
+    for the file f.
+
+    args:
+        f (file): file opened for writing
+        offset (int): position of the first byte that will be written
+        length (int): number of bytes that will be written
+
+    return:
+        True if the file fits on the disk, False otherwise
+    """
+    with diskLock:
+        free = misc_tools.freespace(os.path.dirname(os.path.abspath(f.name)))
+        if free is not None and free - diskReserve < length:
+            logger.warning('Not enough space left on the disk for %s bytes '% str(length) +
+                           '(%s bytes free, %s bytes reserved). Download deferred.'
+                           % (str(free), str(diskReserve)))
+            return False
+        try:
+            misc_tools.preallocate(f.fileno(), offset, length)
+        except OSError as e:
+            logger.warning('The disk space could not be reserved: %s. Download deferred.'% str(e))
+            return False
+    return True
+
 #---------------------------------chunk_read3----------------------------------#
 def chunk_read3(response, destination_path, checksumReal, chunk_size=8192, report_hook=None):
     """Function that read a file from an uri and write it to the hard drive.
     
     args:
-        response (??): url handler (returned by urlopen())
+        response (??): url handler (returned by urlopen()). If the request was
+                    sent with a 'Range:' header (see resumeoffset), the bytes
+                    are appended to the '.part' file of destination_path.
         destination_path (string): path to write the file
         chunk_size (int): number of bytes to read and write at each iteration
-        report_hook: Pass a function name. If None, the progress status will not
-                    be shown.
+        report_hook: Pass a function name (ex: chunk_report) called after each
+                    chunk. The progress of all the downloads is shown by the
+                    monitor anyway (see ProgressMonitor).
 
     return:
-        True if the there is no spaceleft of the disk. False otherwise.
+        fulldisk (boolean): True if the there is no spaceleft of the disk. False
+                            otherwise.
+        checksum (string): md5 checksum of the file, computed on the fly while
+                        the file is written. '' if the file is not complete or
+                        if it has been deferred because it doesn't fit on the
+                        disk (see reservespace).
     """
     # If there is no spaceleft on the disk, the file which is currently being
     # written is removed from the disk.
-    total_size = response.info().getheader('Content-Length').strip()
-    total_size = int(total_size)
+    part_path, info_path = partpaths(destination_path)
     fulldisk = False
+    checksum = ''
     filesize = 0
-    readTimeout = 300
 
     # The function readresponse is just a wrapper fonction that has been created
     # to avoid repetition and is placed inside the chunk_read3 function because it
     # is only used here. 
-    def readresponse(destination_path2, chunk_size2, total_size2, report_hook2):
-        bytes_so_far = 0
+    def readresponse(destination_path2, chunk_size2, report_hook2):
         fulldisk2 = False
-        with open(destination_path2, 'wb') as f:
+        checksum2 = ''
+        offset = 0
+        m = hashlib.md5()
+        # The same buffer is used for all the reads, writes and checksum
+        # updates of the download: no new string is created for each chunk.
+        buf = bytearray(chunk_size2)
+        view = memoryview(buf)
+        if response.getcode() == 206:
+            # Content-Range: bytes <first>-<last>/<total>
+            content_range = response.info().getheader('Content-Range').strip()
+            offset = int(content_range.split(' ')[-1].split('-')[0])
+            total_size2 = int(content_range.split('/')[-1])
+            if offset != resumeoffset(destination_path2):
+                logger.warning('The partial download does not match the server ' +
+                               'response. It will be restarted.')
+                removepart(destination_path2)
+                return fulldisk2, checksum2
+            logger.info('Resuming the download from byte %s of %s'% (str(offset), str(total_size2)))
+            # The bytes already on the disk are the only ones that need to be
+            # read back to compute the checksum of the whole file.
+            with open(part_path, 'rb') as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    m.update(view[:n])
+            mode = 'ab'
+        else:
+            total_size2 = int(response.info().getheader('Content-Length').strip())
+            with open(info_path, 'w') as f:
+                f.write(str(total_size2))
+            mode = 'wb'
+        bytes_so_far = offset
+        with open(part_path, mode) as f:
+            deferred = not reservespace(f, offset, total_size2 - offset)
+        if deferred:
+            # The bytes of an interrupted download are kept to be resumed
+            if offset == 0:
+                removepart(destination_path2)
+            return fulldisk2, checksum2
+        transfer = monitor.start(os.path.basename(destination_path2), total_size2, offset)
+        detector = watchdog.watch(response, transfer)
+        with open(part_path, 'ab') as f:
             while True:
                 try:
-                    with Timeout(readTimeout):
-                        chunk = response.read(chunk_size2)
-                except Timeout.Timeout:
-                    logger.error('Alarm, Read timeout(%s)'% str(readTimeout))
-                    chunk = 0
-                if not chunk:
+                    n = readchunk(response, view)
+                except socket.timeout:
+                    logger.error('Read timeout(%s)'% str(readTimeout))
+                    n = 0
+                except (socket.error, httplib.HTTPException) as e:
+                    logger.error('Read error: %s'% str(e))
+                    n = 0
+                if not n:
                     break
-                bytes_so_far += len(chunk) 
+                chunk = view[:n]
+                if not hasattr(response, 'progress'):
+                    received(detector, n)
+                bytes_so_far += n
+                m.update(chunk)
                 try:
                     f.write(chunk)
                 except IOError as e:
-                    print 'errno:', e.errno
-                    print 'err message:', os.strerror(e.errno)
+                    logger.error('errno: %s err message: %s'% (str(e.errno), os.strerror(e.errno)))
                     if e.errno == errno.ENOSPC:
-                        os.remove(destination_path2)
                         fulldisk2 = True
                     break
                 if report_hook2:
                     report_hook2(bytes_so_far, chunk_size2, total_size2)
-        return fulldisk2
+        watchdog.unwatch(detector)
+        transfer.finish()
+        if fulldisk2:
+            removepart(destination_path2)
+        elif bytes_so_far == total_size2:
+            os.rename(part_path, destination_path2)
+            os.remove(info_path)
+            checksum2 = m.hexdigest()
+            # The checksum computed on the fly is kept so that the file is
+            # not read again by generate_file_md5
+            misc_tools.storedigest(destination_path2, checksum2)
+        else:
+            logger.warning('Download interrupted after %s of %s bytes. The partial ' 
+                           % (str(bytes_so_far), str(total_size2)) +
+                           'file is kept to be resumed later.')
+        return fulldisk2, checksum2
     
     try:
        filesize = os.path.getsize(destination_path) 
     except OSError as e:
         logger.debug('errno: %s err message: %s'% (str(e.errno), os.strerror(e.errno)))
-        fulldisk = readresponse(destination_path, chunk_size, total_size, report_hook)
+        fulldisk, checksum = readresponse(destination_path, chunk_size, report_hook)
     else:
         logger.debug('Generating checksum md5…')
         md5generated = misc_tools.generate_file_md5(os.path.dirname(destination_path),
@@ -142,11 +645,71 @@ def chunk_read3(response, destination_path, checksumReal, chunk_size=8192, repor
         logger.debug('checksum real: %s'% md5generated)
         if checksumReal == md5generated:
             logger.info('The file has already been well downloaded.')
+            checksum = md5generated
         else:
             logger.info('The file has already been downloaded but is corrupted or incomplete. ' +
                         'Redownloading the file…')
-            fulldisk = readresponse(destination_path, chunk_size, total_size, report_hook) 
-    return fulldisk
+            os.remove(destination_path)
+            fulldisk, checksum = readresponse(destination_path, chunk_size, report_hook) 
+    return fulldisk, checksum
+
+#--------------------------------segment_read----------------------------------#
+def segment_read(response, destination_path, offset, length, chunk_size=8192, report_hook=None,
+                 transfer=None):
+    """Function that read a byte range of a file from an uri and write it at its
+    offset inside a file that has already been created with its final size.
+    Several segments of the same file can be read at the same time by
+    different threads.
+
+    args:
+        response (??): url handler (returned by urlopen()) of a request sent
+                    with a 'Range: bytes=<offset>-<offset+length-1>' header.
+        destination_path (string): path of the preallocated file
+        offset (int): position of the first byte of the segment in the file
+        length (int): number of bytes of the segment
+        chunk_size (int): number of bytes to read and write at each iteration
+        report_hook: function called with the number of bytes written at each
+                    iteration. If None, the progress status will not be shown.
+        transfer (Transfer): progress of the whole file, shared by its
+                    segments (see ProgressMonitor)
+
+    return:
+        fulldisk (boolean): True if the there is no spaceleft of the disk.
+        bytes_so_far (int): number of bytes of the segment that have been
+                        written. The segment is complete if it equals length.
+    """
+    fulldisk = False
+    bytes_so_far = 0
+    view = memoryview(bytearray(min(chunk_size, length)))
+    detector = watchdog.watch(response, transfer)
+    with open(destination_path, 'r+b') as f:
+        f.seek(offset)
+        while bytes_so_far < length:
+            try:
+                n = readchunk(response, view[:min(len(view), length - bytes_so_far)])
+            except socket.timeout:
+                logger.error('Read timeout(%s)'% str(readTimeout))
+                n = 0
+            except (socket.error, httplib.HTTPException) as e:
+                logger.error('Read error: %s'% str(e))
+                n = 0
+            if not n:
+                break
+            chunk = view[:n]
+            if not hasattr(response, 'progress'):
+                received(detector, n)
+            try:
+                f.write(chunk)
+            except IOError as e:
+                logger.error('errno: %s err message: %s'% (str(e.errno), os.strerror(e.errno)))
+                if e.errno == errno.ENOSPC:
+                    fulldisk = True
+                break
+            bytes_so_far += n
+            if report_hook:
+                report_hook(n)
+    watchdog.unwatch(detector)
+    return fulldisk, bytes_so_far
 
 #------------------------------------test-------------------------------------#
 if __name__ == '__main__':
@@ -173,4 +736,5 @@ if __name__ == '__main__':
             print 'Code d\' erreur : ', e.code
     else:
         result = chunk_read3(handle, destination_path, checksumReal2, 2**23, report_hook=chunk_report)
-        print 'no spaceleft: ', result
+        print 'no spaceleft: ', result[0]
+        print 'checksum: ', result[1]
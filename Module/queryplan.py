@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""This module contains the planner of the searches of the requete.csv file.
+Rows of the same satellite whose queries only differ by their footprint
+(footprint:"Intersects(POLYGON((...)))"), cloud cover percentage or tiles
+are coalesced into a single search over the bounding box of their footprints.
+The products of the shared search are then filtered for each row with its own
+footprint (footprintfilter), tiles (tilefilter) and cloud cover percentage
+(misc_tools.cloudfilter).
+Only the rows whose footprints have overlapping bounding boxes are coalesced,
+so that distant areas don't make the shared search return much more products
+than the searches of the rows would.
+"""
+
+import os
+import re
+import sys
+import imp
+import logging
+
+module_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(module_path)
+
+import misc_tools
+imp.reload(misc_tools)
+
+if __name__ == '__main__':
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s ' +
+                              '- %(levelname)s - %(message)s')
+    steam_handler = logging.StreamHandler()
+    steam_handler.setFormatter(formatter)
+    steam_handler.setLevel(logging.DEBUG)
+    logger.addHandler(steam_handler)
+else:
+    logger = logging.getLogger('sentinel_dl')
+
+FOOTPRINT = re.compile(r'footprint:"Intersects\((POLYGON\s*\(\([^()]*\)\))\)"', re.IGNORECASE)
+TILE = re.compile('^T?[0-9]{2}[A-Z]{3}$')
+
+#---------------------------------readpolygons--------------------------------#
+def readpolygons(wkt):
+    """Function that read the rings of a WKT footprint (POLYGON or
+    MULTIPOLYGON).
+
+    args:
+        wkt (string): ex 'POLYGON ((6.55 44.31, 6.55 44.47, 6.86 44.47, 6.55 44.31))'
+
+    return:
+        list of rings, each ring being a list of (x, y)
+    """
+    polygons = []
+    for ring in re.findall(r'\(([^()]+)\)', wkt):
+        points = []
+        for point in ring.split(','):
+            coords = point.split()
+            points.append((float(coords[0]), float(coords[1])))
+        polygons.append(points)
+    return polygons
+
+#-------------------------------polygon helpers-------------------------------#
+def bbox(points):
+    """Return (min x, min y, max x, max y) of a list of (x, y)."""
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def bboxintersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def orientation(p, q, r):
+    value = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
+    if value == 0:
+        return 0
+    return 1 if value > 0 else 2
+
+def onsegment(p, q, r):
+    """True if q, collinear with p and r, lies on the segment [p, r]."""
+    return (min(p[0], r[0]) <= q[0] <= max(p[0], r[0]) and
+            min(p[1], r[1]) <= q[1] <= max(p[1], r[1]))
+
+def segmentsintersect(p1, q1, p2, q2):
+    o1 = orientation(p1, q1, p2)
+    o2 = orientation(p1, q1, q2)
+    o3 = orientation(p2, q2, p1)
+    o4 = orientation(p2, q2, q1)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and onsegment(p1, p2, q1)) or (o2 == 0 and onsegment(p1, q2, q1)) or
+            (o3 == 0 and onsegment(p2, p1, q2)) or (o4 == 0 and onsegment(p2, q1, q2)))
+
+def pointinpolygon(point, polygon):
+    """Ray casting test of a point inside a ring."""
+    x, y = point
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        xi, yi = polygon[i]
+        xj, yj = polygon[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+#---------------------------------intersects----------------------------------#
+def intersects(polygon1, polygon2):
+    """Function that tell whether two rings intersect (an edge crosses the
+    other ring or one ring is inside the other one).
+
+    args:
+        polygon1, polygon2 (list of (x, y)): rings (see readpolygons)
+
+    return:
+        boolean
+    """
+    if not bboxintersects(bbox(polygon1), bbox(polygon2)):
+        return False
+    for i in range(len(polygon1) - 1):
+        for j in range(len(polygon2) - 1):
+            if segmentsintersect(polygon1[i], polygon1[i + 1], polygon2[j], polygon2[j + 1]):
+                return True
+    return pointinpolygon(polygon1[0], polygon2) or pointinpolygon(polygon2[0], polygon1)
+
+#-------------------------------footprintfilter-------------------------------#
+def footprintfilter(prodList, polygon):
+    """Function that keep the products whose footprint intersects a polygon.
+
+    args:
+        prodList (list): list of products (see xml_tools.iterprodlist)
+        polygon (list of (x, y)): footprint of the row
+
+    return:
+        filtered list. The products without footprint are kept.
+    """
+    prod_list_filter = []
+    for element in prodList:
+        footprint = element[6] if len(element) > 6 else ''
+        if not footprint or any(intersects(polygon, ring) for ring in readpolygons(footprint)):
+            prod_list_filter.append(element)
+    return prod_list_filter
+
+#----------------------------------tilefilter---------------------------------#
+def tilefilter(prodList, tiles):
+    """Function that keep the products whose name contains one of the tiles.
+    The products named after the former convention (S2A_OPER_PRD_...) don't
+    contain their tiles and are kept (see misc_tools.pushdownreq).
+
+    args:
+        prodList (list): list of products
+        tiles (list of string): return of misc_tools.extractBandsTiles
+
+    return:
+        filtered list (prodList if tiles is empty or not made of tile names)
+    """
+    tiles = [tile.upper() for tile in tiles if tile != '']
+    if not tiles or not all(TILE.match(tile) for tile in tiles):
+        return prodList
+    names = ['_T%s_'% tile[-5:] for tile in tiles]
+    return [element for element in prodList
+            if '_OPER_' in element[0] or any(name in element[0] for name in names)]
+
+#-----------------------------------planrows----------------------------------#
+def planrows(rows, sat_dict):
+    """Function that coalesce the compatible rows of the requete.csv file.
+
+    args:
+        rows (list of list): rows of the requete.csv file (without the header)
+        sat_dict (dictionary): see main.py
+
+    return:
+        list with for each row a dictionary (None if the row is not valid):
+            'query': query of the search shared by the rows of the group
+            'cloud': highest cloud cover percentage of the group ('' if a row
+                     of the group has none)
+            'tiles': tiles of all the rows of the group ([] if a row of the
+                     group keeps every tile)
+            'polygon': footprint of the row (None if not found)
+            'shared': number of rows of the group
+    """
+    groups = []
+    plans = []
+    for row in rows:
+        sat = misc_tools.findSat(row[1], sat_dict)
+        if sat == '':
+            plans.append(None)
+            continue
+        match = FOOTPRINT.search(row[1])
+        polygon = readpolygons(match.group(1))[0] if match else None
+        rest = FOOTPRINT.sub('{footprint}', row[1]) if match else row[1]
+        group = None
+        for candidate in groups:
+            if (polygon is not None and candidate['polygon'] is not None and
+                candidate['sat'] == sat and candidate['rest'] == rest and
+                bboxintersects(candidate['bbox'], bbox(polygon))):
+                group = candidate
+                break
+        if group is None:
+            group = {'sat': sat, 'rest': rest, 'polygon': polygon, 'rows': [],
+                     'bbox': bbox(polygon) if polygon is not None else None}
+            groups.append(group)
+        elif polygon is not None:
+            a, b = group['bbox'], bbox(polygon)
+            group['bbox'] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+        group['rows'].append(row)
+        plan = {'polygon': polygon, 'group': group}
+        plans.append(plan)
+
+    for group in groups:
+        clouds = [row[2] for row in group['rows']]
+        tiles_rows = [[tile for tile in row[3].replace(' ', '').split(',') if tile != '']
+                      for row in group['rows']]
+        if len(group['rows']) == 1:
+            group['query'] = group['rows'][0][1]
+        else:
+            x1, y1, x2, y2 = group['bbox']
+            group['query'] = group['rest'].replace(
+                '{footprint}', 'footprint:"Intersects(POLYGON((%r %r, %r %r, %r %r, %r %r, %r %r)))"'
+                % (x1, y1, x2, y1, x2, y2, x1, y2, x1, y1))
+            logger.debug('%s rows coalesced into: %s'% (str(len(group['rows'])), group['query']))
+        group['cloud'] = (str(max(int(cloud) for cloud in clouds))
+                          if all(cloud.isdigit() for cloud in clouds) else '')
+        group['tiles'] = (sorted(set(sum(tiles_rows, [])))
+                          if all(tiles_rows) else [])
+    for i, plan in enumerate(plans):
+        if plan is None:
+            continue
+        group = plan.pop('group')
+        plan['query'] = group['query']
+        plan['cloud'] = group['cloud']
+        plan['tiles'] = group['tiles']
+        plan['shared'] = len(group['rows'])
+    return plans
+
+#------------------------------------Test-------------------------------------#
+if __name__ == '__main__':
+    sat_dict = {'S1':'platformname:Sentinel-1', 'S2':'platformname:Sentinel-2'}
+    rows = [['zone1', 'platformname:Sentinel-2 AND footprint:"Intersects(POLYGON((6.55 44.31, 6.55 44.47, 6.86 44.47, 6.86 44.31, 6.55 44.31)))"', '20', 'T32TLQ', 'B02'],
+            ['zone2', 'platformname:Sentinel-2 AND footprint:"Intersects(POLYGON((6.80 44.40, 6.80 44.60, 7.00 44.60, 7.00 44.40, 6.80 44.40)))"', '55', 'T32TLR', ''],
+            ['zone3', 'platformname:Sentinel-2 AND footprint:"Intersects(POLYGON((-1.0 48.0, -1.0 48.2, -0.8 48.2, -0.8 48.0, -1.0 48.0)))"', '20', '', ''],
+            ['zone4', 'platformname:Sentinel-1 AND footprint:"Intersects(POLYGON((6.55 44.31, 6.55 44.47, 6.86 44.47, 6.86 44.31, 6.55 44.31)))"', '', '', ''],
+            ['zone5', 'requete non valide', '', '', '']]
+
+    # set test
+    list_function = ['planrows', 'intersects', 'footprintfilter']
+    test_function = [list_function[0], list_function[1], list_function[2]] # insert function(s) from list_function to test
+
+    if(list_function[0] in test_function):
+        print('#--------------test: %s--------------#'% list_function[0])
+        for row, plan in zip(rows, planrows(rows, sat_dict)):
+            print(row[0], plan)
+
+    if(list_function[1] in test_function):
+        print('#--------------test: %s--------------#'% list_function[1])
+        square = [(0, 0), (0, 2), (2, 2), (2, 0), (0, 0)]
+        print(intersects(square, [(1, 1), (1, 3), (3, 3), (3, 1), (1, 1)]))           # True
+        print(intersects(square, [(0.5, 0.5), (0.5, 1), (1, 1), (1, 0.5), (0.5, 0.5)]))  # True (inside)
+        print(intersects(square, [(3, 3), (3, 4), (4, 4), (4, 3), (3, 3)]))           # False
+        print(intersects(square, [(1.8, 2.6), (3, 1.5), (3, 3), (1.8, 2.6)]))         # False (bbox only)
+
+    if(list_function[2] in test_function):
+        print('#--------------test: %s--------------#'% list_function[2])
+        prod_list = [['in', 'uuid1', '', '2016', 10.0, '', 'POLYGON ((6.0 44.0,6.7 44.0,6.7 44.5,6.0 44.5,6.0 44.0))'],
+                     ['out', 'uuid2', '', '2016', 10.0, '', 'POLYGON ((7.5 44.0,7.9 44.0,7.9 44.5,7.5 44.5,7.5 44.0))'],
+                     ['unknown', 'uuid3', '', '2016', 10.0, '', '']]
+        polygon = readpolygons('POLYGON((6.55 44.31, 6.55 44.47, 6.86 44.47, 6.86 44.31, 6.55 44.31))')[0]
+        print([element[0] for element in footprintfilter(prod_list, polygon)])
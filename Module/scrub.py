@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""This module contains the functions that check the integrity of the files
+already downloaded (see verify.py). The expected md5 checksums are read from
+the reports of the download directory:
+    - <dl_dir>/<zone>/rep_<zone>_<sat>.xml: products of a request. An entire
+      product is stored in <zone>/<sat>/<year>/<title>.zip
+    - <dl_dir>/<zone>/rep_<title>.xml: parts of a product when only some tiles
+      and/or bands are downloaded. The parts are stored in
+      <zone>/<sat>/<year>/<title>/<relative path of the part>
+The files are hashed by a pool of processes so that several files are read
+and hashed at the same time.
+"""
+
+import os
+import sys
+import imp
+import glob
+import logging
+import multiprocessing
+from lxml import etree
+
+module_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(module_path)
+
+import misc_tools
+import xmlReport
+imp.reload(misc_tools)
+imp.reload(xmlReport)
+
+if __name__ == '__main__':
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s ' +
+                              '- %(levelname)s - %(message)s')
+    steam_handler = logging.StreamHandler()
+    steam_handler.setFormatter(formatter)
+    steam_handler.setLevel(logging.DEBUG)
+    logger.addHandler(steam_handler)
+else:
+    logger = logging.getLogger('sentinel_dl')
+
+# The products with these statuses have no file to check
+SKIPPED_STATUS = ['missing checksum', 'missing manifest']
+
+#------------------------------------isreport----------------------------------#
+def isreport(xml_path):
+    """Function that tell whether a rep_*.xml file is the report of a request
+    (products with a title) and not the report of the parts of a product."""
+    root = etree.parse(xml_path).getroot()
+    entry = root.find('entry')
+    return entry is None or entry.find('title') is not None
+
+#-----------------------------------listtasks----------------------------------#
+def listtasks(dl_dir):
+    """Function that list the files of the download directory to check.
+
+    args:
+        dl_dir (string): download directory (see config.cfg)
+
+    return:
+        list of task, each task being a tuple:
+            (file path, expected md5, report path, key, status, product)
+        key is the uuid of an entire product or the relative path of a part,
+        status its current status in the report.
+        product is (report path, uuid, status) of the product of a part, None
+        for an entire product.
+    """
+    tasks = []
+    for report_path in sorted(glob.glob(os.path.join(dl_dir, '*', 'rep_*.xml'))):
+        if not isreport(report_path):
+            continue
+        zone_path = os.path.dirname(report_path)
+        # rep_<zone>_<sat>.xml
+        sat = os.path.basename(report_path)[:-len('.xml')].split('_')[-1]
+        for element in xmlReport.readXml(report_path):
+            if element.status in SKIPPED_STATUS:
+                continue
+            base_prod_path = zone_path + '/' + sat + '/' + element.year + '/' + element.title
+            report_part_path = zone_path + '/rep_' + element.title + '.xml'
+            if os.path.isfile(report_part_path):
+                for part in xmlReport.readXmlPart(report_part_path):
+                    tasks.append((base_prod_path + part[0][1:], part[1], report_part_path,
+                                  part[0], part[3], (report_path, element.uuid, element.status)))
+            else:
+                tasks.append((base_prod_path + '.zip', element.checksum, report_path,
+                              element.uuid, element.status, None))
+    return tasks
+
+#-----------------------------------nbworkers----------------------------------#
+def nbworkers(maxWorkers):
+    """Function that return the number of processes hashing the files.
+
+    args:
+        maxWorkers (int): maximum number of processes (verify_workers of the
+                        config.cfg file). 0 means one process per core. On a
+                        hard disk, the reads of several processes compete for
+                        the disk: 1 or 2 is enough.
+
+    return:
+        min(maxWorkers, number of cores)
+    """
+    cores = multiprocessing.cpu_count()
+    if maxWorkers <= 0:
+        return cores
+    return min(maxWorkers, cores)
+
+#-----------------------------------hashfile-----------------------------------#
+def hashfile(args):
+    """Function run by the processes of the pool that hash a file. The digest
+    cache is not read (the file is read again to detect a corruption of the
+    disk) but it is updated.
+
+    args:
+        args (tuple): (task, blocksize)
+
+    return:
+        (task, md5 checksum ('' if the file is missing), size of the file)
+    """
+    task, blocksize = args
+    file_path = task[0]
+    if not os.path.isfile(file_path):
+        return task, '', 0
+    checksum = misc_tools.generate_file_md5(os.path.dirname(file_path),
+                                            os.path.basename(file_path),
+                                            blocksize, cache=False)
+    return task, checksum, os.path.getsize(file_path)
+
+#-------------------------------------scrub------------------------------------#
+def scrub(tasks, nbWorkers, blocksize=2**23):
+    """Generator that hash the files of the tasks with a pool of nbWorkers
+    processes. The results are yielded as soon as a file is hashed.
+
+    args:
+        tasks (list): return of listtasks
+        nbWorkers (int): number of processes (see nbworkers)
+        blocksize (int): bytes read at each iteration
+
+    return:
+        (task, checksum, size) (see hashfile)
+    """
+    if not tasks:
+        return
+    # The biggest files first so that the last file hashed is a small one
+    tasks = sorted(tasks, key=lambda task: (misc_tools.filekey(task[0]) or (0, 0))[1],
+                   reverse=True)
+    pool = multiprocessing.Pool(nbWorkers)
+    try:
+        for result in pool.imap_unordered(hashfile, [(task, blocksize) for task in tasks]):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+#------------------------------------Test-------------------------------------#
+if __name__ == '__main__':
+    import shutil
+    import time
+    import hashlib
+    base_path = os.path.dirname(module_path)
+    dl_dir = base_path + '/testfile/scrub_tmp'
+    # set test
+    list_function = ['listtasks', 'scrub']
+    test_function = [list_function[0], list_function[1]] # insert function(s) from list_function to test
+
+    zone_path = dl_dir + '/zone1'
+    misc_tools.create_directory(zone_path + '/S2/2016')
+    with open(zone_path + '/S2/2016/prod1.zip', 'wb') as f:
+        f.write('sentinel')
+    xmlReport.createXml(zone_path + '/rep_zone1_S2.xml')
+    xmlReport.addProductEntry(zone_path + '/rep_zone1_S2.xml', 'prod1', 'uuid1', 'link1',
+                              'checksum ok', hashlib.md5('sentinel').hexdigest(), '2016')
+    xmlReport.addProductEntry(zone_path + '/rep_zone1_S2.xml', 'prod2', 'uuid2', 'link2',
+                              'missing checksum', '', '2016')
+
+    if(list_function[0] in test_function):
+        print('#--------------test: %s--------------#'% list_function[0])
+        tasks = listtasks(dl_dir)
+        for task in tasks:
+            print(task)
+
+    if(list_function[1] in test_function):
+        print('#--------------test: %s--------------#'% list_function[1])
+        start = time.time()
+        for task, checksum, size in scrub(listtasks(dl_dir), nbworkers(0)):
+            print(task[3], checksum, checksum == task[1], size)
+        print('%s s'% str(time.time() - start))
+
+    shutil.rmtree(dl_dir)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""This module contains the bandwidth limiter shared by all the downloads. It is
+a token bucket: every byte received takes a token, the tokens are refilled at
+the allowed rate, and a transfer that takes more tokens than available waits
+until the bucket is refilled. Since all the transfers (parallel parts,
+segments…) draw from the same bucket, the total download speed of the script
+stays under the limit.
+The limit is set in the config.cfg file with two parameters:
+    - max_rate: default limit in bytes/s (0 means no limit)
+    - rate_schedule: comma separated list of time of day ranges with their own
+      limit, ex: '08:00-18:00=500000, 18:00-20:00=2000000'. A range can cross
+      midnight (ex: '22:00-06:00=0').
+"""
+
+import time
+import threading
+import logging
+
+if __name__ == '__main__':
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s ' +
+                              '- %(levelname)s - %(message)s')
+    steam_handler = logging.StreamHandler()
+    steam_handler.setFormatter(formatter)
+    steam_handler.setLevel(logging.DEBUG)
+    logger.addHandler(steam_handler)
+else:
+    logger = logging.getLogger('sentinel_dl')
+
+#--------------------------------readschedule---------------------------------#
+def readschedule(schedule):
+    """Function that read the rate_schedule parameter.
+
+    args:
+        schedule (string): ex '08:00-18:00=500000, 18:00-20:00=2000000'
+
+    return:
+        list of tuple (start, end, rate) where start and end are minutes since
+        midnight and rate is in bytes/s.
+    """
+    ranges = []
+    for item in schedule.replace(' ', '').split(','):
+        if item == '':
+            continue
+        hours, rate = item.split('=')
+        start, end = hours.split('-')
+        start = int(start.split(':')[0]) * 60 + int(start.split(':')[1])
+        end = int(end.split(':')[0]) * 60 + int(end.split(':')[1])
+        ranges.append((start, end, int(rate)))
+    return ranges
+
+#---------------------------------TokenBucket---------------------------------#
+class TokenBucket(object):
+    """Token bucket shared by all the transfers.
+
+    args:
+        rate (int): default limit in bytes/s. 0 means no limit.
+        schedule (list of tuple): return of readschedule
+    """
+
+    def __init__(self, rate=0, schedule=None):
+        self.rate = rate
+        self.schedule = schedule or []
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last = time.time()
+
+    def currentrate(self, now=None):
+        """Return the limit in bytes/s that applies at the time now."""
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in self.schedule:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.rate
+
+    def consume(self, nb_bytes):
+        """Take nb_bytes tokens from the bucket and wait if there were not
+        enough of them.
+
+        return:
+            the time in second spent waiting
+        """
+        with self.lock:
+            now = time.time()
+            rate = self.currentrate(now)
+            if rate <= 0:
+                self.last = now
+                return 0
+            # The bucket holds at most one second of tokens. The tokens can go
+            # below 0: the transfers that come next wait until the debt is paid.
+            self.tokens = min(rate, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= nb_bytes
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+bucket = TokenBucket()
+
+#----------------------------------configure----------------------------------#
+def configure(maxRate, schedule=''):
+    """Function that set the limit of the bucket shared by all the transfers.
+
+    args:
+        maxRate (int): default limit in bytes/s. 0 means no limit.
+        schedule (string): rate_schedule parameter (see readschedule)
+    """
+    bucket.rate = maxRate
+    bucket.schedule = readschedule(schedule)
+    logger.debug('bandwidth limit: %s bytes/s, schedule: %s'% (str(maxRate), str(bucket.schedule)))
+
+#------------------------------------Test-------------------------------------#
+if __name__ == '__main__':
+
+    # set test
+    list_function = ['readschedule', 'consume']
+    test_function = [list_function[0], list_function[1]] # insert function(s) from list_function to test
+
+    if(list_function[0] in test_function):
+        print('#--------------test: %s--------------#'% list_function[0])
+        print(readschedule('08:00-18:00=500000, 18:00-20:00=2000000'))
+        print(readschedule('22:00-06:00=0'))
+        print(readschedule(''))
+
+    if(list_function[1] in test_function):
+        print('#--------------test: %s--------------#'% list_function[1])
+        configure(1000000)
+        start = time.time()
+        for i in range(10):
+            bucket.consume(500000)
+        print('5 MB at 1 MB/s in %0.1f s'% (time.time() - start))
@@ -9,6 +9,7 @@ download was successful, corrupted.
 from lxml import etree
 import os
 import logging
+import collections
 from shutil import copyfile
 
 if __name__ == '__main__':
@@ -23,6 +24,11 @@ if __name__ == '__main__':
 else:
     logger = logging.getLogger('sentinel_dl')
 
+# Entry of a product in the report (see readXml). The fields can still be read
+# by their index (title = element[0], uuid = element[1]…).
+ReportEntry = collections.namedtuple('ReportEntry', ['title', 'uuid', 'link', 'checksum',
+                                                     'status', 'year'])
+
 #-----------------------------------createXml----------------------------------#
 def createXml(xml_path):
     """Function that create an xml file that contains an empty root tag
@@ -132,8 +138,8 @@ def readXml(xml_path):
         xml_path (string) : Path of the xml file
 
     return:
-        prod_list (list) : List of list. The length of the list correspond to the number
-        of image entry in the xml file. And each sublist contains the different tag values
+        prod_list (list) : List of ReportEntry. The length of the list correspond to the number
+        of image entry in the xml file. And each ReportEntry contains the different tag values
         of an image entry.
     """
     prod_list = []
@@ -141,15 +147,14 @@ def readXml(xml_path):
     root = tree.getroot()
     entries = root.findall('entry')
     for entry in entries:
-        entry_list = []
         title = entry.find('title')
         uuid = entry.find('id')
         dl_link = entry.find('link')
         checksum = entry.find('checksum')
         status = entry.find('status')
         year = entry.find('year')
-        entry_list.extend([title.text, uuid.text, dl_link.text, checksum.text, status.text, year.text])
-        prod_list.append(entry_list)
+        prod_list.append(ReportEntry(title.text, uuid.text, dl_link.text, checksum.text,
+                                     status.text, year.text))
     return prod_list
 
 #-----------------------------filterProductEntry-------------------------------#
@@ -318,6 +323,60 @@ def updateRootValue(xml_path, tag, new_value):
     f.write(etree.tostring(tree, pretty_print=True))
     f.close()
 
+#---------------------------------readSyncState---------------------------------#
+def readSyncState(xml_path, request):
+    """Function that read the state of the incremental synchronisation of a
+    request: the latest ingestion date seen (watermark) and the date of the
+    last full browse of the catalog. The state is stored in a sync_state tag
+    right under the root tag, one per request since several requests may share
+    the same report.
+
+    parameters:
+        xml_path (string) : Path of the xml file
+        request (string) : open search query of the request
+
+    return:
+        (watermark, last_full_sync): dates in the ISO 8601 format, '' if
+        unknown (new request, or report created before the incremental
+        synchronisation)
+    """
+    tree = etree.parse(xml_path)
+    root = tree.getroot()
+    state = ['', '']
+    for sync_state in root.findall('sync_state'):
+        if sync_state.get('request') == request:
+            for i, tag in enumerate(['ingestion_watermark', 'last_full_sync']):
+                tag_element = sync_state.find(tag)
+                if tag_element is not None and tag_element.text:
+                    state[i] = tag_element.text
+    return tuple(state)
+
+#--------------------------------updateSyncState--------------------------------#
+def updateSyncState(xml_path, request, watermark, last_full_sync):
+    """Function that save the state of the incremental synchronisation of a
+    request (see readSyncState).
+
+    parameters:
+        xml_path (string) : Path of the xml file
+        request (string) : open search query of the request
+        watermark (string) : latest ingestion date seen
+        last_full_sync (string) : date of the last full browse of the catalog
+    """
+    tree = etree.parse(xml_path)
+    root = tree.getroot()
+    for sync_state in root.findall('sync_state'):
+        if sync_state.get('request') == request:
+            root.remove(sync_state)
+    sync_state = etree.Element('sync_state', request=request)
+    ingestion_watermark = etree.SubElement(sync_state, 'ingestion_watermark')
+    ingestion_watermark.text = watermark
+    full_sync = etree.SubElement(sync_state, 'last_full_sync')
+    full_sync.text = last_full_sync
+    root.insert(1, sync_state)
+    f = open(xml_path, 'w')
+    f.write(etree.tostring(tree, pretty_print=True))
+    f.close()
+
 #-------------------------------------readXmlPart----------------------------------#
 def readXmlPart(xml_path):
     """Function that read an xml end return the list of product's elements.
@@ -429,7 +488,7 @@ if __name__ == '__main__':
                      'filterProductEntry', 'statusFrequency', 'countNbImage', 'imageExist',
                      'updateImageValue', 'readTagValue', 'addElementEntry',
                      'updateRootValue', 'readXmlPart', 'changeElementEntry',
-                     'removeProductEntry', 'removeElementEntry']
+                     'removeProductEntry', 'removeElementEntry', 'readSyncState']
     test_function = [list_function[16]] # insert function(s) from list_function to test
 
     if(list_function[0] in test_function):
@@ -637,3 +696,15 @@ if __name__ == '__main__':
         copyfile(xmlReportParts2, dst)
         relpath = './GRANULE/S2A_OPER_MSI_L1C_TL_SGS__20160103T174751_A002779_T32TLQ_N02.01/QI_DATA/S2A_OPER_MSK_DETFOO_SGS__20160103T174751_A002779_T32TLQ_B04_MSIL1C.gml'
         removeElementEntry(dst, relpath)
+
+    if(list_function[17] in test_function):
+        print('#--------------test: %s--------------#'% list_function[17])
+        dst = os.path.dirname(xmlReportGlobal)+ '/rep_Barce_S2_copie.xml'
+        copyfile(xmlReportGlobal, dst)
+        request = 'platformname:Sentinel-2'
+        print(readSyncState(dst, request))
+        updateSyncState(dst, request, '2016-02-23T22:45:56.547Z', '2016-03-01T00:00:00.000Z')
+        print(readSyncState(dst, request))
+        updateSyncState(dst, request, '2016-02-24T10:00:00.000Z', '2016-03-01T00:00:00.000Z')
+        print(readSyncState(dst, request))
+        print(readSyncState(dst, 'platformname:Sentinel-1'))
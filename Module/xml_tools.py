@@ -3,6 +3,9 @@
 from lxml import etree # lxml sensé être plus rapide que les autres.
 import os
 import logging
+import datetime
+import collections
+from io import BytesIO
 import dateutil.parser as parser
 
 if __name__ == '__main__':
@@ -22,36 +25,140 @@ else:
 ns = {'os': 'http://a9.com/-/spec/opensearch/1.1/',
       'default': 'http://www.w3.org/2005/Atom'}
 
+ENTRY = '{' + ns['default'] + '}entry'
+TITLE = '{' + ns['default'] + '}title'
+ID = '{' + ns['default'] + '}id'
+LINK = '{' + ns['default'] + '}link'
+TOTAL = '{' + ns['os'] + '}totalResults'
+
+# Record of a product returned by the scihub. It is a tuple: the fields can
+# still be read by their index (title = element[0], uuid = element[1]…) and
+# it takes less memory than a list.
+ProductRecord = collections.namedtuple('ProductRecord', ['title', 'uuid', 'link', 'year',
+                                                         'cloud', 'ingestiondate', 'footprint'])
+
 #-------------------------------getnumbprod-------------------------------#
 def getnumbprod(xml_path):
     tree = etree.parse(xml_path)
-    root = tree.getroot()
+    return numbprod(tree.getroot())
+
+def getnumbprodpage(page):
+    """Same as getnumbprod for a response held in memory (string). None if
+    the response can't be read (see readpage)."""
+    result = readpage(page, 'S1', entries=False)
+    return None if result is None else result[0]
+
+def numbprod(root):
     element = root.find(ns.keys()[1]+':totalResults', ns)
     return int(element.text)
 
+#---------------------------------isodate---------------------------------#
+def isodate(date):
+    """Function that read a date of the scihub. The usual fixed format
+    (ex: '2016-02-22T10:20:28.123Z' or '2016-02-22T10:20:28Z') is read directly
+    from its digits, which is much faster than dateutil. Any other format is
+    read with dateutil.
+
+    args:
+        date (string): date in the ISO 8601 format
+
+    return:
+        datetime object (the fraction of second and the time zone are ignored
+        by the fast path)
+    """
+    if len(date) >= 19 and date[4] == '-' and date[7] == '-' and date[10] == 'T':
+        try:
+            return datetime.datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                     int(date[11:13]), int(date[14:16]), int(date[17:19]))
+        except ValueError:
+            pass
+    return parser.parse(date)
+
+#------------------------------iterprodlist-------------------------------#
+def iterprodlist(source, sat, total=None, entries=True):
+    """Generator that read the products of an open search response one entry
+    at a time (lxml iterparse). Each entry is cleared once read so that the
+    whole tree of a large response is never held in memory.
+
+    args:
+        source: path of the xml file or file object
+        sat (string): name of the satellite, either 'S1' or 'S2'
+        total (list): if not None, the totalResults value is appended to it
+        entries (boolean): if False, the parsing stops after totalResults
+
+    yield:
+        ProductRecord(title, uuid, download link, begin year, cloud cover
+        percentage (None for 'S1'), ingestion date, footprint (WKT))
+    """
+    for event, elem in etree.iterparse(source, events=('end',), tag=(TOTAL, ENTRY)):
+        if elem.tag == TOTAL:
+            if total is not None:
+                total.append(int(elem.text))
+            if not entries:
+                return
+            continue
+        title = uuid = link = begindate = None
+        cloud = None
+        ingestion = footprint = ''
+        for child in elem:
+            tag = child.tag
+            if tag == TITLE:
+                title = child.text
+            elif tag == ID:
+                uuid = child.text
+            elif tag == LINK:
+                if link is None: # the first link tag is the download link. there are 3
+                    link = child.get('href')
+            else:
+                name = child.get('name')
+                if name == 'beginposition':
+                    begindate = child.text
+                elif name == 'ingestiondate':
+                    ingestion = child.text
+                elif name == 'cloudcoverpercentage' and sat == 'S2':
+                    cloud = float(child.text)
+                elif name == 'footprint':
+                    footprint = child.text
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+        yield ProductRecord(title, uuid, link, str(isodate(begindate).year), cloud,
+                            ingestion, footprint)
+
 #-------------------------------getprodlist-------------------------------#
 def getprodlist(xml_path, sat):
-    prod_list = []
-    entry_list = []
-    tree = etree.parse(xml_path)
-    root = tree.getroot()
-    entries = root.findall(ns.keys()[0]+':entry', ns)
-    for entry in entries:
-        entry_list = []
-        title = entry.find('default:title', ns)
-        uuid = entry.find('default:id', ns)
-        dl_link = entry.find('default:link', ns) # recherche da la première balise link. il y en a 3
-        date = entry.find('{' + ns['default'] + '}' + "*[@name='beginposition']") 
-        begindate = date.text
-        logger.debug('begin date:%s'% begindate)
-        begindate = parser.parse(begindate).year
-        logger.debug('begin date:%s'% begindate)
-        entry_list.extend([title.text, uuid.text, dl_link.get('href'), str(begindate)])
-        if(sat == 'S2'):
-            cloud = entry.find('{' + ns['default'] + '}' + "*[@name='cloudcoverpercentage']")
-            entry_list.append(float(cloud.text))
-        prod_list.append(entry_list)
-    return prod_list
+    return list(iterprodlist(xml_path, sat))
+
+def getprodlistpage(page, sat):
+    """Same as getprodlist for a response held in memory (string). None if
+    the response can't be read (see readpage)."""
+    result = readpage(page, sat)
+    return None if result is None else result[1]
+
+#--------------------------------readpage---------------------------------#
+def readpage(page, sat, entries=True):
+    """Function that read an open search response held in memory.
+
+    args:
+        page (string): xml response
+        sat (string): name of the satellite, either 'S1' or 'S2'
+        entries (boolean): if False, only totalResults is read
+
+    return:
+        (total number of products, list of products (see iterprodlist)) or
+        None if the response is not an open search feed (ex: html page of a
+        server under maintenance) or has no totalResults.
+    """
+    total = []
+    try:
+        prod_list = list(iterprodlist(BytesIO(page), sat, total, entries))
+    except (etree.LxmlError, ValueError, TypeError) as e:
+        logger.error('The search response could not be read: %s'% str(e))
+        return None
+    if not total:
+        logger.error('totalResults not found in the search response')
+        return None
+    return total[0], prod_list
 
 #-----------------------------------Test------------------------------------#
 
@@ -62,7 +169,7 @@ if __name__ == '__main__':
     xmlpath2 = base_path + "/testfile/test_S2.xml"
 
     # set test
-    list_function = ['getnumbprod', 'getprodlist']
+    list_function = ['getnumbprod', 'getprodlist', 'getprodlistpage']
     test_function = [list_function[1]] # insert function(s) from list_function to test
     
     if(list_function[0] in test_function):
@@ -84,3 +191,11 @@ if __name__ == '__main__':
         print(len(prod_list))
         for element in prod_list:
             print(element)
+
+    if(list_function[2] in test_function):
+        print('#--------------test: %s--------------#'% list_function[2])
+        with open(xmlpath2, 'r') as f:
+            page = f.read()
+        print(getnumbprodpage(page))
+        print(getprodlistpage(page, 'S2') == getprodlist(xmlpath2, 'S2'))
+        print(readpage('<html><body>maintenance</body></html>', 'S2'))
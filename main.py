@@ -7,6 +7,7 @@ import sys
 import csv
 import os
 import logging
+import datetime
 from logging.handlers import RotatingFileHandler
 import traceback
 
@@ -16,17 +17,6 @@ module_path = base_path + "/Module"
 
 sys.path.append(module_path)
 
-import osodrequest
-import misc_tools
-import xml_tools
-import xmlReport
-import manifestSafe
-imp.reload(osodrequest)
-imp.reload(misc_tools)
-imp.reload(xml_tools)
-imp.reload(xmlReport)
-imp.reload(manifestSafe)
-
 #------------------------------------------------------------------------------#
 # http://sametmax.com/ecrire-des-logs-en-python/
 logger = logging.getLogger('sentinel_dl')
@@ -42,6 +32,32 @@ steam_handler = logging.StreamHandler()
 steam_handler.setLevel(logging.INFO)
 logger.addHandler(steam_handler)
 
+import misc_tools
+import engine
+imp.reload(misc_tools)
+imp.reload(engine)
+# The green engine patches the standard library (see engine.setup). It is set
+# up before the modules below are imported so that the locks they create are
+# green locks.
+engine.setup(misc_tools.readconf(base_path + "/config.cfg")['param']['engine'])
+
+import osodrequest
+import xmlReport
+import manifestSafe
+import dlpool
+import progressbar
+import throttle
+import catalogdb
+import queryplan
+imp.reload(osodrequest)
+imp.reload(xmlReport)
+imp.reload(manifestSafe)
+imp.reload(dlpool)
+imp.reload(progressbar)
+imp.reload(throttle)
+imp.reload(catalogdb)
+imp.reload(queryplan)
+
 
 def main():
     #------------------------------------------------------------------------------#
@@ -54,6 +70,20 @@ def main():
     conf_dict = misc_tools.readconf(config_path)
     request_path = base_path + "/requete.csv"
 
+    progressbar.settimeouts(int(conf_dict['param']['read_timeout']),
+                            int(conf_dict['param']['stall_window']),
+                            int(conf_dict['param']['stall_rate']))
+    progressbar.setdiskreserve(int(conf_dict['param']['disk_reserve']))
+    if int(conf_dict['param']['dump_pages']):
+        # The search responses are written to the disk for debugging
+        osodrequest.dumpDir = base_path + "/cur_prod_list"
+    throttle.configure(int(conf_dict['param']['max_rate']),
+                       conf_dict['param']['rate_schedule'])
+    misc_tools.create_directory(conf_dict['param']['dl_dir'])
+    catalog = catalogdb.opendb(conf_dict['param']['dl_dir'] + '/catalog.db')
+    dlpool.storeDir = conf_dict['param']['dl_dir'] + '/.cas'
+    misc_tools.digestDb = conf_dict['param']['dl_dir'] + '/digest.db'
+
     #------------------------------------------------------------------------------#
     logger.info('Starting authentication…')
     auth_succeed = osodrequest.authenticate(conf_dict['log']['user'],
@@ -82,245 +112,180 @@ def main():
     with open(request_path, 'rb') as csvfile:
         requestreader = csv.reader(csvfile, delimiter=';')
         next(requestreader)
-        for row in requestreader:
-            logger.info('Processing the following request: %s…'% row[1])
-            if fulldisk:
-                logger.warning('The hard drive is full. Skipping the remaining ' +
-                               'requests.')
-                break
-            
-            sat = misc_tools.findSat(row[1], sat_dict)
-            if sat=='':
-                logger.warning('The current request is not valid. It must ' +
-                                'contains %s or %s. Skipping to the next request'%
-                               (sat_dict['S1'], sat_dict['S2']))
-                continue
-            
-            urlrequest = conf_dict['log']['auth_url'] + "/search?q=" + row[1]
-            logger.debug('Current request: %s'% urlrequest)
+        rows = list(requestreader)
+    # The compatible rows are coalesced into a single search (see queryplan).
+    # The list of products of each search is kept for the other rows of the
+    # group.
+    plans = queryplan.planrows(rows, sat_dict)
+    searched = {}
+    for row, plan in zip(rows, plans):
+        logger.info('Processing the following request: %s…'% row[1])
+        if fulldisk:
+            logger.warning('The hard drive is full. Skipping the remaining ' +
+                           'requests.')
+            break
+        
+        sat = misc_tools.findSat(row[1], sat_dict)
+        if sat=='':
+            logger.warning('The current request is not valid. It must ' +
+                            'contains %s or %s. Skipping to the next request'%
+                           (sat_dict['S1'], sat_dict['S2']))
+            continue
+        
+        urlrequest = conf_dict['log']['auth_url'] + "/search?q=" + plan['query']
+        # The cloud cover percentage and the tiles are added to the query so
+        # that the scihub only returns the products that may be downloaded.
+        # The products are still filtered afterwards (see cloudfilter and
+        # manifestSafe.filterelementS2).
+        urlrequest = misc_tools.pushdownreq(urlrequest, sat, plan['cloud'], plan['tiles'])
+        query = urlrequest.split('?q=', 1)[1]
+        logger.debug('Current request: %s'% urlrequest)
+        
+        cur_dl_path_base = conf_dict['param']['dl_dir'] + "/" + row[0]
+        misc_tools.create_directory(cur_dl_path_base)
+        logger.debug('Current download base path: %s'% cur_dl_path_base)
+        
+        report_path = cur_dl_path_base + '/rep_' + row[0][:5] + '_' + sat + '.xml'
+        misc_tools.create_directory(os.path.dirname(report_path))
+        logger.debug('Current report path: %s'% report_path)
+        
+        if not os.path.isfile(report_path):
+            logger.debug('First time processing the current request.')
+            xmlReport.createXml(report_path)
+            xmlReport.addInfoTag(report_path, 0, 'number_past_product', 0)
             
-            xml_product_path = base_path + "/cur_prod_list" + "/product_list.xml"
-            misc_tools.create_directory(os.path.dirname(xml_product_path))
-            logger.debug('Current xml product file temp path: %s'% xml_product_path) 
-
-            cur_dl_path_base = conf_dict['param']['dl_dir'] + "/" + row[0]
-            misc_tools.create_directory(cur_dl_path_base)
-            logger.debug('Current download base path: %s'% cur_dl_path_base)
-            
-            report_path = cur_dl_path_base + '/rep_' + row[0][:5] + '_' + sat + '.xml'
-            misc_tools.create_directory(os.path.dirname(report_path))
-            logger.debug('Current report path: %s'% report_path)
-            
-            if not os.path.isfile(report_path):
-                logger.debug('First time processing the current request.')
-                xmlReport.createXml(report_path)
-                xmlReport.addInfoTag(report_path, 0, 'number_past_product', 0)
-                
-            #-------------------------------Retrieving past failed product-----------------------------#
-            past_prod_list = xmlReport.readXml(report_path)
-            past_prod_list_filt = xmlReport.filterProductEntry(past_prod_list, 4)
-            if (not past_prod_list_filt) and (len(past_prod_list) > 0):
-                logger.info('All the past products are ok.')
-            else:
-                logger.info('Number of past product to be retrieved: %s'% len(past_prod_list_filt))
-                for element in past_prod_list_filt:
-                    #Ajouter ici un test qui permet de savoir si le scihub est indisponible pour éviter de rentrer dans chaque produit.
-                    #Si indisponible alors ajouter un continue. peut être se réauthentifier pour voir ?
-                    if (sat == 'S2') and ((row[3] != '') or (row[4] != '')): #tiles and/or bands case
-                        bandsandtiles = misc_tools.extractBandsTiles(row[3], row[4])
-                        base_prod_path = cur_dl_path_base + '/' + sat + '/' + element[5] + '/' + element[0]
-                        xml_manifest_path = base_prod_path + '/' + 'manifest.safe' + '.xml'
-                        report_part_path = cur_dl_path_base + '/rep_' + element[0] + '.xml'
-                        misc_tools.create_directory(os.path.dirname(xml_manifest_path))
-                        logger.debug('current status: %s'% element[4])
-                        xmlReport.createXml(report_part_path)
-                        if element[4] == 'missing manifest':
-                            #repeat code 3 begin---------------------
-                            if not fulldisk:
-                                result = osodrequest.getmanifest(element[2], element[0],
-                                                                 int(conf_dict['param']['nb_retry']),
-                                                                 int(conf_dict['param']['wait_time']),
-                                                                 xml_manifest_path)
-                                if result:
-                                    logger.info('Manifest.safe successfully retrieved')
-                                    logger.info('reading manifest file…') 
-                                    product_parts = manifestSafe.readmanifest(xml_manifest_path)
-                                    logger.info('Filtering elements of the product…')
-                                    size_before_filt = len(product_parts)
-                                    logger.info('Number of parts before filtering: %s'% str(size_before_filt))
-                                    product_parts = manifestSafe.filterelementS2(product_parts,
-                                                                                 bandsandtiles[0],
-                                                                                 bandsandtiles[1])
-                                    size_after_filt = len(product_parts)
-                                    logger.info('Number of parts after filtering: %s'% str(size_after_filt))
-                                    if size_before_filt == size_after_filt:
-                                        logger.info('No bands or tiles correspond to the specified bands and tiles ' +
-                                                    'for the current product')
-                                        xmlReport.removeProductEntry(report_path, element[1])
-                                        continue
-                                    logger.info('Generating product parts uri…')
-                                    product_parts = manifestSafe.generateuri(product_parts,
-                                                                             element[2],
-                                                                             element[0])
-                                    for i, part in enumerate(product_parts):
-                                        if not fulldisk:
-                                            part_path = base_prod_path + part[0][1:]
-                                            misc_tools.create_directory(os.path.dirname(part_path))
-                                            logger.info('download %s out of %s\n file : %s'
-                                                         % (str(i+1), str(len(product_parts)), part_path))
-                                            result = osodrequest.getimagefile(part[2],
-                                                                              int(conf_dict['param']['nb_retry']),
-                                                                              int(conf_dict['param']['wait_time']),
-                                                                              part_path,
-                                                                              chunk_size,
-                                                                              part[1].lower())
-                                            fulldisk = result[1]
-                                            if result[0]:
-                                                logger.info('Generating checksum md5…') 
-                                                md5generated = misc_tools.generate_file_md5(os.path.dirname(part_path),
-                                                                                            os.path.basename(part_path),
-                                                                                            chunk_size)
-                                                if md5generated.lower() == part[1].lower():
-                                                    logger.info('The current product part has been successfully retrieved')
-                                                    cur_part_status = 'checksum ok'
-                                                else:
-                                                    logger.warning('The current product part is corrupted')
-                                                    cur_part_status = 'corrupted file'
-                                            else:
-                                                logger.warning('The current product part could not be retrieved.') 
-                                                cur_part_status = 'corrupted file'
-                                        else:
-                                            logger.warning('The current product part has not been retrieved because the disk is full') 
-                                            cur_part_status = 'corrupted file'
-                                        xmlReport.removeElementEntry(report_part_path, part[0])
-                                        xmlReport.addElementEntry(report_part_path, part[0],
-                                                                  part[2], part[1],
-                                                                  cur_part_status)
-                                    count = xmlReport.statusFrequency(report_part_path)
-                                    if (sum(count.values()) - count['checksum ok']) == 0:
-                                        cur_prod_status = 'checksum ok'
-                                    else:
-                                        cur_prod_status = 'corrupted archive' 
+        #-------------------------------Retrieving past failed product-----------------------------#
+        past_prod_list = xmlReport.readXml(report_path)
+        if not ((sat == 'S2') and ((row[3] != '') or (row[4] != ''))):
+            # The products of the report are indexed so that the other
+            # requests can link them instead of downloading them again.
+            catalogdb.addstored(catalog, [(element[1], element[3],
+                                           cur_dl_path_base + '/' + sat + '/' + element[5] + '/' + element[0] + '.zip')
+                                          for element in past_prod_list if element[4] == 'checksum ok'],
+                                False)
+        past_prod_list_filt = xmlReport.filterProductEntry(past_prod_list, 4)
+        if (not past_prod_list_filt) and (len(past_prod_list) > 0):
+            logger.info('All the past products are ok.')
+        else:
+            logger.info('Number of past product to be retrieved: %s'% len(past_prod_list_filt))
+            for element in past_prod_list_filt:
+                #Ajouter ici un test qui permet de savoir si le scihub est indisponible pour éviter de rentrer dans chaque produit.
+                #Si indisponible alors ajouter un continue. peut être se réauthentifier pour voir ?
+                if (sat == 'S2') and ((row[3] != '') or (row[4] != '')): #tiles and/or bands case
+                    bandsandtiles = misc_tools.extractBandsTiles(row[3], row[4])
+                    base_prod_path = cur_dl_path_base + '/' + sat + '/' + element[5] + '/' + element[0]
+                    xml_manifest_path = base_prod_path + '/' + 'manifest.safe' + '.xml'
+                    report_part_path = cur_dl_path_base + '/rep_' + element[0] + '.xml'
+                    misc_tools.create_directory(os.path.dirname(xml_manifest_path))
+                    logger.debug('current status: %s'% element[4])
+                    xmlReport.createXml(report_part_path)
+                    if element[4] == 'missing manifest':
+                        #repeat code 3 begin---------------------
+                        if not fulldisk:
+                            result = osodrequest.getmanifest(element[2], element[0],
+                                                             int(conf_dict['param']['nb_retry']),
+                                                             int(conf_dict['param']['wait_time']),
+                                                             xml_manifest_path)
+                            if result:
+                                logger.info('Manifest.safe successfully retrieved')
+                                logger.info('reading manifest file…') 
+                                product_parts = manifestSafe.readmanifest(xml_manifest_path)
+                                logger.info('Filtering elements of the product…')
+                                size_before_filt = len(product_parts)
+                                logger.info('Number of parts before filtering: %s'% str(size_before_filt))
+                                product_parts = manifestSafe.filterelementS2(product_parts,
+                                                                             bandsandtiles[0],
+                                                                             bandsandtiles[1])
+                                size_after_filt = len(product_parts)
+                                logger.info('Number of parts after filtering: %s'% str(size_after_filt))
+                                if size_before_filt == size_after_filt:
+                                    logger.info('No bands or tiles correspond to the specified bands and tiles ' +
+                                                'for the current product')
+                                    xmlReport.removeProductEntry(report_path, element[1])
+                                    continue
+                                logger.info('Generating product parts uri…')
+                                product_parts = manifestSafe.generateuri(product_parts,
+                                                                         element[2],
+                                                                         element[0])
+                                for part, cur_part_status, fulldisk in dlpool.downloadparts(product_parts,
+                                                                                            base_prod_path,
+                                                                                            int(conf_dict['param']['nb_retry']),
+                                                                                            int(conf_dict['param']['wait_time']),
+                                                                                            chunk_size,
+                                                                                            int(conf_dict['param']['nb_workers']),
+                                                                                            fulldisk):
+                                    xmlReport.removeElementEntry(report_part_path, part[0])
+                                    xmlReport.addElementEntry(report_part_path, part[0],
+                                                              part[2], part[1],
+                                                              cur_part_status)
+                                count = xmlReport.statusFrequency(report_part_path)
+                                if (sum(count.values()) - count['checksum ok']) == 0:
+                                    cur_prod_status = 'checksum ok'
                                 else:
-                                    logger.warning('Failed to retrieve the manifest.safe file')
-                                    cur_prod_status = 'missing manifest'
+                                    cur_prod_status = 'corrupted archive' 
                             else:
+                                logger.warning('Failed to retrieve the manifest.safe file')
                                 cur_prod_status = 'missing manifest'
-                            #repeat code 3 end---------------------
-                        elif element[4] == 'corrupted archive':
-                            product_parts = xmlReport.readXmlPart(report_part_path)
-                            product_parts = xmlReport.filterProductEntry(product_parts, 3)
-                            #repeat code 4 begin--------------------- 
-                            for i, part in enumerate(product_parts):
-                                if not fulldisk:
-                                    part_path = base_prod_path + part[0][1:]
-                                    misc_tools.create_directory(os.path.dirname(part_path))
-                                    logger.info('download %s out of %s\n file : %s'
-                                                % (str(i+1), str(len(product_parts)), part_path))
-                                    result = osodrequest.getimagefile(part[2],
-                                                                      int(conf_dict['param']['nb_retry']),
-                                                                      int(conf_dict['param']['wait_time']),
-                                                                      part_path,
-                                                                      chunk_size,
-                                                                      part[1].lower())
-                                    fulldisk = result[1]
-                                    if result[0]:
-                                        logger.info('Generating checksum md5…')
-                                        md5generated = misc_tools.generate_file_md5(os.path.dirname(part_path),
-                                                                                    os.path.basename(part_path),
-                                                                                    chunk_size)
-                                        if md5generated.lower() == part[1].lower():
-                                            logger.info('The current product part has been successfully retrieved')
-                                            cur_part_status = 'checksum ok'
-                                        else:
-                                            logger.warning('The current product part is corrupted')
-                                            cur_part_status = 'corrupted file'
-                                    else:
-                                        logger.warning('The current product part could not be retrieved.') 
-                                        cur_part_status = 'corrupted file'
-                                else:
-                                    logger.warning('The current product part has not been retrieved because the disk is full') 
-                                    cur_part_status = 'corrupted file'
-                                xmlReport.changeElementEntry(report_part_path, part[0],
-                                                             'status', cur_part_status)
-                            count = xmlReport.statusFrequency(report_part_path)
-                            if (sum(count.values()) - count['checksum ok']) == 0:
-                                cur_prod_status = 'checksum ok'
-                            else:
-                                cur_prod_status = 'corrupted archive'
-                            #repeat code 4 end--------------------- 
                         else:
-                            logger.debug('Problem past product. Unknown status.')
+                            cur_prod_status = 'missing manifest'
+                        #repeat code 3 end---------------------
+                    elif element[4] == 'corrupted archive':
+                        product_parts = xmlReport.readXmlPart(report_part_path)
+                        product_parts = xmlReport.filterProductEntry(product_parts, 3)
+                        #repeat code 4 begin--------------------- 
+                        for part, cur_part_status, fulldisk in dlpool.downloadparts(product_parts,
+                                                                                    base_prod_path,
+                                                                                    int(conf_dict['param']['nb_retry']),
+                                                                                    int(conf_dict['param']['wait_time']),
+                                                                                    chunk_size,
+                                                                                    int(conf_dict['param']['nb_workers']),
+                                                                                    fulldisk):
+                            xmlReport.changeElementEntry(report_part_path, part[0],
+                                                         'status', cur_part_status)
+                        count = xmlReport.statusFrequency(report_part_path)
+                        if (sum(count.values()) - count['checksum ok']) == 0:
+                            cur_prod_status = 'checksum ok'
+                        else:
                             cur_prod_status = 'corrupted archive'
-                        xmlReport.updateImageValue(report_path, element[1], 'status', cur_prod_status)
-                    else: #entire product case
-                        cur_dl_path_file = cur_dl_path_base + '/' + sat + '/' + element[5] + '/' + element[0] + ".zip"
-                        misc_tools.create_directory(os.path.dirname(cur_dl_path_file))
-                        logger.info('Current file path: %s'% cur_dl_path_file)
-                        if element[4] == 'missing checksum':
-                            #code reapeat 1 begin------------------------------
-                            checksum_real = osodrequest.getmd5(element[2], int(conf_dict['param']['nb_retry']),
-                                                               int(conf_dict['param']['wait_time']))
-                            logger.debug('checksum_real value: %s'% str(checksum_real[0])) 
-                            if checksum_real[0]:
-                                xmlReport.updateImageValue(report_path, element[1], 'checksum', checksum_real[1]) 
-                                #code reapeat 2 begin
-                                if not fulldisk:
-                                    logger.info('Downloading image %s to path: %s…'% (element[0], cur_dl_path_file))
-                                    result = osodrequest.getimagefile(element[2],
-                                                                      int(conf_dict['param']['nb_retry']),
-                                                                      int(conf_dict['param']['wait_time']),
-                                                                      cur_dl_path_file,
-                                                                      chunk_size,
-                                                                      checksum_real[1].lower())
-                                    fulldisk = result[1]
-                                    if result[0]:
-                                        logger.info('Generating checksum md5…') 
-                                        checksum_calculated = misc_tools.generate_file_md5(os.path.dirname(cur_dl_path_file),
-                                                                                           os.path.basename(cur_dl_path_file),
-                                                                                           blocksize=2**20)
-                                        logger.debug('checksum calculated: %s'% checksum_calculated.lower())
-                                        logger.debug('checksum real: %s'% checksum_real[1].lower())
-                                        if (checksum_real[1].lower() == checksum_calculated.lower()):
-                                            logger.info('The current product has been successfully retrieved')
-                                            cur_prod_status = 'checksum ok'
-                                        else:
-                                            logger.warning('The current product part is corrupted') 
-                                            cur_prod_status = 'corrupted archive'
-                                    else:
-                                        logger.warning('The current product could not be retrieved.')
-                                        cur_prod_status = 'corrupted archive'
-                                else:
-                                    logger.warning('The current product has not been retrieved because the disk is full') 
-                                    cur_prod_status = 'corrupted archive'
-                                #code reapeat 2 end
-                            else:
-                                logger.warning('The checksum could not be retrived. Skipping to the next product')
-                                cur_prod_status = 'missing checksum'
-                            #code reapeat 1 end--------------------------------
-                        elif element[4] == 'corrupted archive':
+                        #repeat code 4 end--------------------- 
+                    else:
+                        logger.debug('Problem past product. Unknown status.')
+                        cur_prod_status = 'corrupted archive'
+                    xmlReport.updateImageValue(report_path, element[1], 'status', cur_prod_status)
+                else: #entire product case
+                    cur_dl_path_file = cur_dl_path_base + '/' + sat + '/' + element[5] + '/' + element[0] + ".zip"
+                    misc_tools.create_directory(os.path.dirname(cur_dl_path_file))
+                    logger.info('Current file path: %s'% cur_dl_path_file)
+                    if element[4] == 'missing checksum':
+                        #code reapeat 1 begin------------------------------
+                        checksum_real = osodrequest.getmd5(element[2], int(conf_dict['param']['nb_retry']),
+                                                           int(conf_dict['param']['wait_time']))
+                        logger.debug('checksum_real value: %s'% str(checksum_real[0])) 
+                        if checksum_real[0]:
+                            xmlReport.updateImageValue(report_path, element[1], 'checksum', checksum_real[1]) 
                             #code reapeat 2 begin
-                            if not fulldisk:
-                                logger.info('Downloading image %s to path: %s…'% (element[0], cur_dl_path_file)) 
+                            if catalogdb.linkstored(catalog, element[1], checksum_real[1], cur_dl_path_file):
+                                cur_prod_status = 'checksum ok'
+                            elif not fulldisk:
+                                logger.info('Downloading image %s to path: %s…'% (element[0], cur_dl_path_file))
                                 result = osodrequest.getimagefile(element[2],
                                                                   int(conf_dict['param']['nb_retry']),
                                                                   int(conf_dict['param']['wait_time']),
                                                                   cur_dl_path_file,
                                                                   chunk_size,
-                                                                  element[3].lower())
+                                                                  checksum_real[1].lower(),
+                                                                  nbSegments=int(conf_dict['param']['nb_segments']))
                                 fulldisk = result[1]
                                 if result[0]:
-                                    logger.info('Generating checksum md5…')
-                                    checksum_calculated = misc_tools.generate_file_md5(os.path.dirname(cur_dl_path_file),
-                                                                                       os.path.basename(cur_dl_path_file),
-                                                                                       blocksize=2**20)
+                                    checksum_calculated = result[2]
                                     logger.debug('checksum calculated: %s'% checksum_calculated.lower())
-                                    logger.debug('checksum real: %s'% element[3].lower())
-                                    if (element[3].lower() == checksum_calculated.lower()):
+                                    logger.debug('checksum real: %s'% checksum_real[1].lower())
+                                    if (checksum_real[1].lower() == checksum_calculated.lower()):
                                         logger.info('The current product has been successfully retrieved')
                                         cur_prod_status = 'checksum ok'
+                                        catalogdb.addstored(catalog, [(element[1], checksum_real[1], cur_dl_path_file)])
                                     else:
-                                        logger.warning('The current product part is corrupted')
+                                        logger.warning('The current product part is corrupted') 
                                         cur_prod_status = 'corrupted archive'
                                 else:
                                     logger.warning('The current product could not be retrieved.')
@@ -330,161 +295,33 @@ def main():
                                 cur_prod_status = 'corrupted archive'
                             #code reapeat 2 end
                         else:
-                            logger.debug('Problem past product. Unknown status.')
-                            cur_prod_status = 'corrupted archive'
-                        xmlReport.updateImageValue(report_path, element[1], 'status', cur_prod_status) 
-            #-----------------------------------Retrieving new product---------------------------------#                   
-            logger.info('Retrieving the number of product in the database for the current request…')                 
-            result = osodrequest.getproductlist(urlrequest,
-                                                int(conf_dict['param']['nb_retry']),
-                                                int(conf_dict['param']['wait_time']),
-                                                xml_product_path)
-            if result == False:
-                logger.warning('Failed to retrieve the number of product. The ' +
-                               'server may be currently unavailable. Skipping to ' +
-                               'the next request')
-                logger.debug('request: %s'% urlrequest)
-                continue
-            numb_prod = xml_tools.getnumbprod(xml_product_path)
-            logger.info('The total number of product for the current request is %s'% str(numb_prod))
-            logger.info('Retrieving the entire list of products currently available in the scihub ' +
-                        'database…')
-            totalProduct = osodrequest.browseprod(urlrequest,
-                                                  sat,
-                                                  numb_prod,
-                                                  int(conf_dict['param']['max_items']),
-                                                  int(conf_dict['param']['nb_retry']),
-                                                  int(conf_dict['param']['wait_time']),
-                                                  xml_product_path)
-            if not totalProduct:
-                logger.warning('Failed to retrieve the list of product. The server may be ' +
-                                'currently unavailable. Skipping to the next request')
-                continue
-            if sat != 'S1' and row[2].isdigit():
-                totalProduct = misc_tools.cloudfilter(totalProduct, sat, int(row[2]))
-                logger.info('Number of product corresponding to a cloud cover percentage of %s: %s'%
-                            (row[2], str(len(totalProduct))))
-            current_list = osodrequest.filternewproduct(past_prod_list, totalProduct)
-            if not current_list:
-                logger.info('No new products were found for the current request. Skipping to the next request.')
-                continue
-            else:
-                logger.info('%s new product(s) were published for the current request.'% str(len(current_list)))
-            for element in current_list:
-                cur_prod_status = '' # ne devrais pas être nécessaire normalement d'initialiser les variables.
-                cur_part_status = ''
-                if (sat == 'S2') and ((row[3] != '') or (row[4] != '')):#tiles and/or bands case
-                    bandsandtiles = misc_tools.extractBandsTiles(row[3], row[4])
-                    logger.debug('type year: %s'% str(type(element[3])))
-                    base_prod_path = cur_dl_path_base + '/' + sat + '/' + element[3] + '/' + element[0]
-                    xml_manifest_path = base_prod_path + '/' + 'manifest.safe' + '.xml'
-                    report_part_path = cur_dl_path_base + '/rep_' + element[0] + '.xml'
-                    misc_tools.create_directory(os.path.dirname(xml_manifest_path))
-                    xmlReport.createXml(report_part_path)
-                    #repeat code 3 begin---------------------
-                    if not fulldisk:
-                        result = osodrequest.getmanifest(element[2], element[0],
-                                                         int(conf_dict['param']['nb_retry']),
-                                                         int(conf_dict['param']['wait_time']),
-                                                         xml_manifest_path)
-                        if result:
-                            logger.info('Manifest.safe successfully retrieved')
-                            logger.info('reading manifest file…') 
-                            product_parts = manifestSafe.readmanifest(xml_manifest_path)
-                            logger.info('Filtering elements of the product…')
-                            size_before_filt = len(product_parts)
-                            logger.info('Number of parts before filtering: %s'% str(size_before_filt))
-                            product_parts = manifestSafe.filterelementS2(product_parts,
-                                                                         bandsandtiles[0],
-                                                                         bandsandtiles[1])
-                            size_after_filt = len(product_parts)
-                            logger.info('Number of parts after filtering: %s'% str(size_after_filt))
-                            if size_before_filt == size_after_filt:
-                                logger.info('No bands or tiles correspond to the specified bands and tiles ' +
-                                            'for the current product')
-                                continue
-                            logger.info('Generating product parts uri…')
-                            product_parts = manifestSafe.generateuri(product_parts,
-                                                                     element[2],
-                                                                     element[0])
-                            #repeat code 4 begin--------------------- 
-                            for i, part in enumerate(product_parts):
-                                if not fulldisk:
-                                    part_path = base_prod_path + part[0][1:]
-                                    misc_tools.create_directory(os.path.dirname(part_path))
-                                    logger.info('download %s out of %s\n file : %s'
-                                                 % (str(i+1), str(len(product_parts)), part_path))
-                                    result = osodrequest.getimagefile(part[2],
-                                                                      int(conf_dict['param']['nb_retry']),
-                                                                      int(conf_dict['param']['wait_time']),
-                                                                      part_path,
-                                                                      chunk_size,
-                                                                      part[1].lower())
-                                    fulldisk = result[1]
-                                    if result[0]:
-                                        md5generated = misc_tools.generate_file_md5(os.path.dirname(part_path),
-                                                                                    os.path.basename(part_path),
-                                                                                    chunk_size)
-                                        if md5generated.lower() == part[1].lower():
-                                            logger.info('The current product part has been successfully retrieved')
-                                            cur_part_status = 'checksum ok'
-                                        else:
-                                            logger.warning('The current product part is corrupted')
-                                            cur_part_status = 'corrupted file'
-                                    else:
-                                        logger.warning('The current product part could not be retrieved.') 
-                                        cur_part_status = 'corrupted file'
-                                else:
-                                    logger.warning('The current product part has not been retrieved because the disk is full') 
-                                    cur_part_status = 'corrupted file'
-                                xmlReport.removeElementEntry(report_part_path, part[0]) # ensure there is not any duplicated entry
-                                xmlReport.addElementEntry(report_part_path, part[0],
-                                                          part[2], part[1],
-                                                          cur_part_status)
-                            count = xmlReport.statusFrequency(report_part_path)
-                            if (sum(count.values()) - count['checksum ok']) == 0:
-                                cur_prod_status = 'checksum ok'
-                            else:
-                                cur_prod_status = 'corrupted archive'
-                            #repeat code 4 end--------------------- 
-                        else:
-                            logger.warning('Failed to retrieve the manifest.safe file')
-                            cur_prod_status = 'missing manifest'
-                    else:
-                        cur_prod_status = 'missing manifest'
-                    #repeat code 3 end---------------------
-                    xmlReport.removeProductEntry(report_path, element[1]) # Make sure there is no duplicated entry
-                    xmlReport.addProductEntry(report_path, element[0],
-                                            element[1], element[2], cur_prod_status, 'not needed', element[3])
-                else: #entire product case
-                    cur_dl_path_file = cur_dl_path_base + '/' + sat + '/' + element[3] + '/' + element[0] + ".zip"
-                    logger.info('Current file path: %s'% cur_dl_path_file)
-                    misc_tools.create_directory(os.path.dirname(cur_dl_path_file))
-                    #code reapeat 1 begin-------------------------------------
-                    checksum_real = osodrequest.getmd5(element[2], int(conf_dict['param']['nb_retry']),
-                                                       int(conf_dict['param']['wait_time']))
-                    if checksum_real[0]:
+                            logger.warning('The checksum could not be retrived. Skipping to the next product')
+                            cur_prod_status = 'missing checksum'
+                        #code reapeat 1 end--------------------------------
+                    elif element[4] == 'corrupted archive':
                         #code reapeat 2 begin
-                        if not fulldisk:
-                            logger.info('Downloading image %s to path: %s…'% (element[0], cur_dl_path_file))
+                        if catalogdb.linkstored(catalog, element[1], element[3], cur_dl_path_file):
+                            cur_prod_status = 'checksum ok'
+                        elif not fulldisk:
+                            logger.info('Downloading image %s to path: %s…'% (element[0], cur_dl_path_file)) 
                             result = osodrequest.getimagefile(element[2],
                                                               int(conf_dict['param']['nb_retry']),
                                                               int(conf_dict['param']['wait_time']),
                                                               cur_dl_path_file,
                                                               chunk_size,
-                                                              checksum_real[1].lower())
+                                                              element[3].lower(),
+                                                              nbSegments=int(conf_dict['param']['nb_segments']))
                             fulldisk = result[1]
-                            if result[0]:  
-                                checksum_calculated = misc_tools.generate_file_md5(os.path.dirname(cur_dl_path_file),
-                                                                                   os.path.basename(cur_dl_path_file),
-                                                                                   blocksize=2**20)
+                            if result[0]:
+                                checksum_calculated = result[2]
                                 logger.debug('checksum calculated: %s'% checksum_calculated.lower())
-                                logger.debug('checksum real: %s'% checksum_real[1].lower())
-                                if (checksum_real[1].lower() == checksum_calculated.lower()):
+                                logger.debug('checksum real: %s'% element[3].lower())
+                                if (element[3].lower() == checksum_calculated.lower()):
                                     logger.info('The current product has been successfully retrieved')
                                     cur_prod_status = 'checksum ok'
+                                    catalogdb.addstored(catalog, [(element[1], element[3], cur_dl_path_file)])
                                 else:
-                                    logger.warning('The current product is corrupted') 
+                                    logger.warning('The current product part is corrupted')
                                     cur_prod_status = 'corrupted archive'
                             else:
                                 logger.warning('The current product could not be retrieved.')
@@ -492,16 +329,264 @@ def main():
                         else:
                             logger.warning('The current product has not been retrieved because the disk is full') 
                             cur_prod_status = 'corrupted archive'
-                       #code reapeat 2 end 
+                        #code reapeat 2 end
                     else:
-                        logger.warning('The checksum could not be retrived. Skipping to the next product')
-                        cur_prod_status = 'missing checksum'
-                    #code reapeat 1 end-----------------------------------------
+                        logger.debug('Problem past product. Unknown status.')
+                        cur_prod_status = 'corrupted archive'
+                    xmlReport.updateImageValue(report_path, element[1], 'status', cur_prod_status) 
+        #-----------------------------------Retrieving new product---------------------------------#                   
+        # Only the products ingested since the latest ingestion date seen
+        # for the request (watermark), minus an overlap, are browsed. The
+        # entire catalog is browsed again every full_sync_days days to
+        # catch the products that have been removed or ingested again.
+        # The products are kept in a local catalog (catalogdb): a request
+        # refreshed less than catalog_ttl minutes ago (ex: by a previous
+        # row with the same query) is answered without the scihub, even if
+        # a full sync is due.
+        watermark, last_full_sync = xmlReport.readSyncState(report_path, query)
+        now = datetime.datetime.utcnow()
+        if query in searched:
+            # the search is shared with a previous row (see queryplan)
+            logger.info('The list of products has been retrieved for a previous request.')
+            totalProduct, complete, full_synced, numb_prod = searched[query]
+        else:
+            full_sync = ((watermark == '') or (last_full_sync == '') or
+                         (catalogdb.lastrefresh(catalog, query) is None) or
+                         ((now - misc_tools.readdate(last_full_sync)).days >=
+                          int(conf_dict['param']['full_sync_days'])))
+            cached = catalogdb.freshproducts(catalog, query,
+                                             int(conf_dict['param']['catalog_ttl']))
+            from_catalog = cached is not None
+            complete = True
+            if from_catalog:
+                logger.info('The list of products is read from the local catalog.')
+                # an incomplete browse keeps the watermark where it is
+                totalProduct, complete = cached
+                numb_prod = len(totalProduct)
+            elif full_sync:
+                logger.info('Browsing the entire catalog for the current request…')
+                urlsearch = urlrequest
+            else:
+                logger.info('Browsing the products ingested since %s…'% watermark)
+                urlsearch = misc_tools.ingestionreq(urlrequest, watermark,
+                                                    int(conf_dict['param']['sync_overlap']))
+            if not from_catalog:
+                logger.info('Retrieving the number of product in the database for the current request…')
+                numb_prod = osodrequest.countproducts(urlsearch,
+                                                      int(conf_dict['param']['nb_retry']),
+                                                      int(conf_dict['param']['wait_time']))
+                if numb_prod is None:
+                    logger.warning('Failed to retrieve the number of product. The ' +
+                                   'server may be currently unavailable. Skipping to ' +
+                                   'the next request')
+                    logger.debug('request: %s'% urlrequest)
+                    continue
+                logger.info('The total number of product for the current request is %s'% str(numb_prod))
+                logger.info('Retrieving the entire list of products currently available in the scihub ' +
+                            'database…')
+                totalProduct, complete = osodrequest.browseprod(urlsearch,
+                                                                sat,
+                                                                numb_prod,
+                                                                int(conf_dict['param']['max_items']),
+                                                                int(conf_dict['param']['nb_retry']),
+                                                                int(conf_dict['param']['wait_time']),
+                                                                int(conf_dict['param']['nb_page_workers']))
+                if not totalProduct and numb_prod > 0:
+                    logger.warning('Failed to retrieve the list of product. The server may be ' +
+                                    'currently unavailable. Skipping to the next request')
+                    continue
+                # A partial list is kept: its products are downloaded, but
+                # neither the watermark nor the full sync move forward so that
+                # the missing products are browsed again at the next run.
+                catalogdb.storeproducts(catalog, query, totalProduct, full_sync and complete,
+                                        complete)
+                if not (full_sync and complete):
+                    # the products ingested before the watermark come from the catalog
+                    totalProduct = catalogdb.readproducts(catalog, query)
+            full_synced = full_sync and complete and not from_catalog
+            searched[query] = (totalProduct, complete, full_synced, numb_prod)
+        for element in totalProduct:
+            if complete and element[5] and ((watermark == '') or
+                               (misc_tools.readdate(element[5]) > misc_tools.readdate(watermark))):
+                watermark = element[5]
+        # The full sync is only recorded once the scihub has been browsed.
+        if full_synced:
+            last_full_sync = now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            removed_list = osodrequest.filterremovedproduct(xmlReport.readXml(report_path),
+                                                            totalProduct)
+            for element in removed_list:
+                if element[4] == 'checksum ok':
+                    logger.info('%s is not in the catalog anymore.'% element[0])
+                else:
+                    logger.warning('%s is not in the catalog anymore and can\'t be retrieved. '% element[0] +
+                                   'Removing it from the report.')
                     xmlReport.removeProductEntry(report_path, element[1])
-                    xmlReport.addProductEntry(report_path, element[0],
-                                              element[1], element[2], cur_prod_status,
-                                              checksum_real[1], element[3])
+        if plan['shared'] > 1:
+            # Only the products of the current row are kept from the search
+            # shared with the other rows.
+            if plan['polygon'] is not None:
+                totalProduct = queryplan.footprintfilter(totalProduct, plan['polygon'])
+            if sat == 'S2':
+                totalProduct = queryplan.tilefilter(totalProduct,
+                                                    misc_tools.extractBandsTiles(row[3], row[4])[0])
+            logger.info('Number of product corresponding to the footprint and the tiles of ' +
+                        'the current request: %s'% str(len(totalProduct)))
+        if sat != 'S1' and row[2].isdigit():
+            totalProduct = misc_tools.cloudfilter(totalProduct, sat, int(row[2]))
+            logger.info('Number of product corresponding to a cloud cover percentage of %s: %s'%
+                        (row[2], str(len(totalProduct))))
+        current_list = osodrequest.filternewproduct(past_prod_list, totalProduct)
+        if not current_list:
+            logger.info('No new products were found for the current request.')
+        else:
+            logger.info('%s new product(s) were published for the current request.'% str(len(current_list)))
+        # The manifests (tiles and/or bands case) or the checksums (entire
+        # product case) of the new products are retrieved concurrently
+        # before the downloads start. Nothing is retrieved once the disk is
+        # full.
+        if fulldisk:
+            prefetched = [None] * len(current_list)
+        elif (sat == 'S2') and ((row[3] != '') or (row[4] != '')):
+            prefetch_args = []
+            for element in current_list:
+                xml_manifest_path = (cur_dl_path_base + '/' + sat + '/' + element[3] + '/' +
+                                     element[0] + '/' + 'manifest.safe' + '.xml')
+                misc_tools.create_directory(os.path.dirname(xml_manifest_path))
+                prefetch_args.append((element[2], element[0],
+                                      int(conf_dict['param']['nb_retry']),
+                                      int(conf_dict['param']['wait_time']),
+                                      xml_manifest_path))
+            prefetched = engine.runparallel(osodrequest.getmanifest, prefetch_args,
+                                            int(conf_dict['param']['nb_workers']))
+        else:
+            prefetch_args = [(element[2], int(conf_dict['param']['nb_retry']),
+                              int(conf_dict['param']['wait_time'])) for element in current_list]
+            prefetched = engine.runparallel(osodrequest.getmd5, prefetch_args,
+                                            int(conf_dict['param']['nb_workers']))
+        for element, prefetch in zip(current_list, prefetched):
+            cur_prod_status = '' # ne devrais pas être nécessaire normalement d'initialiser les variables.
+            cur_part_status = ''
+            if (sat == 'S2') and ((row[3] != '') or (row[4] != '')):#tiles and/or bands case
+                bandsandtiles = misc_tools.extractBandsTiles(row[3], row[4])
+                logger.debug('type year: %s'% str(type(element[3])))
+                base_prod_path = cur_dl_path_base + '/' + sat + '/' + element[3] + '/' + element[0]
+                xml_manifest_path = base_prod_path + '/' + 'manifest.safe' + '.xml'
+                report_part_path = cur_dl_path_base + '/rep_' + element[0] + '.xml'
+                misc_tools.create_directory(os.path.dirname(xml_manifest_path))
+                xmlReport.createXml(report_part_path)
+                #repeat code 3 begin---------------------
+                if not fulldisk:
+                    result = prefetch # return of osodrequest.getmanifest
+                    if result:
+                        logger.info('Manifest.safe successfully retrieved')
+                        logger.info('reading manifest file…') 
+                        product_parts = manifestSafe.readmanifest(xml_manifest_path)
+                        logger.info('Filtering elements of the product…')
+                        size_before_filt = len(product_parts)
+                        logger.info('Number of parts before filtering: %s'% str(size_before_filt))
+                        product_parts = manifestSafe.filterelementS2(product_parts,
+                                                                     bandsandtiles[0],
+                                                                     bandsandtiles[1])
+                        size_after_filt = len(product_parts)
+                        logger.info('Number of parts after filtering: %s'% str(size_after_filt))
+                        if size_before_filt == size_after_filt:
+                            logger.info('No bands or tiles correspond to the specified bands and tiles ' +
+                                        'for the current product')
+                            continue
+                        logger.info('Generating product parts uri…')
+                        product_parts = manifestSafe.generateuri(product_parts,
+                                                                 element[2],
+                                                                 element[0])
+                        #repeat code 4 begin--------------------- 
+                        for part, cur_part_status, fulldisk in dlpool.downloadparts(product_parts,
+                                                                                    base_prod_path,
+                                                                                    int(conf_dict['param']['nb_retry']),
+                                                                                    int(conf_dict['param']['wait_time']),
+                                                                                    chunk_size,
+                                                                                    int(conf_dict['param']['nb_workers']),
+                                                                                    fulldisk):
+                            xmlReport.removeElementEntry(report_part_path, part[0]) # ensure there is not any duplicated entry
+                            xmlReport.addElementEntry(report_part_path, part[0],
+                                                      part[2], part[1],
+                                                      cur_part_status)
+                        count = xmlReport.statusFrequency(report_part_path)
+                        if (sum(count.values()) - count['checksum ok']) == 0:
+                            cur_prod_status = 'checksum ok'
+                        else:
+                            cur_prod_status = 'corrupted archive'
+                        #repeat code 4 end--------------------- 
+                    else:
+                        logger.warning('Failed to retrieve the manifest.safe file')
+                        cur_prod_status = 'missing manifest'
+                else:
+                    cur_prod_status = 'missing manifest'
+                #repeat code 3 end---------------------
+                xmlReport.removeProductEntry(report_path, element[1]) # Make sure there is no duplicated entry
+                xmlReport.addProductEntry(report_path, element[0],
+                                        element[1], element[2], cur_prod_status, 'not needed', element[3])
+            else: #entire product case
+                cur_dl_path_file = cur_dl_path_base + '/' + sat + '/' + element[3] + '/' + element[0] + ".zip"
+                logger.info('Current file path: %s'% cur_dl_path_file)
+                misc_tools.create_directory(os.path.dirname(cur_dl_path_file))
+                #code reapeat 1 begin-------------------------------------
+                checksum_real = prefetch # return of osodrequest.getmd5
+                if checksum_real is None:
+                    logger.warning('The checksum has not been retrieved because the disk is full')
+                    checksum_real = (False, '')
+                    cur_prod_status = 'missing checksum'
+                elif checksum_real[0]:
+                    #code reapeat 2 begin
+                    if catalogdb.linkstored(catalog, element[1], checksum_real[1], cur_dl_path_file):
+                        cur_prod_status = 'checksum ok'
+                    elif not fulldisk:
+                        logger.info('Downloading image %s to path: %s…'% (element[0], cur_dl_path_file))
+                        result = osodrequest.getimagefile(element[2],
+                                                          int(conf_dict['param']['nb_retry']),
+                                                          int(conf_dict['param']['wait_time']),
+                                                          cur_dl_path_file,
+                                                          chunk_size,
+                                                          checksum_real[1].lower(),
+                                                          nbSegments=int(conf_dict['param']['nb_segments']))
+                        fulldisk = result[1]
+                        if result[0]:  
+                            checksum_calculated = result[2]
+                            logger.debug('checksum calculated: %s'% checksum_calculated.lower())
+                            logger.debug('checksum real: %s'% checksum_real[1].lower())
+                            if (checksum_real[1].lower() == checksum_calculated.lower()):
+                                logger.info('The current product has been successfully retrieved')
+                                cur_prod_status = 'checksum ok'
+                                catalogdb.addstored(catalog, [(element[1], checksum_real[1], cur_dl_path_file)])
+                            else:
+                                logger.warning('The current product is corrupted') 
+                                cur_prod_status = 'corrupted archive'
+                        else:
+                            logger.warning('The current product could not be retrieved.')
+                            cur_prod_status = 'corrupted archive'
+                    else:
+                        logger.warning('The current product has not been retrieved because the disk is full') 
+                        cur_prod_status = 'corrupted archive'
+                   #code reapeat 2 end 
+                else:
+                    logger.warning('The checksum could not be retrived. Skipping to the next product')
+                    cur_prod_status = 'missing checksum'
+                #code reapeat 1 end-----------------------------------------
+                xmlReport.removeProductEntry(report_path, element[1])
+                xmlReport.addProductEntry(report_path, element[0],
+                                          element[1], element[2], cur_prod_status,
+                                          checksum_real[1], element[3])
+        # The watermark is only saved once the new products are in the
+        # report, so that an interrupted run browses them again.
+        xmlReport.updateSyncState(report_path, query, watermark, last_full_sync)
+        if full_synced:
             xmlReport.updateRootValue(report_path, 'number_past_product', str(numb_prod))
+    catalog.close()
+    logger.info('Part store: %s part(s) linked instead of downloaded, %s saved, %s freed'%
+                (str(dlpool.storeStats['linked']), progressbar.humansize(dlpool.storeStats['saved']),
+                 progressbar.humansize(dlpool.prunestore())))
+    logger.info('Digest cache: %s stale entrie(s) removed'% str(misc_tools.prunedigest()))
+    stats = osodrequest.connectionstats()
+    logger.info('%s http requests sent, %s connections opened, %s reused'%
+                (str(stats['requests']), str(stats['opened']), str(stats['reused'])))
 
 #-----------------------------------execute main---------------------------------#    
 try:
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the md5 checksum of big files (misc_tools.generate_file_md5).
+
+Files of 100 MB, 500 MB and 2 GB (random bytes) are hashed with:
+    - loop1M / loop8M: the former generate_file_md5, f.read(blocksize) with
+      the blocksizes used by the callers (2**20 and 2**23),
+    - readinto: misc_tools.md5readinto (one buffer of 2**23 bytes),
+    - mmap: misc_tools.md5mmap (windows of MMAP_WINDOW bytes),
+    - auto: misc_tools.generate_file_md5, which picks one of them by size.
+Each file is hashed with a cold page cache (echo 3 > /proc/sys/vm/drop_caches
+if run as root, the pages of the file are dropped with posix_fadvise
+otherwise) and with a warm one. Each variant runs in its own process so that
+its peak memory (ru_maxrss) is not mixed with the other ones.
+
+usage: python benchmd5.py [directory of the files (default: /tmp)] [sizes in MB]
+"""
+import os
+import sys
+import time
+import hashlib
+import resource
+import subprocess
+
+script_path = os.path.realpath(__file__)
+module_path = os.path.dirname(os.path.dirname(script_path)) + '/Module'
+sys.path.append(module_path)
+
+import misc_tools
+
+def loopmd5(file_path, blocksize):
+    """misc_tools.generate_file_md5 before the md5 backends."""
+    m = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        while True:
+            buf = f.read(blocksize)
+            if not buf:
+                break
+            m.update(buf)
+    return m.hexdigest()
+
+def dropcache(file_path):
+    if os.getuid() == 0:
+        subprocess.call('sync; echo 3 > /proc/sys/vm/drop_caches', shell=True)
+    else:
+        fd = os.open(file_path, os.O_RDONLY)
+        misc_tools.fadvise(fd, misc_tools.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+def run(variant, file_path, cache):
+    if cache == 'cold':
+        dropcache(file_path)
+    size = os.path.getsize(file_path)
+    start = time.time()
+    if variant == 'loop1M':
+        checksum = loopmd5(file_path, 2**20)
+    elif variant == 'loop8M':
+        checksum = loopmd5(file_path, 2**23)
+    elif variant == 'auto':
+        checksum = misc_tools.generate_file_md5(os.path.dirname(file_path),
+                                                os.path.basename(file_path), 2**23)
+    else:
+        with open(file_path, 'rb', 0) as f:
+            misc_tools.fadvise(f.fileno(), misc_tools.POSIX_FADV_SEQUENTIAL)
+            if variant == 'readinto':
+                checksum = misc_tools.md5readinto(f, 2**23)
+            else:
+                checksum = misc_tools.md5mmap(f, size)
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print('%-4s %-8s %6.2f s %5.0f MB/s  cpu %6.2f s  %5.0f MB  %s'
+          % (cache, variant, elapsed, size / elapsed / 2**20,
+             usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0, checksum))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3], sys.argv[4])
+        sys.exit(0)
+
+    # the logs of misc_tools are not shown
+    misc_tools.logger.disabled = True
+    dir_path = sys.argv[1] if len(sys.argv) > 1 else '/tmp'
+    sizes = [int(arg) for arg in sys.argv[2:]] or [100, 500, 2048]
+    for size in sizes:
+        file_path = os.path.join(dir_path, 'benchmd5_%dM.bin'% size)
+        with open(file_path, 'wb') as f:
+            for i in range(size):
+                f.write(os.urandom(2**20))
+        print('%d MB'% size)
+        try:
+            for cache in ['cold', 'warm']:
+                for variant in ['loop1M', 'loop8M', 'readinto', 'mmap', 'auto']:
+                    if cache == 'warm':
+                        loopmd5(file_path, 2**20)
+                    subprocess.call([sys.executable, script_path, '--run', variant,
+                                     file_path, cache])
+        finally:
+            os.remove(file_path)
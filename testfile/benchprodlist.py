@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the extraction of the products of an open search response.
+
+A synthetic response of n entries (with long footprints, like the scihub ones)
+is read with:
+    - tree: the former xml_tools.getprodlist, which parses the whole tree and
+      reads the dates with dateutil,
+    - stream: the current xml_tools.readpage, which reads the entries one at a
+      time with iterparse and reads the dates with xml_tools.isodate.
+Each variant runs in its own process so that its peak memory (ru_maxrss) is
+not mixed with the other one.
+
+usage: python benchprodlist.py [number of entries]
+"""
+import os
+import sys
+import time
+import random
+import resource
+import tempfile
+import subprocess
+import dateutil.parser as parser
+from lxml import etree
+
+script_path = os.path.realpath(__file__)
+module_path = os.path.dirname(os.path.dirname(script_path)) + '/Module'
+sys.path.append(module_path)
+
+import xml_tools
+
+def treeprodlist(page, sat):
+    """xml_tools.getprodlist before the streaming parser."""
+    ns = xml_tools.ns
+    root = etree.fromstring(page)
+    prod_list = []
+    for entry in root.iterfind('default:entry', ns):
+        title = entry.find('default:title', ns).text
+        uuid = entry.find('default:id', ns).text
+        link = entry.find('default:link', ns).get('href')
+        date = entry.find('default:date[@name="beginposition"]', ns).text
+        year = str(parser.parse(date).year)
+        element = [title, uuid, link, year]
+        if sat == 'S2':
+            element.append(float(entry.find('default:double[@name="cloudcoverpercentage"]', ns).text))
+        else:
+            element.append(None)
+        ingestion = entry.find('default:date[@name="ingestiondate"]', ns)
+        element.append(ingestion.text if ingestion is not None else '')
+        prod_list.append(element)
+    return int(root.find('os:totalResults', ns).text), prod_list
+
+def makepage(nb_entry):
+    random.seed(0)
+    entries = []
+    for i in range(nb_entry):
+        uuid = '%08x-0000-0000-0000-%012x'% (i, i)
+        footprint = ' '.join('%0.6f,%0.6f'% (random.uniform(-10, 10), random.uniform(40, 50))
+                             for j in range(200))
+        entries.append(
+            '<entry><title>S2A_MSIL1C_20170105T%06d_N0204_R008_T31TDF_%d</title>'
+            '<link href="https://scihub.copernicus.eu/dhus/odata/v1/Products(\'%s\')/$value"/>'
+            '<link rel="alternative" href="https://scihub.copernicus.eu/dhus/odata/v1/Products(\'%s\')/"/>'
+            '<link rel="icon" href="https://scihub.copernicus.eu/dhus/odata/v1/Products(\'%s\')/Products(\'Quicklook\')/$value"/>'
+            '<id>%s</id>'
+            '<date name="ingestiondate">2017-01-05T15:%02d:%02d.%03dZ</date>'
+            '<date name="beginposition">2017-01-05T10:%02d:%02d.026Z</date>'
+            '<str name="gmlfootprint">&lt;gml:Polygon&gt;%s&lt;/gml:Polygon&gt;</str>'
+            '<double name="cloudcoverpercentage">%0.4f</double>'
+            '<str name="filename">S2A_MSIL1C_%d.SAFE</str></entry>'
+            % (i, i, uuid, uuid, uuid, uuid, i % 60, i % 60, i % 1000, i % 60, i % 60,
+               footprint, random.uniform(0, 100), i))
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<feed xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" '
+            'xmlns="http://www.w3.org/2005/Atom">'
+            '<opensearch:totalResults>%d</opensearch:totalResults>%s</feed>'
+            % (nb_entry, ''.join(entries)))
+
+def run(variant, page_path):
+    with open(page_path, 'rb') as f:
+        page = f.read()
+    start = time.time()
+    if variant == 'tree':
+        numb, prod_list = treeprodlist(page, 'S2')
+    else:
+        numb, prod_list = xml_tools.readpage(page, 'S2')
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%-7s %7.2f s  %8.0f entries/s  peak RSS %7.1f MB  (%d/%d products)'
+          % (variant, elapsed, len(prod_list) / elapsed, rss / 1024.0, len(prod_list), numb))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    nb_entry = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    page = makepage(nb_entry)
+    page_path = tempfile.mktemp(suffix='.xml')
+    with open(page_path, 'wb') as f:
+        f.write(page)
+    # both variants must return the same products (the footprint has been
+    # added to the records since)
+    numb, prod_list = xml_tools.readpage(page, 'S2')
+    assert treeprodlist(page, 'S2') == (numb, [list(element[:6]) for element in prod_list])
+    del page
+
+    print('%d entries, %0.1f MB'% (nb_entry, os.path.getsize(page_path) / 2.0**20))
+    try:
+        for variant in ['tree', 'stream']:
+            subprocess.call([sys.executable, script_path, '--run', variant, page_path])
+    finally:
+        os.remove(page_path)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of the download loop of progressbar.chunk_read3.
+
+A file is served by a local http server and downloaded with:
+    - read: the former loop, which creates a new string of chunk_size bytes
+      for each response.read(chunk_size),
+    - readinto: the current chunk_read3, which fills a single buffer with
+      readinto.
+Each variant runs in its own process so that its peak memory (ru_maxrss) is
+not mixed with the other one.
+
+usage: python benchreadloop.py [size in MB] [chunk size in bytes]
+"""
+import os
+import sys
+import time
+import shutil
+import hashlib
+import resource
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import SimpleHTTPServer
+
+script_path = os.path.realpath(__file__)
+module_path = os.path.dirname(os.path.dirname(script_path)) + '/Module'
+sys.path.append(module_path)
+
+import httpsession
+import progressbar
+
+def readloop(response, destination_path, chunk_size):
+    """Loop of chunk_read3 before the readinto buffer."""
+    m = hashlib.md5()
+    with open(destination_path, 'wb') as f:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            m.update(chunk)
+            f.write(chunk)
+    return m.hexdigest()
+
+def run(variant, url, destination_path, chunk_size):
+    session = httpsession.Session()
+    response = session.urlopen(url)
+    start = time.time()
+    if variant == 'read':
+        checksum = readloop(response, destination_path, chunk_size)
+    else:
+        checksum = progressbar.chunk_read3(response, destination_path, '', chunk_size)[1]
+    elapsed = time.time() - start
+    size = os.path.getsize(destination_path)
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%-9s %8.1f MB/s  peak RSS %7.1f MB  md5 %s'
+          % (variant, size / elapsed / 2**20, rss / 1024.0, checksum))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]))
+        sys.exit(0)
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2**23
+    tmp_dir = tempfile.mkdtemp()
+    with open(tmp_dir + '/file.bin', 'wb') as f:
+        block = os.urandom(2**20)
+        for i in range(size):
+            f.write(block)
+
+    os.chdir(tmp_dir)
+    SimpleHTTPServer.SimpleHTTPRequestHandler.log_message = lambda *args: None
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), SimpleHTTPServer.SimpleHTTPRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%s/file.bin'% str(server.server_address[1])
+
+    print('%s MB, chunk size %s bytes'% (str(size), str(chunk_size)))
+    try:
+        for variant in ['read', 'readinto']:
+            destination_path = tmp_dir + '/out_%s.bin'% variant
+            subprocess.call([sys.executable, script_path, '--run',
+                             variant, url, destination_path, str(chunk_size)])
+            os.remove(destination_path)
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the product records and of the detection of the new products.
+
+For n products (10k and 100k by default):
+    - memory: peak RSS of n records built as lists (former records) and as
+      xml_tools.ProductRecord,
+    - diff: time of the former osodrequest.filternewproduct (membership test
+      in a list of uuids, O(N*M)) and of the current one (set of uuids) to
+      find the 1% of new products among n.
+Each variant runs in its own process so that its peak memory (ru_maxrss) is
+not mixed with the other one. The former diff is not run above 20k products
+(it takes hours at 100k).
+
+usage: python benchrecords.py [n1 n2 ...]
+"""
+import os
+import sys
+import time
+import resource
+import subprocess
+
+script_path = os.path.realpath(__file__)
+module_path = os.path.dirname(os.path.dirname(script_path)) + '/Module'
+sys.path.append(module_path)
+
+import xml_tools
+import osodrequest
+
+def listfilternewproduct(oldProduct, totalProduct):
+    """osodrequest.filternewproduct before the set of uuids."""
+    oldUuid = [elem[1] for elem in oldProduct]
+    newProduct = [elem for elem in totalProduct if elem[1] not in oldUuid]
+    return newProduct
+
+def makeproduct(i, record):
+    uuid = '%08x-1244-4b81-bfd4-%012x'% (i, i)
+    fields = ['S2A_MSIL1C_20170105T%06d_N0204_R008_T31TDF_20170105T103426'% (i % 1000000),
+              uuid,
+              "https://scihub.copernicus.eu/dhus/odata/v1/Products('%s')/$value"% uuid,
+              '2017',
+              float(i % 100),
+              '2017-01-05T15:%02d:%02d.%03dZ'% (i % 60, i % 60, i % 1000),
+              'POLYGON ((%d.1 44.2,%d.4 43.2,%d.7 43.2,%d.7 44.2,%d.1 44.2))'% ((i % 10,) * 5)]
+    if record:
+        return xml_tools.ProductRecord._make(fields)
+    return fields
+
+def rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run(variant, nb_product):
+    before = rss()
+    total_product = [makeproduct(i, variant == 'record') for i in xrange(nb_product)]
+    memory = rss() - before
+    old_product = total_product[:nb_product - nb_product // 100]
+    if variant == 'list':
+        if nb_product > 20000:
+            print('%-7s %7d products  %7.1f MB  diff: skipped (O(N*M))'
+                  % (variant, nb_product, memory))
+            return
+        diff = listfilternewproduct
+    else:
+        diff = osodrequest.filternewproduct
+    start = time.time()
+    new_product = diff(old_product, total_product)
+    elapsed = time.time() - start
+    print('%-7s %7d products  %7.1f MB  diff: %8.3f s (%d new)'
+          % (variant, nb_product, memory, elapsed, len(new_product)))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    for nb_product in sizes:
+        for variant in ['list', 'record']:
+            subprocess.call([sys.executable, script_path, '--run', variant, str(nb_product)])
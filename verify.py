@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#-----------------------------------------------------------------------------#
+#-----------------------------------VERIFY------------------------------------#
+#-----------------------------------------------------------------------------#
+# Check the integrity of the files already downloaded in the download
+# directory (dl_dir of the config.cfg file) without contacting the scihub.
+# Each file is hashed again and its md5 checksum compared with the one of the
+# reports. The status of the products and parts are updated: 'checksum ok',
+# 'corrupted file' (part) or 'corrupted archive' (product), so that the next
+# run of main.py downloads the corrupted files again.
+# It must not be run while main.py is running (both write the reports).
+#
+# usage: python verify.py
+import imp
+import sys
+import os
+import time
+import logging
+from logging.handlers import RotatingFileHandler
+import traceback
+
+
+base_path = os.path.dirname(os.path.realpath(__file__))
+module_path = base_path + "/Module"
+
+sys.path.append(module_path)
+
+import misc_tools
+import xmlReport
+import progressbar
+import scrub
+imp.reload(misc_tools)
+imp.reload(xmlReport)
+imp.reload(progressbar)
+imp.reload(scrub)
+
+#------------------------------------------------------------------------------#
+logger = logging.getLogger('sentinel_dl')
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(module)s - %(funcName)s ' +
+                              '- %(levelname)s - %(message)s')
+log_path = base_path + '/activity.log'
+file_handler = RotatingFileHandler(log_path, 'a', 2000000, 2)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+steam_handler = logging.StreamHandler()
+steam_handler.setLevel(logging.INFO)
+logger.addHandler(steam_handler)
+
+
+def main():
+    chunk_size = 2**23 # bytes read at each iteration when hashing a file
+    config_path = base_path + "/config.cfg"
+    conf_dict = misc_tools.readconf(config_path)
+    dl_dir = conf_dict['param']['dl_dir']
+    misc_tools.digestDb = dl_dir + '/digest.db'
+
+    tasks = scrub.listtasks(dl_dir)
+    nb_workers = scrub.nbworkers(int(conf_dict['param']['verify_workers']))
+    logger.info('%s file(s) to check with %s process(es)…'% (str(len(tasks)), str(nb_workers)))
+
+    count = {'checksum ok': 0, 'corrupted file': 0, 'corrupted archive': 0, 'missing': 0}
+    changed = 0
+    total_size = 0
+    # (report path, uuid, status) of the products made of parts: True if all
+    # their parts are ok
+    products = {}
+    start = time.time()
+    for task, checksum, size in scrub.scrub(tasks, nb_workers, chunk_size):
+        file_path, checksum_real, report_path, key, old_status, product = task
+        total_size += size
+        good = checksum != '' and checksum.lower() == checksum_real.lower()
+        if product is None:
+            status = 'checksum ok' if good else 'corrupted archive'
+        else:
+            status = 'checksum ok' if good else 'corrupted file'
+            products[product] = products.get(product, True) and good
+        count[status] += 1
+        if checksum == '':
+            count['missing'] += 1
+            logger.warning('Missing file: %s'% file_path)
+        elif not good:
+            logger.warning('Corrupted file: %s'% file_path)
+        # The reports are only written when a status changes
+        if old_status != status:
+            if product is None:
+                xmlReport.updateImageValue(report_path, key, 'status', status)
+            else:
+                xmlReport.changeElementEntry(report_path, key, 'status', status)
+            changed += 1
+    elapsed = time.time() - start
+
+    for (report_path, uuid, old_status), good in products.items():
+        status = 'checksum ok' if good else 'corrupted archive'
+        if old_status != status:
+            xmlReport.updateImageValue(report_path, uuid, 'status', status)
+            changed += 1
+
+    logger.info('%s file(s), %s checked in %.1f s: %s/s with %s process(es)'%
+                (str(len(tasks)), progressbar.humansize(total_size), elapsed,
+                 progressbar.humansize(total_size / elapsed if elapsed > 0 else 0),
+                 str(nb_workers)))
+    logger.info('%s ok, %s corrupted file(s) (%s missing), %s status(es) updated'%
+                (str(count['checksum ok']),
+                 str(count['corrupted file'] + count['corrupted archive']),
+                 str(count['missing']), str(changed)))
+
+#-----------------------------------execute main---------------------------------#
+try:
+    main()
+except Exception as e:
+    logger.error('A problem occured')
+    logger.error(traceback.format_exc())
+else:
+    logger.info('Everything ran fine')
+finally:
+    logger.info('End verify')